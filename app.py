@@ -6,7 +6,6 @@ import uuid
 from pathlib import Path
 from datetime import datetime, timezone
 import unicodedata
-import re
 
 import requests
 import streamlit as st
@@ -102,20 +101,33 @@ IMPROVED PROMPT:
 """
 
 
+class _ControlCharacterTable(dict):
+    """str.translate table deleting control characters, filled in as code points are seen."""
+
+    def __init__(self, max_size=65536):
+        super().__init__()
+        self.max_size = max_size
+
+    def __missing__(self, code_point):
+        char = chr(code_point)
+        value = None if unicodedata.category(char)[0] == 'C' and char not in '\n\r\t' else char
+        if len(self) < self.max_size:
+            self[code_point] = value
+        return value
+
+
+_CONTROL_TABLE = _ControlCharacterTable()
+
+
 def clean_text_for_llm(text):
     # Normalize Unicode
     text = unicodedata.normalize('NFKC', text)
     
-    # Remove control characters except newlines/tabs
-    text = ''.join(c for c in text if unicodedata.category(c)[0] != 'C' or c in '\n\r\t')
-    
-    # Remove zero-width characters
-    text = re.sub(r'[\u200b-\u200d\ufeff]', '', text)
+    # Remove control characters except newlines/tabs (zero-width characters are Cf)
+    text = text.translate(_CONTROL_TABLE)
     
     # Normalize whitespace
-    text = re.sub(r'\s+', ' ', text)
-    
-    return text.strip()
+    return ' '.join(text.split())
 
 def web_search(query: str, n=10) -> str:
     print(f"Performing web search for query: {query}")
@@ -0,0 +1,274 @@
+import asyncio
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+
+import openai
+from django.conf import settings
+
+from . import log
+from .extraction import OutputExtractor, parse_llm_response, parse_response, record_extraction
+from .shared_utils import (
+    EnhancedPromptResponse,
+    PromptConfig,
+    ProviderSession,
+    ProviderUnavailable,
+    check_hcai_status,
+    create_chat_completion,
+    prompt_cache_stats,
+    run_tool_calls,
+)
+from .timings import Timings
+from .token_budget import get_context_budget
+
+SKIPPED_TOOL_RESULT = "Skipped: the request is running out of time. Answer with the information you already have."
+
+
+@dataclass
+class LoopLimits:
+    request_seconds: float = 90.0
+    llm_call_seconds: float = 45.0
+    tool_seconds: float = 15.0
+    # Time kept free for the final answer; tools are skipped once less than this remains
+    final_answer_reserve_seconds: float = 20.0
+    max_iterations: int = 6
+
+
+def get_loop_limits() -> LoopLimits:
+    defaults = LoopLimits()
+    return LoopLimits(
+        request_seconds=getattr(settings, "AGENT_REQUEST_BUDGET_SECONDS", defaults.request_seconds),
+        llm_call_seconds=getattr(settings, "AGENT_LLM_CALL_TIMEOUT_SECONDS", defaults.llm_call_seconds),
+        tool_seconds=getattr(settings, "AGENT_TOOL_TIMEOUT_SECONDS", defaults.tool_seconds),
+        final_answer_reserve_seconds=getattr(
+            settings, "AGENT_FINAL_ANSWER_RESERVE_SECONDS", defaults.final_answer_reserve_seconds
+        ),
+        max_iterations=getattr(settings, "AGENT_MAX_ITERATIONS", defaults.max_iterations),
+    )
+
+
+class BudgetExhausted(TimeoutError):
+    """The request ran out of time before the model produced any usable answer."""
+
+
+class Deadline:
+    """Wall-clock budget of one request. Time spent waiting for the user is not counted."""
+
+    def __init__(self, seconds: float):
+        self._expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return self._expires_at - time.monotonic()
+
+    @contextmanager
+    def paused(self):
+        paused_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self._expires_at += time.monotonic() - paused_at
+
+
+@dataclass
+class AgentOutcome:
+    result: str | None
+    messages: list
+    is_fallback: bool
+    timings: Timings
+
+
+def skipped_tool_results(tool_calls: list) -> list[dict]:
+    return [
+        {"role": "tool", "tool_call_id": tool_call.id, "content": SKIPPED_TOOL_RESULT}
+        for tool_call in tool_calls
+    ]
+
+
+class AgentLoop:
+    """The tool loop shared by prompt enhancement and editing.
+
+    The model is called with the tools until it stops asking for them, then its
+    answer is extracted by an `OutputExtractor` fed from the stream as it arrives,
+    with one structured `parse` call as the last resort.
+    Every LLM call and web search has its own timeout, and the whole request has a
+    latency budget (`LoopLimits`). When time or iterations run short the loop
+    degrades instead of failing: remaining tool calls are skipped and the model is
+    asked for its final answer, and if a call times out the best draft so far is
+    returned. Only when there is no draft at all does it raise `BudgetExhausted`.
+    """
+
+    def __init__(self, name: str, config: PromptConfig, limits: LoopLimits | None = None):
+        self.limits = limits or get_loop_limits()
+        self.timings = Timings(name)
+        self.deadline = Deadline(self.limits.request_seconds)
+        self.context_budget = get_context_budget()
+        self.session: ProviderSession | None = None
+        self.extractor = OutputExtractor()
+        if config.ask_user_func:
+            config = replace(config, ask_user_func=self._pausing_deadline(config.ask_user_func))
+        self.config = config
+        self._on_delta = self._extracting_delta if config.on_delta else None
+        # The draft the client is showing, and whether the next delta must replace
+        # it because a new call (the next turn, or a retry on the fallback) started
+        self._shown = ""
+        self._restart_stream = False
+
+    def _pausing_deadline(self, ask_user_func):
+        async def ask_user(questions):
+            with self.deadline.paused():
+                return await ask_user_func(questions)
+        return ask_user
+
+    async def _extracting_delta(self, delta: str):
+        """Stream the improved prompt of the current call, not the analysis or tool chatter around it."""
+        draft = self.extractor.feed(delta).draft()
+        if not draft or draft == self._shown:
+            return
+        if self._restart_stream or not draft.startswith(self._shown):
+            await self.config.on_delta(draft, reset=True)
+        else:
+            await self.config.on_delta(draft[len(self._shown):])
+        self._shown = draft
+        self._restart_stream = False
+
+    def open_session(self, falling_back: bool = False) -> ProviderSession:
+        """Pick the provider, skipping the primary while HCAI reports downtime or its circuit is open."""
+        session = ProviderSession(self.config.model, fallback=falling_back)
+        if not session.is_fallback and (not check_hcai_status() or session.breaker.is_open()):
+            log("Primary provider is unavailable, falling back to alternative model...")
+            if not session.can_fall_back():
+                raise ProviderUnavailable()
+            session.switch_to_fallback()
+        self.session = session
+        return session
+
+    async def _complete(self, request, messages: list, name: str, turn: int):
+        timeout = min(self.limits.llm_call_seconds, self.deadline.remaining())
+        if timeout <= 0:
+            raise asyncio.TimeoutError
+        with self.timings.step(name, turn=turn):
+            return await self.session.call(request, messages, timeout=timeout)
+
+    def _tool_loop_request(self, messages: list, tools: list, reasoning_effort: str, tool_choice: str | None = None):
+        # Use .create() during tool loop to avoid parsing errors when model returns tool calls
+        extra = {"tool_choice": tool_choice} if tool_choice else {}
+
+        def send(client, model):
+            # A fresh extractor per attempt, so a retry on the fallback starts clean
+            self.extractor = OutputExtractor()
+            self._restart_stream = True
+            return create_chat_completion(
+                client,
+                self._on_delta,
+                model=model,
+                messages=self.context_budget.fit(messages),
+                tools=tools,
+                reasoning_effort=reasoning_effort,
+                **extra,
+            )
+        return send
+
+    def _extract(self, message) -> tuple[str | None, str | None]:
+        """The improved prompt in the message the last call returned, and its format."""
+        if self._on_delta is None:
+            # Not streamed: parse the complete content in one pass
+            return parse_response(message.content)
+        return self.extractor.result(), self.extractor.format
+
+    def _best_draft(self, draft: str | None, messages: list, reason: str) -> AgentOutcome:
+        if draft is None:
+            raise BudgetExhausted("The request took too long to complete. Please try again.")
+        self.timings.degrade(f"{reason}: returned the best draft so far")
+        messages.append({"role": "assistant", "content": draft})
+        return self._finish(draft, messages)
+
+    def _finish(self, result: str | None, messages: list) -> AgentOutcome:
+        self.timings.log_summary()
+        if self.config.on_timings:
+            self.config.on_timings(self.timings.as_dict())
+        return AgentOutcome(result, messages, self.session.is_fallback, self.timings)
+
+    async def run(
+        self,
+        messages: list,
+        tools: list,
+        reasoning_effort: str = "low",
+        followup_reasoning_effort: str | None = None,
+    ) -> AgentOutcome:
+        """Run the loop on `messages`, which is extended in place with the conversation."""
+        if self.session is None:
+            self.open_session()
+        followup_reasoning_effort = followup_reasoning_effort or reasoning_effort
+        limits = self.limits
+        draft = None
+
+        try:
+            message = await self._complete(
+                self._tool_loop_request(messages, tools, reasoning_effort), messages, "llm_call", 1
+            )
+            log(f"[DEBUG] Initial LLM Response (Async): {message}")
+
+            turn = 1
+            while message.tool_calls:
+                messages.append(message)
+                draft = self._extract(message)[0] or draft
+
+                if turn >= limits.max_iterations:
+                    shortcut = "iteration cap reached"
+                elif self.deadline.remaining() <= limits.final_answer_reserve_seconds:
+                    shortcut = "time budget running low"
+                else:
+                    shortcut = None
+
+                if shortcut:
+                    self.timings.degrade(f"{shortcut}: skipped tool calls and forced a final answer")
+                    messages.extend(skipped_tool_results(message.tool_calls))
+                    request = self._tool_loop_request(messages, tools, followup_reasoning_effort, tool_choice="none")
+                else:
+                    tool_timeout = min(limits.tool_seconds, self.deadline.remaining() - limits.final_answer_reserve_seconds)
+                    messages.extend(await run_tool_calls(message.tool_calls, self.config, self.timings, turn, tool_timeout))
+                    request = self._tool_loop_request(messages, tools, followup_reasoning_effort)
+
+                turn += 1
+                message = await self._complete(request, messages, "llm_call", turn)
+                log(f"[DEBUG] Next LLM Response (Async): {message}")
+                if shortcut:
+                    break
+        except (asyncio.TimeoutError, openai.APITimeoutError):
+            return self._best_draft(draft, messages, "LLM call timed out")
+
+        content = message.content or ""
+        with self.timings.step("extract_result"):
+            result, response_format = self._extract(message)
+        record_extraction(response_format, needed_parse_call=not result)
+        if result:
+            messages.append({"role": "assistant", "content": content})
+            return self._finish(result, messages)
+
+        # If parsing failed, make a final call with response_format (no tools)
+        log(f"[DEBUG] Making final parse call with response_format")
+        messages.append(message)
+        try:
+            final_response = await self._complete(
+                lambda client, model: client.chat.completions.parse(
+                    model=model,
+                    messages=self.context_budget.fit(messages),
+                    reasoning_effort=reasoning_effort,
+                    response_format=EnhancedPromptResponse,
+                ),
+                messages,
+                "final_parse_call",
+                turn + 1,
+            )
+        except (asyncio.TimeoutError, openai.APITimeoutError):
+            return self._best_draft(draft, messages, "final parse call timed out")
+        final_message = final_response.choices[0].message
+        prompt_cache_stats.record(final_response.usage)
+
+        if getattr(final_message, "parsed", None):
+            result = final_message.parsed.improved_prompt
+        else:
+            # Last resort: manual parsing of final response
+            result = parse_llm_response(final_message.content)
+        messages.append({"role": "assistant", "content": final_message.content})
+        return self._finish(result, messages)
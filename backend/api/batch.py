@@ -0,0 +1,207 @@
+import asyncio
+import os
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import log
+from .agent_loop import get_loop_limits
+from .lifecycle import on_shutdown, on_startup
+from .models import BatchItem, BatchJob
+from .result_cache import enhance_prompt_cached
+from .scheduler import BATCH, scheduler
+from .shared_utils import PromptConfig
+
+stats = {"items_done": 0, "items_failed": 0, "items_cancelled": 0, "jobs_completed": 0, "jobs_cancelled": 0}
+
+
+def batch_config(options: dict, on_timings) -> PromptConfig:
+    """The enhancement config of a batch item. Nobody is there to answer questions."""
+    return PromptConfig(
+        model=os.getenv("MODEL", "gemini-3-flash-preview"),
+        use_web_search=options.get("use_web_search", False),
+        additional_context_query=options.get("additional_context_query", ""),
+        ask_user_func=None,
+        target_model=options.get("target_model", "gpt-5.1"),
+        is_reasoning_native=options.get("is_reasoning_native", False),
+        prompt_style=options.get("prompt_style", {}),
+        on_timings=on_timings,
+    )
+
+
+class BatchRunner:
+    """Runs batch jobs as tasks on the server's event loop.
+
+    All progress lives in the database, so any process can serve status and result
+    requests. Items are claimed with a conditional update before they run, which
+    keeps two runners from enhancing the same item. At most `max_concurrency` items
+    run at once across all jobs in this process, and each job is further limited to
+    its own `concurrency`. Items also take a slot in the scheduler's batch lane, so
+    interactive requests go first. Cancellation is written to the job row and picked up by
+    the workers before every item, so it also reaches jobs run by other processes.
+    """
+
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self._slots: asyncio.Semaphore | None = None
+        self._slots_loop: asyncio.AbstractEventLoop | None = None
+        self._jobs: dict[str, asyncio.Task] = {}
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._slots_loop is not loop:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+            self._slots_loop = loop
+        return self._slots
+
+    async def start(self, job_id) -> None:
+        """Start running a job on the current loop unless it is already running here."""
+        job_id = str(job_id)
+        task = self._jobs.get(job_id)
+        if task is None or task.done():
+            task = asyncio.ensure_future(self._run_job(job_id))
+            self._jobs[job_id] = task
+
+            def forget(done):
+                if self._jobs.get(job_id) is done:
+                    del self._jobs[job_id]
+            task.add_done_callback(forget)
+
+    async def wait(self, job_id) -> None:
+        task = self._jobs.get(str(job_id))
+        if task is not None:
+            await asyncio.shield(task)
+
+    async def cancel(self, job_id) -> bool:
+        """Mark a job cancelled; items not finished yet are cancelled. False if it had already finished."""
+        updated = await BatchJob.objects.filter(pk=job_id).exclude(status__in=BatchJob.FINISHED).aupdate(
+            status=BatchJob.CANCELLED, finished_at=timezone.now()
+        )
+        if not updated:
+            return False
+        stats["jobs_cancelled"] += 1
+        task = self._jobs.get(str(job_id))
+        if task is not None:
+            task.cancel()
+        stats["items_cancelled"] += await BatchItem.objects.filter(
+            job_id=job_id, status__in=(BatchItem.PENDING, BatchItem.RUNNING)
+        ).aupdate(status=BatchItem.CANCELLED, finished_at=timezone.now())
+        return True
+
+    async def _run_job(self, job_id: str):
+        job = await BatchJob.objects.aget(pk=job_id)
+        if job.status in BatchJob.FINISHED:
+            return
+        if job.status == BatchJob.QUEUED:
+            await BatchJob.objects.filter(pk=job_id, status=BatchJob.QUEUED).aupdate(
+                status=BatchJob.RUNNING, started_at=timezone.now()
+            )
+        log(f"[Batch] Running batch {job_id} ({job.total} items, concurrency {job.concurrency})")
+
+        pending = [
+            pk async for pk in BatchItem.objects.filter(job_id=job_id, status=BatchItem.PENDING)
+            .order_by("index").values_list("pk", flat=True)
+        ]
+        queue: asyncio.Queue[int] = asyncio.Queue()
+        for pk in pending:
+            queue.put_nowait(pk)
+        workers = [
+            asyncio.ensure_future(self._worker(job, queue))
+            for _ in range(max(1, min(job.concurrency, len(pending))))
+        ]
+        try:
+            await asyncio.gather(*workers)
+        except asyncio.CancelledError:
+            for worker in workers:
+                worker.cancel()
+            raise
+
+        finished = await BatchJob.objects.filter(pk=job_id, status=BatchJob.RUNNING).aupdate(
+            status=BatchJob.COMPLETED, finished_at=timezone.now()
+        )
+        if finished:
+            stats["jobs_completed"] += 1
+            log(f"[Batch] Batch {job_id} completed")
+
+    async def _worker(self, job: BatchJob, queue: asyncio.Queue):
+        while not queue.empty():
+            pk = queue.get_nowait()
+            if await BatchJob.objects.filter(pk=job.pk, status=BatchJob.CANCELLED).aexists():
+                return
+            async with self._semaphore(), scheduler.slot(f"batch:{job.pk}", lane=BATCH):
+                claimed = await BatchItem.objects.filter(pk=pk, status=BatchItem.PENDING).aupdate(
+                    status=BatchItem.RUNNING, started_at=timezone.now()
+                )
+                if claimed:
+                    await self._run_item(job, pk)
+
+    async def _run_item(self, job: BatchJob, pk: int):
+        item = await BatchItem.objects.aget(pk=pk)
+        captured = {}
+        config = batch_config(job.options, on_timings=captured.update)
+        t_start = time.perf_counter()
+        try:
+            result, is_fallback, _, cache_hit = await enhance_prompt_cached(
+                task=item.task,
+                lazy_prompt=item.lazy_prompt,
+                config=config,
+                reasoning_effort=job.options.get("reasoning_effort", "low"),
+            )
+        except asyncio.CancelledError:
+            # Interrupted by shutdown or cancel(); queue the item again and let
+            # cancel() mark it cancelled if the whole job is being cancelled
+            await BatchItem.objects.filter(pk=pk, status=BatchItem.RUNNING).aupdate(
+                status=BatchItem.PENDING, started_at=None
+            )
+            raise
+        except Exception as e:
+            log(f"[Batch] Item {item.index} of batch {job.pk} failed: {e}")
+            traceback.print_exc()
+            fields = {"status": BatchItem.FAILED, "error": str(e)}
+            stats["items_failed"] += 1
+        else:
+            fields = {
+                "status": BatchItem.DONE,
+                "result": result or "",
+                "is_fallback": is_fallback,
+                "cache_hit": cache_hit or "",
+            }
+            stats["items_done"] += 1
+        await BatchItem.objects.filter(pk=pk, status=BatchItem.RUNNING).aupdate(
+            timings=captured or None,
+            latency_seconds=time.perf_counter() - t_start,
+            finished_at=timezone.now(),
+            **fields,
+        )
+
+    async def resume_unfinished(self):
+        """Pick up jobs left unfinished by a previous run of the server.
+
+        Items still marked running after twice the request budget belonged to a
+        process that went away, so they are queued again.
+        """
+        stale_before = timezone.now() - timedelta(seconds=2 * get_loop_limits().request_seconds)
+        await BatchItem.objects.filter(status=BatchItem.RUNNING, started_at__lt=stale_before).aupdate(
+            status=BatchItem.PENDING, started_at=None
+        )
+        async for job_id in BatchJob.objects.filter(
+            status__in=(BatchJob.QUEUED, BatchJob.RUNNING)
+        ).values_list("pk", flat=True):
+            await self.start(job_id)
+
+    async def stop(self):
+        tasks = list(self._jobs.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {"active_jobs": len(self._jobs), "max_concurrency": self.max_concurrency, **stats}
+
+
+batch_runner = BatchRunner(max_concurrency=getattr(settings, "BATCH_MAX_CONCURRENCY", 8))
+on_startup(batch_runner.resume_unfinished)
+on_shutdown(batch_runner.stop)
@@ -1,50 +1,50 @@
 import json
 import asyncio
-import os
-import time
 import traceback
+import uuid
 from channels.generic.websocket import AsyncWebsocketConsumer
-from django.core.cache import cache
 from django.conf import settings
-from asgiref.sync import sync_to_async
 from dotenv import load_dotenv
 from . import log
-from .shared_utils import PromptConfig
+from .conversations import get_conversation_store
+from .jobs import Job
+from .lifecycle import run_startup_soon
+from .rate_limit import get_rate_limiter
+from .scheduler import client_key
 
 load_dotenv()
 
-def _check_rate_limit_sync(ip_address):
-        """Check if IP has exceeded rate limit."""
-        cache_key = f"ws_enhance_limit_{ip_address}"
-        count = cache.get(cache_key, 0)
-        
-        limit = getattr(settings, 'WS_RATE_LIMIT', 5)
-        
-        if count >= limit:
-            return False
-            
-        if count == 0:
-            cache.set(cache_key, 1, 60)
-        else:
-            cache.incr(cache_key)
-            
-        return True
-
-
-class EnhanceConsumer(AsyncWebsocketConsumer):
+class JobConsumer(AsyncWebsocketConsumer):
+    """WebSocket end of enhance and edit jobs.
+
+    A `start_type` message starts a job and `user_answer` messages answer its
+    questions. The job runs in this process, or, when ENHANCE_WORKER_CHANNEL is set,
+    in a worker process (`api.workers`) and this consumer only relays frames over
+    the channel layer.
+    """
+    kind = None
+    start_type = None
+    started_message = None
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.pending_answer = None
-        self.answer_event = None
-        self.enhancement_task = None
+        self.answers: asyncio.Queue | None = None
+        self.job_task = None
+        # Worker mode: the running job's id and channel, whether a worker took it,
+        # and the task failing it if none does in time
+        self.job_id = None
+        self.job_channel = None
+        self.worker_started = asyncio.Event()
+        self.start_watchdog = None
 
     async def connect(self):
         self.task_id = self.scope['url_route']['kwargs']['task_id']
-        self.room_group_name = f'enhance_{self.task_id}'
-        self.pending_answer = None
-        self.answer_event = asyncio.Event()
+        self.room_group_name = f'{self.kind}_{self.task_id}'
+        self.answers = asyncio.Queue()
 
         log(f"[WebSocket] Client connecting to group: {self.room_group_name}")
+        # Daphne has no lifespan support, so the first connection triggers startup
+        run_startup_soon()
 
         await self.channel_layer.group_add(
             self.room_group_name,
@@ -56,8 +56,12 @@ class EnhanceConsumer(AsyncWebsocketConsumer):
 
     async def disconnect(self, close_code):
         log(f"[WebSocket] Client disconnecting from group: {self.room_group_name}")
-        if self.enhancement_task and not self.enhancement_task.done():
-            self.enhancement_task.cancel()
+        if self.job_task and not self.job_task.done():
+            self.job_task.cancel()
+        if self.start_watchdog:
+            self.start_watchdog.cancel()
+        if self.job_id:
+            await self.send_to_worker({'type': 'job.cancel'})
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
@@ -71,145 +75,128 @@ class EnhanceConsumer(AsyncWebsocketConsumer):
             log(f"[WebSocket] Message type: {message_type}")
 
             if message_type == 'user_answer':
+                if not await self.check_rate_limit('answer'):
+                    return
                 answer = text_data_json.get('answers')
-                self.pending_answer = answer
-                self.answer_event.set()
-                
+                if self.job_id:
+                    await self.send_to_worker({'type': 'job.answer', 'answers': answer})
+                else:
+                    self.answers.put_nowait(answer)
+
                 await self.send(text_data=json.dumps({
                     'type': 'answer_received',
                     'status': 'ok'
                 }))
 
-            elif message_type == 'enhance':
-                # Rate limit check
-                client_ip = self.scope.get('client', ['0.0.0.0'])[0]
-                is_allowed = await sync_to_async(_check_rate_limit_sync)(client_ip)
-                
-                if not is_allowed:
-                    log(f"[WebSocket] Rate limit exceeded for IP: {client_ip}")
-                    await self.send(text_data=json.dumps({
-                        'type': 'task_error',
-                        'error': 'Rate limit exceeded. Please wait a minute before trying again.'
-                    }))
+            elif message_type == self.start_type:
+                if not await self.check_rate_limit(self.kind):
                     return
 
-                log("[WebSocket] Starting enhancement...")
+                log(f"[WebSocket] Starting {self.kind}...")
                 # Send acknowledgment first
                 await self.send(text_data=json.dumps({
                     'type': 'processing',
-                    'message': 'Enhancement started'
+                    'message': self.started_message
                 }))
-                
-                # Run enhancement and handle result in callback
-                self.enhancement_task = asyncio.create_task(
-                    self._run_enhancement_with_callback(text_data_json)
-                )
-
-        except Exception as e:
-            log(f"[WebSocket] Error in receive: {e}")
-            traceback.print_exc()
+                await self.start_job(text_data_json)
 
-    async def _run_enhancement_with_callback(self, data):
-        """Wrapper that ensures errors are properly sent to client."""
-        try:
-            await self.run_enhancement(data)
-        except asyncio.CancelledError:
-            log("[WebSocket] Enhancement task was cancelled")
-        except Exception as e:
-            log(f"[WebSocket] Unhandled error in enhancement: {e}")
-            traceback.print_exc()
-            try:
+            else:
+                log(f"[WebSocket] Unknown message type received: {message_type}")
                 await self.send(text_data=json.dumps({
                     'type': 'task_error',
-                    'error': str(e)
+                    'error': f'Unknown message type: {message_type}'
                 }))
-            except Exception:
-                pass
 
-    async def run_enhancement(self, data):
-        """Run the enhancement process directly in the WebSocket consumer."""
-        try:
-            t_ws_start = time.perf_counter()
-            # Import here to avoid circular imports at module load time
-            from .enhance import enhance_prompt_async
-            
-            log(f"[WebSocket] Calling enhance_prompt_async with task: {data.get('task', '')[:50]}")
-            log(f"[TIMING] [WS] enhance request received")
-            
-            config = PromptConfig(
-                model=os.getenv("MODEL", "gemini-3-flash-preview"),
-                use_web_search=data.get('use_web_search', True),
-                additional_context_query=data.get('additional_context_query', ''),
-                ask_user_func=self.ask_user_question,
-                target_model=data.get('target_model', 'gpt-5.1'),
-                is_reasoning_native=data.get('is_reasoning_native', False),
-                prompt_style=data.get('prompt_style', {}),
-            )
-            t_before_enhance = time.perf_counter()
-            log(f"[TIMING] [WS] config built in {t_before_enhance - t_ws_start:.3f}s")
-            result, is_fallback, messages = await enhance_prompt_async(
-                task=data.get('task', ''),
-                lazy_prompt=data.get('lazy_prompt', ''),
-                reasoning_effort=data.get('reasoning_effort', 'low'),
-                config=config,
-            )
-            t_after_enhance = time.perf_counter()
-            log(f"[TIMING] [WS] enhance_prompt_async completed in {t_after_enhance - t_before_enhance:.3f}s")
-            
-            result = result or "Sorry, I couldn't generate a response."
-            messages = messages or []
-            
-            serializable_messages = []
-            for msg in messages:
-                if hasattr(msg, 'model_dump'):
-                    serializable_messages.append(msg.model_dump(mode="json"))
-                elif isinstance(msg, dict):
-                    serializable_messages.append(msg)
-                else:
-                    serializable_messages.append(str(msg))
-            cache.set(f"enhance_messages_{self.task_id}", serializable_messages, timeout=3600)
-            t_after_cache = time.perf_counter()
-            log(f"[TIMING] [WS] message serialization + cache in {t_after_cache - t_after_enhance:.3f}s")
-            
-            log(f"[WebSocket] Enhancement complete, result length: {len(result)}, messages stored: {len(messages)}")
-            
-            await self.send(text_data=json.dumps({
-                'type': 'task_complete',
-                'result': result,
-                'is_fallback': is_fallback
-            }))
-            t_total = time.perf_counter() - t_ws_start
-            log(f"[TIMING] [WS] total enhance request wall time: {t_total:.3f}s")
-            log("[WebSocket] Sent task_complete to client")
-            
         except Exception as e:
-            log(f"[WebSocket] Enhancement error: {e}")
+            log(f"[WebSocket] Error in receive: {e}")
             traceback.print_exc()
             await self.send(text_data=json.dumps({
                 'type': 'task_error',
                 'error': str(e)
             }))
 
-    async def ask_user_question(self, questions: str, timeout: int = 300) -> str:
-        """Ask user a question and wait for answer via WebSocket."""
-        self.answer_event.clear()
-        self.pending_answer = None
-        
-        log(f"[WebSocket] Asking user question: {questions}")
+    async def check_rate_limit(self, route):
+        """Take a token for the client's IP on `route`, telling the client if there is none."""
+        client_ip = self.scope.get('client', ['0.0.0.0'])[0]
+        if await get_rate_limiter().allow(route, client_ip):
+            return True
+        log(f"[WebSocket] Rate limit exceeded for IP: {client_ip} ({route})")
         await self.send(text_data=json.dumps({
-            'type': 'user_question',
-            'questions': questions
+            'type': 'task_error',
+            'error': 'Rate limit exceeded. Please wait a minute before trying again.'
         }))
-        
+        return False
+
+    async def start_job(self, data):
+        worker_channel = getattr(settings, 'ENHANCE_WORKER_CHANNEL', '')
+        client = client_key(self.scope)
+        if not worker_channel:
+            job = Job(self.kind, self.task_id, data, client, self.send_frame, self.answers)
+            self.job_task = asyncio.create_task(job.run())
+            return
+
+        # The job's channel is named here rather than by the worker, so answers and
+        # cancellation can be sent before a worker has taken the job; the layer holds
+        # them until the worker listens
+        self.job_id = str(uuid.uuid4())
+        self.job_channel = f'{worker_channel}.{self.job_id}'
+        self.worker_started = asyncio.Event()
+        await self.channel_layer.send(worker_channel, {
+            'type': 'job.start',
+            'job_id': self.job_id,
+            'job_channel': self.job_channel,
+            'kind': self.kind,
+            'task_id': self.task_id,
+            'data': data,
+            'client': client,
+            'reply_channel': self.channel_name,
+        })
+        self.start_watchdog = asyncio.create_task(self.expect_worker(self.job_id))
+
+    async def expect_worker(self, job_id: str):
+        """Fail the job if no worker takes it within ENHANCE_WORKER_START_TIMEOUT seconds."""
+        timeout = getattr(settings, 'ENHANCE_WORKER_START_TIMEOUT', 10)
         try:
-            await asyncio.wait_for(self.answer_event.wait(), timeout=timeout)
-            answer = self.pending_answer
-            self.pending_answer = None
-            log(f"[WebSocket] Got user answer: {answer}")
-            return answer or ""
+            await asyncio.wait_for(self.worker_started.wait(), timeout)
+            return
         except asyncio.TimeoutError:
-            raise TimeoutError(f"User did not respond within {timeout} seconds")
+            pass
+        if job_id != self.job_id:
+            return
+        log(f"[WebSocket] No worker took {self.kind} job {job_id} within {timeout}s")
+        # A worker picking the job up later finds the cancel first
+        await self.send_to_worker({'type': 'job.cancel'})
+        self.job_id = self.job_channel = None
+        await self.send_frame({
+            'type': 'task_error',
+            'error': 'The service is busy. Please try again later.',
+        })
+
+    async def send_to_worker(self, message: dict):
+        await self.channel_layer.send(self.job_channel, message)
+
+    async def send_frame(self, frame: dict):
+        await self.send(text_data=json.dumps(frame))
+
+    async def worker_attached(self, event):
+        """A worker took the job."""
+        if event['job_id'] == self.job_id:
+            self.worker_started.set()
 
+    async def worker_finished(self, event):
+        """The worker is done with the job; a later disconnect has nothing to cancel."""
+        if event['job_id'] == self.job_id:
+            self.job_id = self.job_channel = None
+
+    async def worker_frame(self, event):
+        """Relay a frame from the worker to the WebSocket as is."""
+        await self.send_frame(event['frame'])
+
+
+class EnhanceConsumer(JobConsumer):
+    kind = 'enhance'
+    start_type = 'enhance'
+    started_message = 'Enhancement started'
 
     async def task_complete(self, event):
         """Send task completion to WebSocket (for group messages)."""
@@ -226,191 +213,31 @@ class EnhanceConsumer(AsyncWebsocketConsumer):
         }))
 
 
-class EditConsumer(AsyncWebsocketConsumer):
+class EditConsumer(JobConsumer):
+    """Edits continue the conversation of an enhancement, which stays pinned in the
+    conversation store while the socket is open."""
+    kind = 'edit'
+    start_type = 'edit_request'
+    started_message = 'Edit process started'
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.messages: list[dict] = []
-        self.edit_task = None
-        self.pending_answer = None
-        self.answer_event = None
-    
-    async def connect(self):
-        self.task_id = self.scope['url_route']['kwargs']['task_id']
-        self.room_group_name = f'edit_{self.task_id}'
-        self.answer_event = asyncio.Event()
+        self.pinned_session = None
 
-
-        log(f"[WebSocket] EditConsumer connecting to group: {self.room_group_name}")
-
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
-
-        await self.accept()
-        log(f"[WebSocket] EditConsumer connected and joined group: {self.room_group_name}")
-    
     async def disconnect(self, close_code):
-        log(f"[WebSocket] EditConsumer disconnecting from group: {self.room_group_name}")
-        if self.edit_task and not self.edit_task.done():
-            self.edit_task.cancel()
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
-    async def receive(self, text_data):
-        
-        # Rate limit check
-        client_ip = self.scope.get('client', ['0.0.0.0'])[0]
-        is_allowed = await sync_to_async(_check_rate_limit_sync)(client_ip)
-        
-        if not is_allowed:
-            log(f"[WebSocket] Rate limit exceeded for IP: {client_ip}")
-            await self.send(text_data=json.dumps({
-                'type': 'task_error',
-                'error': 'Rate limit exceeded. Please wait a minute before trying again.'
-            }))
-            return
-        
-        log(f"[WebSocket] EditConsumer received message: {text_data[:200]}")
-        try:
-            text_data_json = json.loads(text_data)
-            message_type = text_data_json.get('type')
-            log(f"[WebSocket] EditConsumer message type: {message_type}")
-
-            if message_type == 'edit_request':
-                log("[WebSocket] Starting edit process...")
-                # Send acknowledgment first
-                await self.send(text_data=json.dumps({
-                    'type': 'processing',
-                    'message': 'Edit process started'
-                }))
-                
-                enhancement_task_id = text_data_json.get("enhancement_task_id", None)
-                
-                if enhancement_task_id:
-                    cached_messages = cache.get(f"enhance_messages_{enhancement_task_id}")
-                    if cached_messages:
-                        self.messages = cached_messages
-                        log(f"[WebSocket] Loaded messages from cache for enhancement_task_id: {enhancement_task_id}, messages count: {len(self.messages)}")
-                    else:
-                        log(f"[WebSocket] No cached messages found for enhancement_task_id: {enhancement_task_id}")
-                
-                # Run edit process and handle result in callback
-                self.edit_task = asyncio.create_task(
-                    self._run_edit_with_callback(text_data_json)
-                )
-            else:
-                log(f"[WebSocket] Unknown message type received: {message_type}")
-                await self.send(text_data=json.dumps({
-                    'type': 'task_error',
-                    'error': f'Unknown message type: {message_type}'
-                }))
-        except Exception as e:
-            log(f"[WebSocket] EditConsumer error in receive: {e}")
-            traceback.print_exc()
-            await self.send(text_data=json.dumps({
-                'type': 'task_error',
-                'error': str(e)
-            }))
-    
-    async def _run_edit_with_callback(self, data):
-        """Wrapper that ensures errors are properly sent to client."""
-        try:
-            await self.run_edit(data)
-        except asyncio.CancelledError:
-            log("[WebSocket] Edit task was cancelled")
-        except Exception as e:
-            log(f"[WebSocket] Unhandled error in edit: {e}")
-            traceback.print_exc()
-            try:
-                await self.send(text_data=json.dumps({
-                    'type': 'task_error',
-                    'error': str(e)
-                }))
-            except Exception:
-                pass
-
-    async def run_edit(self, data):
-        """Run the edit process directly in the WebSocket consumer."""
-        try:
-            t_ws_start = time.perf_counter()
-            if data.get("edit_instructions", "") == "" :
-                raise ValueError("Edit instructions cannot be empty.")
-            
-            # Import here to avoid circular imports at module load time
-            from .edit import edit_prompt_async
-            
-            log(f"[WebSocket] Calling edit_prompt_async with instructions: {data.get('edit_instructions', '')[:50]}")
-            log(f"[TIMING] [WS] edit request received")
-            
-            enhancement_task_id = data.get("enhancement_task_id", None)
-            enhancement_messages = self._get_enhancement_messages(enhancement_task_id)
-            t_after_cache_load = time.perf_counter()
-            log(f"[TIMING] [WS] enhancement messages loaded in {t_after_cache_load - t_ws_start:.3f}s")
-            
-            config = PromptConfig(
-                model=os.getenv("MODEL", "gemini-3-flash-preview"),
-                use_web_search=data.get('use_web_search', True),
-                additional_context_query=data.get('additional_context_query', ''),
-                ask_user_func=self.ask_user_question,
-                target_model=data.get('target_model', 'gpt-5.1'),
-                is_reasoning_native=data.get('is_reasoning_native', False),
-                prompt_style=data.get('prompt_style', {}),
-            )
-            t_before_edit = time.perf_counter()
-            result = await edit_prompt_async(
-                edit_instructions=data.get('edit_instructions', ''),
-                current_prompt=data.get('current_prompt', ''),
-                config=config,
-                enhancement_messages=enhancement_messages
-            )
-            t_after_edit = time.perf_counter()
-            log(f"[TIMING] [WS] edit_prompt_async completed in {t_after_edit - t_before_edit:.3f}s")
-        
-            await self.send(text_data=json.dumps({
-                'type': 'task_complete',
-                'result': result
-            }))
-            t_total = time.perf_counter() - t_ws_start
-            log(f"[TIMING] [WS] total edit request wall time: {t_total:.3f}s")
-            log("[WebSocket] Sent task_complete to client")
-        except Exception as e:
-            log(f"[WebSocket] Edit error: {e}")
-            traceback.print_exc()
-            await self.send(text_data=json.dumps({
-                'type': 'task_error',
-                'error': str(e)
-            }))
+        await super().disconnect(close_code)
+        self.pin_session(None)
 
+    async def start_job(self, data):
+        self.pin_session(data.get('enhancement_task_id'))
+        await super().start_job(data)
 
-    async def ask_user_question(self, questions: str, timeout: int = 300) -> str:
-        """Ask user a question and wait for answer via WebSocket."""
-        self.answer_event.clear()
-        self.pending_answer = None
-        
-        log(f"[WebSocket] Asking user question: {questions}")
-        await self.send(text_data=json.dumps({
-            'type': 'user_question',
-            'questions': questions
-        }))
-        
-        try:
-            await asyncio.wait_for(self.answer_event.wait(), timeout=timeout)
-            answer = self.pending_answer
-            self.pending_answer = None
-            log(f"[WebSocket] Got user answer: {answer}")
-            return answer or ""
-        except asyncio.TimeoutError:
-            raise TimeoutError(f"User did not respond within {timeout} seconds")
-    
-    def _get_enhancement_messages(self, enhancement_task_id):
-        """Helper to get enhancement messages from cache."""
-        if enhancement_task_id:
-            cached_messages = cache.get(f"enhance_messages_{enhancement_task_id}")
-            if cached_messages:
-                log(f"[WebSocket] Loaded messages from cache for enhancement_task_id: {enhancement_task_id}, messages count: {len(cached_messages)}")
-                return cached_messages
-            else:
-                log(f"[WebSocket] No cached messages found for enhancement_task_id: {enhancement_task_id}")
-        return []
\ No newline at end of file
+    def pin_session(self, session_id):
+        if session_id == self.pinned_session:
+            return
+        store = get_conversation_store()
+        if self.pinned_session:
+            store.unpin(self.pinned_session)
+        if session_id:
+            store.pin(session_id)
+        self.pinned_session = session_id
@@ -0,0 +1,393 @@
+import abc
+import sqlite3
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from pathlib import Path
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from . import log
+from .history_codec import blob_refs, encode_chunk, expand_messages, unpack_chunk
+
+
+class ConversationStore(abc.ABC):
+    """Enhancement conversations shared by every process, so an edit finds the
+    history wherever it runs.
+
+    A conversation is a list of chunks, each holding the messages of one `save` or
+    `append`. Appends are atomic and every write restarts the `ttl`. The layout maps
+    onto a Redis list (RPUSH + EXPIRE in one transaction) as well as onto rows in
+    SQLite.
+
+    Chunks are stored in the compact form of `api.history_codec`. System prompts
+    are kept apart as blobs keyed by content hash, one copy for all sessions, and
+    remembered in-process once read.
+
+    Sessions an open edit is working on are pinned (`pin` / `unpin`), so stores that
+    evict under memory pressure keep them.
+    """
+
+    # System prompts kept in memory; there are only a handful of distinct ones
+    BLOB_MEMO_SIZE = 64
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.loads = 0
+        self.misses = 0
+        self.writes = 0
+        self.bytes_written = 0
+        self._blob_memo: dict[str, str] = {}
+        self._pins: Counter[str] = Counter()
+
+    async def load(self, session_id: str) -> list[dict] | None:
+        """The conversation, or None if there is none or it expired."""
+        self.loads += 1
+        chunks = await self._load_chunks(session_id)
+        if not chunks:
+            self.misses += 1
+            return None
+        compact = [message for chunk in chunks for message in unpack_chunk(chunk)]
+        return expand_messages(compact, await self._blobs(blob_refs(compact)))
+
+    async def save(self, session_id: str, messages: list[dict]):
+        """Replace the conversation."""
+        await self._encode_and_write(session_id, messages, replace=True)
+
+    async def append(self, session_id: str, messages: list[dict]):
+        """Add messages to the end of the conversation, starting it if needed."""
+        if not messages:
+            return
+        await self._encode_and_write(session_id, messages, replace=False)
+
+    @abc.abstractmethod
+    async def delete(self, session_id: str):
+        ...
+
+    def pin(self, session_id: str):
+        """Keep the session from being evicted until every `pin` is matched by an `unpin`."""
+        self._pins[session_id] += 1
+
+    def unpin(self, session_id: str):
+        self._pins[session_id] -= 1
+        if self._pins[session_id] <= 0:
+            del self._pins[session_id]
+
+    def is_pinned(self, session_id: str) -> bool:
+        return session_id in self._pins
+
+    async def _encode_and_write(self, session_id: str, messages: list[dict], replace: bool):
+        payload, blobs = encode_chunk(messages)
+        self.writes += 1
+        self.bytes_written += len(payload)
+        # Blobs are written every time, which also keeps them alive as long as the sessions using them
+        await self._write(session_id, payload, {digest: zlib.compress(text.encode()) for digest, text in blobs.items()}, replace)
+        self._remember_blobs(blobs)
+
+    async def _blobs(self, digests: set[str]) -> dict[str, str]:
+        found = {digest: self._blob_memo[digest] for digest in digests if digest in self._blob_memo}
+        missing = digests - found.keys()
+        if missing:
+            loaded = {digest: zlib.decompress(blob).decode() for digest, blob in (await self._load_blobs(missing)).items()}
+            if loaded.keys() != missing:
+                raise LookupError(f"Conversation refers to missing blobs: {sorted(missing - loaded.keys())}")
+            self._remember_blobs(loaded)
+            found.update(loaded)
+        return found
+
+    def _remember_blobs(self, blobs: dict[str, str]):
+        if len(self._blob_memo) + len(blobs) > self.BLOB_MEMO_SIZE:
+            self._blob_memo.clear()
+        self._blob_memo.update(blobs)
+
+    @abc.abstractmethod
+    async def _load_chunks(self, session_id: str) -> list[bytes]:
+        ...
+
+    @abc.abstractmethod
+    async def _load_blobs(self, digests: set[str]) -> dict[str, bytes]:
+        ...
+
+    @abc.abstractmethod
+    async def _write(self, session_id: str, payload: bytes, blobs: dict[str, bytes], replace: bool):
+        ...
+
+    def stats(self) -> dict:
+        # Only edits load conversations, so misses are edits that found no history
+        return {
+            "backend": type(self).__name__,
+            "loads": self.loads,
+            "misses": self.misses,
+            "miss_rate": self.misses / self.loads if self.loads else 0.0,
+            "writes": self.writes,
+            "bytes_written": self.bytes_written,
+            "bytes_per_write": self.bytes_written / self.writes if self.writes else 0.0,
+            "pinned": len(self._pins),
+        }
+
+
+class MemoryConversationStore(ConversationStore):
+    """Conversations in this process's memory, within a budget of `max_bytes`.
+
+    For single-process deployments. Sizes are those of the encoded chunks, so the
+    budget is what the conversations really take. When it is exceeded the least
+    recently used sessions are evicted, whatever their count, skipping pinned ones;
+    a session that is pinned may keep the store above budget until it is unpinned.
+    """
+
+    def __init__(self, ttl: float, max_bytes: int = 64 * 1024 * 1024):
+        super().__init__(ttl)
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.evictions = 0
+        # session_id -> (expires_at, chunks, size), least recently used first
+        self._sessions: OrderedDict[str, tuple[float, list[bytes], int]] = OrderedDict()
+        self._stored_blobs: dict[str, bytes] = {}
+
+    async def delete(self, session_id: str):
+        self._remove(session_id)
+
+    def unpin(self, session_id: str):
+        super().unpin(session_id)
+        self._evict()
+
+    async def _load_chunks(self, session_id: str) -> list[bytes]:
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            return []
+        if entry[0] <= time.monotonic():
+            self._remove(session_id)
+            return []
+        self._sessions.move_to_end(session_id)
+        return list(entry[1])
+
+    async def _load_blobs(self, digests: set[str]) -> dict[str, bytes]:
+        return {digest: self._stored_blobs[digest] for digest in digests if digest in self._stored_blobs}
+
+    async def _write(self, session_id: str, payload: bytes, blobs: dict[str, bytes], replace: bool):
+        # Only a handful of distinct system prompts, kept for good
+        self._stored_blobs.update(blobs)
+        entry = self._sessions.get(session_id)
+        chunks = [] if replace or entry is None or entry[0] <= time.monotonic() else entry[1]
+        self._remove(session_id)
+        chunks = [*chunks, payload]
+        size = sum(map(len, chunks))
+        self._sessions[session_id] = (time.monotonic() + self.ttl, chunks, size)
+        self.bytes += size
+        self._evict()
+
+    def _remove(self, session_id: str):
+        entry = self._sessions.pop(session_id, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def _evict(self):
+        if self.bytes <= self.max_bytes:
+            return
+        now = time.monotonic()
+        for session_id, (expires_at, _, _) in list(self._sessions.items()):
+            if self.bytes <= self.max_bytes:
+                break
+            if expires_at <= now:
+                self._remove(session_id)
+            elif not self.is_pinned(session_id):
+                self._remove(session_id)
+                self.evictions += 1
+                log(f"[Conversations] Evicted {session_id} to stay within {self.max_bytes} bytes")
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            "sessions": len(self._sessions),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+        }
+
+
+class SQLiteConversationStore(ConversationStore):
+    """Conversations in a SQLite file, shared by the processes of one host.
+
+    Every write runs in a `BEGIN IMMEDIATE` transaction, so concurrent appends from
+    several processes never interleave or lose chunks. Expired conversations read as
+    missing and are purged every `purge_every` writes.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS conversation_sessions ("
+        " session_id TEXT PRIMARY KEY, expires_at REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS conversation_chunks ("
+        " session_id TEXT NOT NULL, seq INTEGER NOT NULL, payload BLOB NOT NULL,"
+        " PRIMARY KEY (session_id, seq))",
+        "CREATE INDEX IF NOT EXISTS conversation_sessions_expiry ON conversation_sessions (expires_at)",
+        "CREATE TABLE IF NOT EXISTS conversation_blobs ("
+        " digest TEXT PRIMARY KEY, payload BLOB NOT NULL, expires_at REAL NOT NULL)",
+    )
+
+    def __init__(self, path, ttl: float, purge_every: int = 500):
+        super().__init__(ttl)
+        self.path = Path(path)
+        self.purge_every = purge_every
+        self._local = threading.local()
+        self._connection()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Autocommit mode; transactions are opened explicitly
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+            self._local.connection = connection
+        return connection
+
+    async def delete(self, session_id: str):
+        await sync_to_async(self._delete_sync, thread_sensitive=False)(session_id)
+
+    def _delete_sync(self, session_id: str):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute("DELETE FROM conversation_chunks WHERE session_id = ?", (session_id,))
+            connection.execute("DELETE FROM conversation_sessions WHERE session_id = ?", (session_id,))
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    async def _load_chunks(self, session_id: str) -> list[bytes]:
+        return await sync_to_async(self._load_chunks_sync, thread_sensitive=False)(session_id)
+
+    def _load_chunks_sync(self, session_id: str) -> list[bytes]:
+        connection = self._connection()
+        # One statement, so the chunks are read from a single snapshot
+        rows = connection.execute(
+            "SELECT c.payload FROM conversation_chunks c"
+            " JOIN conversation_sessions s ON s.session_id = c.session_id"
+            " WHERE c.session_id = ? AND s.expires_at > ? ORDER BY c.seq",
+            (session_id, time.time()),
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    async def _load_blobs(self, digests: set[str]) -> dict[str, bytes]:
+        return await sync_to_async(self._load_blobs_sync, thread_sensitive=False)(digests)
+
+    def _load_blobs_sync(self, digests: set[str]) -> dict[str, bytes]:
+        digests = sorted(digests)
+        rows = self._connection().execute(
+            f"SELECT digest, payload FROM conversation_blobs WHERE digest IN ({', '.join('?' * len(digests))})",
+            digests,
+        ).fetchall()
+        return dict(rows)
+
+    async def _write(self, session_id: str, payload: bytes, blobs: dict[str, bytes], replace: bool):
+        await sync_to_async(self._write_sync, thread_sensitive=False)(session_id, payload, blobs, replace)
+
+    def _write_sync(self, session_id: str, payload: bytes, blobs: dict[str, bytes], replace: bool):
+        connection = self._connection()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT expires_at FROM conversation_sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            if replace or row is None or row[0] <= now:
+                connection.execute("DELETE FROM conversation_chunks WHERE session_id = ?", (session_id,))
+                seq = 0
+            else:
+                seq = connection.execute(
+                    "SELECT COALESCE(MAX(seq) + 1, 0) FROM conversation_chunks WHERE session_id = ?", (session_id,)
+                ).fetchone()[0]
+            connection.execute(
+                "INSERT INTO conversation_chunks (session_id, seq, payload) VALUES (?, ?, ?)",
+                (session_id, seq, payload),
+            )
+            connection.execute(
+                "INSERT INTO conversation_sessions (session_id, expires_at) VALUES (?, ?)"
+                " ON CONFLICT (session_id) DO UPDATE SET expires_at = excluded.expires_at",
+                (session_id, now + self.ttl),
+            )
+            connection.executemany(
+                "INSERT INTO conversation_blobs (digest, payload, expires_at) VALUES (?, ?, ?)"
+                " ON CONFLICT (digest) DO UPDATE SET expires_at = excluded.expires_at",
+                [(digest, blob, now + self.ttl) for digest, blob in blobs.items()],
+            )
+            if self.writes % self.purge_every == 0:
+                self._purge_expired(connection, now)
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    @staticmethod
+    def _purge_expired(connection: sqlite3.Connection, now: float):
+        connection.execute(
+            "DELETE FROM conversation_chunks WHERE session_id IN"
+            " (SELECT session_id FROM conversation_sessions WHERE expires_at <= ?)",
+            (now,),
+        )
+        connection.execute("DELETE FROM conversation_sessions WHERE expires_at <= ?", (now,))
+        connection.execute("DELETE FROM conversation_blobs WHERE expires_at <= ?", (now,))
+
+
+class RedisConversationStore(ConversationStore):
+    """Conversations in Redis, shared by every node. Needs the `redis` package.
+
+    Each conversation is a list of chunks under `prefix + session_id`, and each
+    system prompt a string under `prefix + "blob:" + digest`; writes are MULTI/EXEC
+    transactions that also reset the expiry of both.
+    """
+
+    def __init__(self, url: str, ttl: float, prefix: str = "conversation:"):
+        super().__init__(ttl)
+        try:
+            from redis import asyncio as redis
+        except ImportError as e:
+            raise ImproperlyConfigured("RedisConversationStore needs the redis package") from e
+        self.client = redis.from_url(url)
+        self.prefix = prefix
+
+    async def delete(self, session_id: str):
+        await self.client.delete(self.prefix + session_id)
+
+    async def _load_chunks(self, session_id: str) -> list[bytes]:
+        return await self.client.lrange(self.prefix + session_id, 0, -1)
+
+    async def _load_blobs(self, digests: set[str]) -> dict[str, bytes]:
+        digests = sorted(digests)
+        values = await self.client.mget([self.prefix + "blob:" + digest for digest in digests])
+        return {digest: value for digest, value in zip(digests, values) if value is not None}
+
+    async def _write(self, session_id: str, payload: bytes, blobs: dict[str, bytes], replace: bool):
+        key = self.prefix + session_id
+        async with self.client.pipeline(transaction=True) as pipe:
+            if replace:
+                pipe.delete(key)
+            pipe.rpush(key, payload)
+            pipe.expire(key, int(self.ttl))
+            for digest, blob in blobs.items():
+                pipe.set(self.prefix + "blob:" + digest, blob, ex=int(self.ttl))
+            await pipe.execute()
+
+
+_store: ConversationStore | None = None
+
+
+def get_conversation_store() -> ConversationStore:
+    """The store configured by the CONVERSATION_STORE setting, created on first use."""
+    global _store
+    if _store is None:
+        config = getattr(settings, "CONVERSATION_STORE", {})
+        backend = import_string(config.get("BACKEND", "api.conversations.SQLiteConversationStore"))
+        options = {"ttl": getattr(settings, "CONVERSATION_TTL_SECONDS", 3600), **config.get("OPTIONS", {})}
+        if backend is SQLiteConversationStore:
+            options.setdefault("path", Path(settings.BASE_DIR) / "conversations.sqlite3")
+        _store = backend(**options)
+        log(f"[Conversations] Using {backend.__name__}")
+    return _store
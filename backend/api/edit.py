@@ -1,23 +1,11 @@
-import os
-import time
-import json_repair as json
 from dotenv import load_dotenv
 
-from .prompt import _build_edit_user_prompt, _build_system_prompt
-from . import log
-import openai
+from .prompt import _build_edit_user_prompt, get_system_prompt
+from .agent_loop import AgentLoop
 
 from .shared_utils import (
     PromptConfig,
-    get_async_client,
-    web_search_async,
-    check_hcai_status,
-    format_answers_for_llm,
     get_tools,
-    FALLBACK_MODEL,
-    EnhancedPromptResponse,
-    parse_llm_response_XML,
-    parse_llm_response_markdown
 )
 
 load_dotenv()
@@ -28,42 +16,13 @@ async def edit_prompt_async(
     config: PromptConfig,
     enhancement_messages: list[dict],
     falling_back: bool = False,
-) -> str | None:
-    
-    t_start = time.perf_counter()
-    timings: list[tuple[str, float]] = []
-
-    def _mark(label: str):
-        timings.append((label, time.perf_counter() - t_start))
-        log(f"[TIMING] {label}: {timings[-1][1]:.3f}s elapsed")
-
-    _mark("edit_start")
-
-    # Check HCAI status before proceeding
-    if not check_hcai_status() and not falling_back:
-        log("HCAI service is down, falling back to alternative model...")
-        if os.getenv("FALLBACK_API_KEY") and os.getenv("FALLBACK_API_KEY") != "":
-            fallback_config = PromptConfig(
-                model=FALLBACK_MODEL,
-                use_web_search=config.use_web_search,
-                additional_context_query=config.additional_context_query,
-                target_model=config.target_model,
-                ask_user_func=config.ask_user_func,
-                prompt_style=config.prompt_style,
-                is_reasoning_native=config.is_reasoning_native,
-            )
-            result = await edit_prompt_async(
-                edit_instructions, current_prompt, fallback_config, enhancement_messages, falling_back=True
-            )
-            return result
-        else:
-            raise Exception("We are out of money! Please try again later.")
+) -> tuple[str | None, list]:
+    """Edit a prompt, continuing the enhancement conversation when there is one.
 
-    _mark("hcai_check_done")
-    
-    client = get_async_client(fallback=falling_back)
-    
-    tools = get_tools(config.use_web_search)
+    Returns the edited prompt and the whole conversation, enhancement included.
+    """
+    loop = AgentLoop("edit", config)
+    loop.open_session(falling_back)
     
     # Best case scenario - we have the messages from the enhancement phase and can just continue the conversation
     if enhancement_messages:
@@ -75,7 +34,7 @@ async def edit_prompt_async(
 
     # If we don't have enhancement messages, we need to reconstruct the conversation from scratch
     else:
-        system_prompt = _build_system_prompt(use_web_search=config.use_web_search, is_reasoning_native=config.is_reasoning_native, additional_context=None)
+        system_prompt = get_system_prompt(use_web_search=config.use_web_search, is_reasoning_native=config.is_reasoning_native, has_additional_context=False)
         user_prompt = _build_edit_user_prompt(
             edit_instructions=edit_instructions,
             current_prompt=current_prompt
@@ -85,142 +44,7 @@ async def edit_prompt_async(
             {"role": "user", "content": user_prompt}
         ]
 
-    _mark("messages_built")
-        
-    try:
-        _mark("llm_call_1_start")
-        # Use .create() during tool loop to avoid parsing errors when model returns tool calls
-        response = await client.chat.completions.create(
-            model=config.model,
-            messages=messages,
-            tools=tools,
-            reasoning_effort="low",
-        )
-        _mark("llm_call_1_done")
-        log(f"[DEBUG] Initial LLM Response (Async): {response.choices[0].message}")
-        
-        count = 1
-        while response.choices[0].message.tool_calls:
-            messages.append(response.choices[0].message)
-            for tool_call in response.choices[0].message.tool_calls:
-                log(f"[DEBUG] Processing Tool Call (Async): {tool_call.function.name} with args: {tool_call.function.arguments}")
-                if tool_call.function.name == "web_search":
-                    _mark(f"tool_web_search_{count}_start")
-                    args = json.loads(tool_call.function.arguments)
-                    search_result = await web_search_async(args["query"])
-                    _mark(f"tool_web_search_{count}_done")
-                    log(f"[DEBUG] Tool Result ({tool_call.function.name}): {search_result[:100]}...")
-                    messages.append({
-                        "role": "tool",
-                        "tool_call_id": tool_call.id,
-                        "content": search_result
-                    })
-                elif tool_call.function.name == "get_user_input":
-                    _mark(f"tool_get_user_input_{count}_start")
-                    args = json.loads(tool_call.function.arguments)
-                    log("Asking user question via WebSocket...")
-                    if config.ask_user_func:
-                        user_input = await config.ask_user_func(args["questions"])
-                    else:
-                        user_input = "(No user input handler available)"
-                    
-                    user_input = format_answers_for_llm(args["questions"], user_input)
-                    _mark(f"tool_get_user_input_{count}_done")
-                    
-                    log(f"[DEBUG] Tool Result ({tool_call.function.name}): {user_input}")
-
-                    messages.append({
-                        "role": "tool",
-                        "tool_call_id": tool_call.id,
-                        "content": user_input
-                    })
-
-            _mark(f"llm_call_{count + 1}_start")
-            # Continue using .create() during tool loop
-            response = await client.chat.completions.create(
-                model=config.model,
-                messages=messages,
-                tools=tools,
-                reasoning_effort="medium",
-            )
-            _mark(f"llm_call_{count + 1}_done")
-            log(f"[DEBUG] Next LLM Response (Async): {response.choices[0].message}")
-            count += 1
-
-        _mark("parsing_response_start")
-        content = response.choices[0].message.content or ""
-        result = None
-        
-        # First, try to parse the response from the tool loop
-        if content:
-            try:
-                parsed = json.loads(content)
-                if "improved_prompt" in parsed:
-                    result = parsed["improved_prompt"]
-                    log(f"[DEBUG] Successfully parsed response from tool loop")
-            except Exception as e:
-                log(f"[DEBUG] Could not parse tool loop response as JSON: {e}")
-                # Try XML/markdown parsing
-                result = parse_llm_response_XML(content)
-                if not result:
-                    result = parse_llm_response_markdown(content)
-        
-        # If parsing failed, make a final call with response_format (no tools)
-        if not result:
-            log(f"[DEBUG] Making final parse call with response_format")
-            _mark("final_parse_call_start")
-            messages.append(response.choices[0].message)
-            final_response = await client.chat.completions.parse(
-                model=config.model,
-                messages=messages,
-                reasoning_effort="low",
-                response_format=EnhancedPromptResponse,
-            )
-            _mark("final_parse_call_done")
-            
-            if hasattr(final_response.choices[0].message, "parsed") and final_response.choices[0].message.parsed:
-                result = final_response.choices[0].message.parsed.improved_prompt
-            else:
-                # Last resort: manual parsing of final response
-                content = final_response.choices[0].message.content or ""
-                try:
-                    parsed = json.loads(content)
-                    result = parsed.get("improved_prompt")
-                except:
-                    result = parse_llm_response_XML(content) or parse_llm_response_markdown(content)
-            
-            messages.append({"role": "assistant", "content": final_response.choices[0].message.content})
-        else:
-            messages.append({"role": "assistant", "content": content})
-
-        _mark("edit_complete")
-        log(f"[TIMING] === Edit Timing Summary ===")
-        prev = 0.0
-        for label, elapsed in timings:
-            delta = elapsed - prev
-            log(f"[TIMING]   {label}: {elapsed:.3f}s total, +{delta:.3f}s step")
-            prev = elapsed
-        log(f"[TIMING] === Total: {timings[-1][1]:.3f}s ===")
-
-        return result
-
-    except openai.APIStatusError as e:
-        log(f"APIStatusError: {e}")
-        log("Falling back to alternative model...")
-        if os.getenv("FALLBACK_API_KEY") and os.getenv("FALLBACK_API_KEY") != "" and not falling_back:
-            fallback_config = PromptConfig(
-                model=FALLBACK_MODEL,
-                use_web_search=config.use_web_search,
-                additional_context_query=config.additional_context_query,
-                target_model=config.target_model,
-                ask_user_func=config.ask_user_func,
-                prompt_style=config.prompt_style,
-                is_reasoning_native=config.is_reasoning_native,
-            )
-            result = await edit_prompt_async(
-                edit_instructions, current_prompt, fallback_config, messages, falling_back=True
-            )
-            return result
-        else:
-            raise Exception("We are out of money! Please try again later.") from e
-
+    outcome = await loop.run(
+        messages, get_tools(config.use_web_search), reasoning_effort="low", followup_reasoning_effort="medium"
+    )
+    return outcome.result, outcome.messages
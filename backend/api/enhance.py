@@ -1,23 +1,17 @@
-import os
-import time
-import json_repair as json
+import asyncio
+
+import httpx
 
-import openai
 from dotenv import load_dotenv
 
 from .prompt import build_enhancement_prompts
 from . import log
+from .agent_loop import AgentLoop
 
 from .shared_utils import (
-    FALLBACK_MODEL,
-    EnhancedPromptResponse,
     PromptConfig,
-    get_async_client,
-    parse_llm_response_XML,
-    parse_llm_response_markdown,
+    preconnect_async_client,
     web_search_async,
-    check_hcai_status,
-    format_answers_for_llm,
     get_tools
 )
 
@@ -32,202 +26,53 @@ async def enhance_prompt_async(
     falling_back: bool = False,
 ) -> tuple[str, bool, list[dict]]:
     """Async version of enhance_prompt that runs in the WebSocket consumer."""
-    t_start = time.perf_counter()
-    timings: list[tuple[str, float]] = []
+    loop = AgentLoop("enhance", config)
+
+    # The context search does not depend on the provider, so start it right away and
+    # only wait for it once the prompts need it
+    context_search = None
+    if config.additional_context_query:
+        context_search = asyncio.ensure_future(loop.timings.measure(
+            "additional_context_search",
+            asyncio.wait_for(web_search_async(config.additional_context_query, 3), loop.limits.tool_seconds),
+        ))
 
-    def _mark(label: str):
-        timings.append((label, time.perf_counter() - t_start))
-        log(f"[TIMING] {label}: {timings[-1][1]:.3f}s elapsed")
+    try:
+        session = loop.open_session(falling_back)
+    except Exception:
+        if context_search:
+            context_search.cancel()
+        raise
 
-    _mark("enhance_start")
+    additional_context = ""
+    if context_search:
+        # Open the provider connection while the search is still running
+        search_result, _ = await asyncio.gather(
+            context_search, preconnect_async_client(fallback=session.is_fallback), return_exceptions=True
+        )
+        if isinstance(search_result, (httpx.HTTPError, asyncio.TimeoutError)):
+            log(f"Additional context search failed, continuing without it: {search_result!r}")
+        elif isinstance(search_result, BaseException):
+            raise search_result
+        else:
+            additional_context = search_result
 
-    if not check_hcai_status() and not falling_back:
-        log("HCAI service is down, falling back to alternative model...")
-        if os.getenv("FALLBACK_API_KEY") and os.getenv("FALLBACK_API_KEY") != "":
-            fallback_config = PromptConfig(
-                model=FALLBACK_MODEL,
+    with loop.timings.step("build_prompts"):
+        system_prompt, user_prompt = build_enhancement_prompts(
+                task=task,
+                lazy_prompt=lazy_prompt,
                 use_web_search=config.use_web_search,
-                additional_context_query=config.additional_context_query,
+                additional_context=additional_context,
                 target_model=config.target_model,
-                ask_user_func=config.ask_user_func,
                 prompt_style=config.prompt_style,
                 is_reasoning_native=config.is_reasoning_native,
-            )
-            result, _, msgs = await enhance_prompt_async(
-                task, lazy_prompt,config=fallback_config, reasoning_effort=reasoning_effort, falling_back=True
-            )
-            return result, True, msgs
-        else:
-            raise Exception("We are out of money! Please try again later.")
-
-    _mark("hcai_check_done")
-    
-    client = get_async_client(fallback=falling_back)
-
-    additional_context = ""
-    if config.additional_context_query:
-        _mark("additional_context_search_start")
-        additional_context = await web_search_async(config.additional_context_query, 3)
-        _mark("additional_context_search_done")
-    
-    system_prompt, user_prompt = build_enhancement_prompts(
-            task=task,
-            lazy_prompt=lazy_prompt,
-            use_web_search=config.use_web_search,
-            additional_context=additional_context,
-            target_model=config.target_model,
-            prompt_style=config.prompt_style,
-            is_reasoning_native=config.is_reasoning_native
-        ).values()
-
-    _mark("prompts_built")
+                seed_prompt=config.seed_prompt,
+            ).values()
 
     messages = [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": user_prompt},
     ]
-    
-    tools = get_tools(config.use_web_search)
-    
-    try:
-        _mark("llm_call_1_start")
-        # Use .create() during tool loop to avoid parsing errors when model returns tool calls
-        response = await client.chat.completions.create(
-            model=config.model,
-            messages=messages,
-            tools=tools,
-            reasoning_effort=reasoning_effort,
-        )
-        _mark("llm_call_1_done")
-        log(f"[DEBUG] Initial LLM Response (Async): {response.choices[0].message}")
-        
-        count = 1
-        while (response.choices[0].message.tool_calls
-               or (response.choices[0].message.content.strip() == "" and
-                    not response.choices[0].message.tool_calls)) and count <= 6:
-            messages.append(response.choices[0].message)
-            if not response.choices[0].message.tool_calls:
-                log(f"[DEBUG] LLM response has no tool calls but content is empty.")
-                break
-            for tool_call in response.choices[0].message.tool_calls:
-                log(f"[DEBUG] Processing Tool Call (Async): {tool_call.function.name} with args: {tool_call.function.arguments}")
-                if tool_call.function.name == "web_search":
-                    _mark(f"tool_web_search_{count}_start")
-                    args = json.loads(tool_call.function.arguments)
-                    search_result = await web_search_async(args["query"])
-                    _mark(f"tool_web_search_{count}_done")
-                    log(f"[DEBUG] Tool Result ({tool_call.function.name}): {search_result[:100]}...")
-                    messages.append({
-                        "role": "tool",
-                        "tool_call_id": tool_call.id,
-                        "content": search_result
-                    })
-                elif tool_call.function.name == "get_user_input":
-                    _mark(f"tool_get_user_input_{count}_start")
-                    args = json.loads(tool_call.function.arguments)
-                    log("Asking user question via WebSocket...")
-                    if config.ask_user_func:
-                        user_input = await config.ask_user_func(args["questions"])
-                    else:
-                        user_input = "(No user input handler available)"
-                    
-                    user_input = format_answers_for_llm(args["questions"], user_input)
-                    _mark(f"tool_get_user_input_{count}_done")
-                    
-                    log(f"[DEBUG] Tool Result ({tool_call.function.name}): {user_input}")
-
-                    messages.append({
-                        "role": "tool",
-                        "tool_call_id": tool_call.id,
-                        "content": user_input
-                    })
-
-            _mark(f"llm_call_{count + 1}_start")
-            # Continue using .create() during tool loop
-            response = await client.chat.completions.create(
-                model=config.model,
-                messages=messages,
-                tools=tools,
-                reasoning_effort=reasoning_effort,
-            )
-            _mark(f"llm_call_{count + 1}_done")
-            log(f"[DEBUG] Next LLM Response (Async): {response.choices[0].message}")
-            count += 1
-
-        _mark("parsing_response_start")
-        content = response.choices[0].message.content or ""
-        result = None
-        
-        # First, try to parse the response from the tool loop
-        if content:
-            try:
-                parsed = json.loads(content)
-                if "improved_prompt" in parsed:
-                    result = parsed["improved_prompt"]
-                    log(f"[DEBUG] Successfully parsed response from tool loop")
-            except Exception as e:
-                log(f"[DEBUG] Could not parse tool loop response as JSON: {e}")
-                # Try XML/markdown parsing
-                result = parse_llm_response_XML(content)
-                if not result:
-                    result = parse_llm_response_markdown(content)
-        
-        # If parsing failed, make a final call with response_format (no tools)
-        if not result:
-            log(f"[DEBUG] Making final parse call with response_format")
-            _mark("final_parse_call_start")
-            messages.append(response.choices[0].message)
-            final_response = await client.chat.completions.parse(
-                model=config.model,
-                messages=messages,
-                reasoning_effort=reasoning_effort,
-                response_format=EnhancedPromptResponse,
-            )
-            _mark("final_parse_call_done")
-            
-            if hasattr(final_response.choices[0].message, "parsed") and final_response.choices[0].message.parsed:
-                result = final_response.choices[0].message.parsed.improved_prompt
-            else:
-                # Last resort: manual parsing of final response
-                content = final_response.choices[0].message.content or ""
-                try:
-                    parsed = json.loads(content)
-                    result = parsed.get("improved_prompt")
-                except:
-                    result = parse_llm_response_XML(content) or parse_llm_response_markdown(content)
-            
-            messages.append({"role": "assistant", "content": final_response.choices[0].message.content})
-        else:
-            messages.append({"role": "assistant", "content": content})
-
-        _mark("enhance_complete")
-        log(f"[TIMING] === Enhancement Timing Summary ===")
-        prev = 0.0
-        for label, elapsed in timings:
-            delta = elapsed - prev
-            log(f"[TIMING]   {label}: {elapsed:.3f}s total, +{delta:.3f}s step")
-            prev = elapsed
-        log(f"[TIMING] === Total: {timings[-1][1]:.3f}s ===")
-                    
-        return result, False, messages
 
-
-    except openai.APIStatusError as e:
-        log(f"APIStatusError: {e}")
-        log("Falling back to alternative model...")
-        if os.getenv("FALLBACK_API_KEY") and os.getenv("FALLBACK_API_KEY") != "" and not falling_back:
-            fallback_config = PromptConfig(
-                model=FALLBACK_MODEL,
-                use_web_search=config.use_web_search,
-                additional_context_query=config.additional_context_query,
-                target_model=config.target_model,
-                ask_user_func=config.ask_user_func,
-                prompt_style=config.prompt_style,
-                is_reasoning_native=config.is_reasoning_native,
-            )
-            result, _, msgs = await enhance_prompt_async(
-                task, lazy_prompt, config=fallback_config, reasoning_effort=reasoning_effort, falling_back=True
-            )
-            return result, True, msgs
-        else:
-            raise Exception("We are out of money! Please try again later.") from e
\ No newline at end of file
+    outcome = await loop.run(messages, get_tools(config.use_web_search), reasoning_effort=reasoning_effort)
+    return outcome.result, outcome.is_fallback, outcome.messages
@@ -0,0 +1,425 @@
+import json
+import re
+
+import json_repair
+
+from . import log
+
+# The "Improved Prompt" label line: optional bullet, bold and heading markers, an
+# optional colon, then an optional inline value. Horizontal whitespace only, so the
+# same pattern works on a single line and with re.MULTILINE on a whole response.
+_MARKER = (
+    r"^[ \t]*(?:[-*+][ \t]*)?(?:\*{1,2}[ \t]*)?(?:[-*+][ \t]*)?(?:#{1,6}[ \t]*)?Improved[ \t]+Prompt"
+    r"(?:[ \t]*\*{1,2})?[ \t]*:?[ \t]*(?:\*{1,2})?[ \t]*(?P<inline>[^\n]*?)[ \t\r]*$"
+)
+MARKDOWN_MARKER_PATTERN = re.compile(_MARKER, re.IGNORECASE)
+# For matching at a line start inside a whole response
+_MARKER_LINE_PATTERN = re.compile(_MARKER, re.IGNORECASE | re.MULTILINE)
+NEXT_SECTION_PATTERN = re.compile(
+    r"^\s*(?:\*{1,2})?\s*(?:#{1,6}\s*)?[A-Z][A-Za-z0-9\s/&()_-]{1,48}\s*:?\s*(?:\*{1,2})?\s*$"
+)
+XML_OPEN_PATTERN = re.compile(r"<improved[-_]prompt>", re.IGNORECASE)
+XML_CLOSE_PATTERN = re.compile(r"</improved[-_]prompt>", re.IGNORECASE)
+# parse_response finds candidates with plain substring searches, which run at
+# memory speed, and only then checks the line around them with the patterns above.
+# "mproved" covers "Improved", "improved" and the tags; "MPROVED" the upper case.
+_WORD_NEEDLES = ("mproved", "MPROVED")
+_FENCE = "```"
+_NON_SPACE_PATTERN = re.compile(r"\S")
+# Enough trailing text to catch a tag split across two deltas
+_TAG_OVERLAP = len("</improved-prompt>")
+_PROMPT_LABEL = "**Prompt:**"
+_CLOSING_TAG = "</improved-prompt>"
+
+stats = {"responses": 0, "xml": 0, "json": 0, "markdown": 0, "fenced": 0, "failed": 0, "parse_calls": 0}
+
+
+def _strip_prompt_label(text: str) -> str:
+    if text.startswith(_PROMPT_LABEL):
+        return text[len(_PROMPT_LABEL):].strip()
+    return text
+
+
+def _unclosed_end(text: str, start: int) -> int:
+    """End of a tagged prompt that is still streaming: before a trailing "<..." that may become the closing tag."""
+    cut = text.rfind("<", max(start, len(text) - _TAG_OVERLAP))
+    if cut != -1 and _CLOSING_TAG.startswith(text[cut:].lower().replace("_", "-")):
+        return cut
+    return len(text)
+
+
+def _json_prompt(text: str) -> str | None:
+    try:
+        parsed = json.loads(text)
+    except ValueError:
+        try:
+            parsed = json_repair.loads(text)
+        except Exception:
+            return None
+    if isinstance(parsed, dict) and isinstance(parsed.get("improved_prompt"), str):
+        return parsed["improved_prompt"].strip() or None
+    return None
+
+
+def _unfence_json(text: str) -> str:
+    """Strip a ```json fence around a JSON answer."""
+    return text.strip().strip("`").removeprefix("json")
+
+
+def _sniff_json(text: str, start: int) -> bool:
+    """Whether the response starting at `start` (its first non-whitespace character) is a JSON answer."""
+    if text.startswith("{", start):
+        return True
+    if text.startswith("```", start):
+        line_end = text.find("\n", start)
+        body = _NON_SPACE_PATTERN.search(text, line_end + 1) if line_end != -1 else None
+        return body is not None and body.group() == "{"
+    return False
+
+
+def _find_word(text: str, start: int) -> int:
+    """Index of the next "mproved"/"MPROVED" at or after `start`, or -1."""
+    lower = text.find(_WORD_NEEDLES[0], start)
+    upper = text.find(_WORD_NEEDLES[1], start)
+    if upper == -1 or lower != -1 and lower < upper:
+        return lower
+    return upper
+
+
+def _xml_prompt(text: str, start: int) -> str:
+    """Text between the opening tag ending at `start` and its closing tag, or the end of a truncated response."""
+    end = len(text)
+    position = _find_word(text, start)
+    while position != -1:
+        # "</improved-prompt>": the word starts 3 characters after the "<"
+        if position >= start + 3 and XML_CLOSE_PATTERN.match(text, position - 3):
+            end = position - 3
+            break
+        position = _find_word(text, position + 1)
+    return text[start:end].strip()
+
+
+def _marker_at(text: str, position: int) -> re.Match | None:
+    """The label match for the line holding the word found at `position`, if that line is a label."""
+    line_start = text.rfind("\n", 0, position) + 1
+    line_end = text.find("\n", position)
+    return _MARKER_LINE_PATTERN.match(text, line_start, len(text) if line_end == -1 else line_end)
+
+
+def _section_prompt(text: str, start: int) -> str:
+    """The lines from `start` up to the next section heading, with fence lines dropped."""
+    collected: list[str] = []
+    in_code_fence = False
+    length = len(text)
+    while start < length:
+        end = text.find("\n", start)
+        if end == -1:
+            end = length
+        line = text[start:end].rstrip("\r")
+        start = end + 1
+        stripped = line.strip()
+        if stripped.startswith("```"):
+            in_code_fence = not in_code_fence
+            continue
+        if not in_code_fence and stripped and NEXT_SECTION_PATTERN.match(line):
+            break
+        collected.append(line)
+    return _strip_prompt_label("\n".join(collected).strip())
+
+
+def _markdown_prompt(text: str, marker: re.Match) -> str:
+    inline = _strip_prompt_label(marker.group("inline").strip())
+    if inline:
+        return inline
+    line_end = text.find("\n", marker.end())
+    if line_end == -1:
+        return ""
+    return _section_prompt(text, line_end + 1)
+
+
+def parse_response(text: str | None) -> tuple[str | None, str | None]:
+    """Find the improved prompt in a complete response in one pass; returns (prompt, format).
+
+    The format is sniffed from the first non-whitespace characters: a JSON answer
+    is decoded directly. Otherwise one left-to-right scan stops at the first
+    `<improved-prompt>` tag or "Improved Prompt" label line, noting code fences on
+    the way for the fallback to the last fenced block. Same preferences as
+    `OutputExtractor`.
+    """
+    if not text:
+        return None, None
+    first = _NON_SPACE_PATTERN.search(text)
+    if first is None:
+        return None, None
+    if _sniff_json(text, first.start()):
+        prompt = _json_prompt(_unfence_json(text))
+        if prompt:
+            return prompt, "json"
+
+    fence_start = None
+    last_fence = None
+    word = _find_word(text, 0)
+    fence = text.find(_FENCE)
+    while word != -1 or fence != -1:
+        if fence == -1 or (word != -1 and word < fence):
+            position, word = word, _find_word(text, word + 1)
+            tag = XML_OPEN_PATTERN.match(text, position - 2) if position >= 2 else None
+            if tag:
+                prompt = _xml_prompt(text, tag.end())
+                if prompt:
+                    return prompt, "xml"
+                continue
+            marker = _marker_at(text, position)
+            if not marker:
+                continue
+            # A tagged prompt wins over the label, e.g. under an "## Improved Prompt" heading
+            tag = XML_OPEN_PATTERN.search(text, marker.end())
+            if tag:
+                prompt = _xml_prompt(text, tag.end())
+                if prompt:
+                    return prompt, "xml"
+            prompt = _markdown_prompt(text, marker)
+            return (prompt, "markdown") if prompt else (None, None)
+
+        position, fence = fence, text.find(_FENCE, fence + 3)
+        line_start = text.rfind("\n", 0, position) + 1
+        if text[line_start:position].strip():
+            continue
+        line_end = text.find("\n", position)
+        if fence_start is None:
+            fence_start = len(text) if line_end == -1 else line_end + 1
+        else:
+            last_fence = (fence_start, line_start)
+            fence_start = None
+        if line_end != -1 and fence != -1 and fence < line_end:
+            # Skip the rest of the fence line, e.g. "````" or "```json ```"
+            fence = text.find(_FENCE, line_end)
+
+    if fence_start is not None:
+        last_fence = (fence_start, len(text))
+    if last_fence:
+        fenced = text[last_fence[0]:last_fence[1]].strip()
+        if fenced:
+            prompt = _json_prompt(fenced) if fenced.startswith("{") else None
+            return prompt or fenced, "fenced"
+    return None, None
+
+
+def parse_llm_response(text: str | None) -> str | None:
+    prompt, response_format = parse_response(text)
+    if prompt:
+        log(f"[DEBUG] Parsed improved prompt ({response_format}): {prompt[:50]}...")
+    else:
+        log("[DEBUG] No improved prompt found in LLM response.")
+    return prompt
+
+
+def parse_llm_response_XML(response: str) -> str | None:
+    match = XML_OPEN_PATTERN.search(response)
+    if match:
+        improved_prompt = _xml_prompt(response, match.end())
+        log(f"[DEBUG] Parsed Improved Prompt: {improved_prompt[:50]}...")
+        return improved_prompt
+    log("[DEBUG] No <improved-prompt> tag found in LLM response.")
+    return None
+
+
+def parse_llm_response_markdown(response: str) -> str | None:
+    marker = None
+    position = _find_word(response, 0)
+    while position != -1 and marker is None:
+        marker = _marker_at(response, position)
+        position = _find_word(response, position + 1)
+    if not marker:
+        log("[DEBUG] No markdown Improved Prompt label found in LLM response.")
+        return None
+    improved_prompt = _markdown_prompt(response, marker)
+    if improved_prompt:
+        log(f"[DEBUG] Parsed Improved Prompt from Markdown: {improved_prompt[:50]}...")
+        return improved_prompt
+    log("[DEBUG] Found Improved Prompt label but no prompt content.")
+    return None
+
+
+class OutputExtractor:
+    """Recognizes the improved prompt in a model response while it is being produced.
+
+    Feed it the response as it arrives (stream deltas, or the whole content at
+    once) and call `result()` at the end. Tags, sections and code fences are
+    tracked as the text comes in, so `result()` only has to slice out the span it
+    already found. In order of preference it recognizes JSON with an
+    `improved_prompt` key (sniffed from the first characters), `<improved-prompt>`
+    tags (also unterminated ones in a truncated response), a markdown "Improved
+    Prompt" section and, failing those, the last fenced code block.
+    """
+
+    def __init__(self):
+        self._chunks: list[str] = []
+        self._length = 0
+        self._tail = ""
+        self._pending_line = ""
+        self._head = ""
+        self.json_like: bool | None = None
+        self._xml_start: int | None = None
+        self._xml_end: int | None = None
+        self._section: list[str] | None = None
+        self._section_inline: str | None = None
+        self._section_done = False
+        self._section_fence = False
+        self._fence: list[str] | None = None
+        self._last_fence: str | None = None
+        self._finished = False
+        self.format: str | None = None
+
+    def feed(self, text: str | None) -> "OutputExtractor":
+        if not text:
+            return self
+        if self.json_like is None:
+            self._sniff(text)
+        self._scan_tags(text)
+        self._chunks.append(text)
+        self._length += len(text)
+
+        lines = (self._pending_line + text).split("\n")
+        self._pending_line = lines.pop()
+        for line in lines:
+            self._scan_line(line)
+        return self
+
+    def _sniff(self, text: str):
+        # Decide on the first non-whitespace characters whether this is a JSON answer
+        self._head = (self._head + text).lstrip()
+        if self._head.startswith("{"):
+            self.json_like = True
+        elif self._head.startswith("```"):
+            body = self._head.split("\n", 1)[1].lstrip() if "\n" in self._head else ""
+            if body:
+                self.json_like = body.startswith("{")
+        elif self._head:
+            self.json_like = False
+
+    def _scan_tags(self, text: str):
+        window = self._tail + text
+        offset = self._length - len(self._tail)
+        if self._xml_start is None:
+            match = XML_OPEN_PATTERN.search(window)
+            if match:
+                self._xml_start = offset + match.end()
+        if self._xml_start is not None and self._xml_end is None:
+            match = XML_CLOSE_PATTERN.search(window, max(0, self._xml_start - offset))
+            if match:
+                self._xml_end = offset + match.start()
+        self._tail = window[-_TAG_OVERLAP:]
+
+    def _scan_line(self, line: str):
+        stripped = line.strip()
+        if self._section is not None:
+            if self._section_done:
+                return
+            if stripped.startswith("```"):
+                self._section_fence = not self._section_fence
+            elif not self._section_fence and stripped and NEXT_SECTION_PATTERN.match(line):
+                self._section_done = True
+            else:
+                self._section.append(line)
+            return
+
+        if self._section_inline is None:
+            marker = MARKDOWN_MARKER_PATTERN.match(line)
+            if marker:
+                inline = _strip_prompt_label(marker.group("inline").strip())
+                if inline:
+                    self._section_inline = inline
+                else:
+                    self._section = []
+                return
+
+        if stripped.startswith("```"):
+            if self._fence is None:
+                self._fence = []
+            else:
+                self._last_fence = "\n".join(self._fence)
+                self._fence = None
+        elif self._fence is not None:
+            self._fence.append(line)
+
+    def _text(self) -> str:
+        if len(self._chunks) > 1:
+            self._chunks = ["".join(self._chunks)]
+        return self._chunks[0] if self._chunks else ""
+
+    def draft(self) -> str | None:
+        """The improved prompt as far as it has arrived, for showing while it streams.
+
+        Only a tagged prompt or a markdown "Improved Prompt" section can be told
+        apart from the rest of the response this early; None until one starts. A
+        trailing "<..." that may be the start of the closing tag is held back, and a
+        section grows a line at a time. JSON and fenced answers have no draft.
+        """
+        if self._xml_start is not None:
+            text = self._text()
+            end = self._xml_end if self._xml_end is not None else _unclosed_end(text, self._xml_start)
+            return text[self._xml_start:end].strip()
+        if self._section_inline:
+            return self._section_inline
+        if self._section:
+            return _strip_prompt_label("\n".join(self._section).strip())
+        return None
+
+    @property
+    def complete(self) -> bool:
+        """Whether the tagged prompt has been closed, so the rest of the response is not needed."""
+        return self._xml_end is not None
+
+    def result(self) -> str | None:
+        if not self._finished:
+            self._finished = True
+            if self._pending_line:
+                self._scan_line(self._pending_line)
+                self._pending_line = ""
+        text = "".join(self._chunks)
+
+        if self.json_like:
+            prompt = _json_prompt(_unfence_json(text))
+            if prompt:
+                return self._found("json", prompt)
+        if self._xml_start is not None:
+            prompt = text[self._xml_start:self._xml_end].strip()
+            if prompt:
+                return self._found("xml", prompt)
+        if self._section_inline:
+            return self._found("markdown", self._section_inline)
+        if self._section:
+            prompt = _strip_prompt_label("\n".join(self._section).strip())
+            if prompt:
+                return self._found("markdown", prompt)
+
+        fence = self._last_fence if self._fence is None else "\n".join(self._fence)
+        if fence and fence.strip():
+            prompt = _json_prompt(fence) if fence.lstrip().startswith("{") else None
+            return self._found("fenced", prompt or fence.strip())
+
+        self.format = None
+        log("[DEBUG] No improved prompt found in LLM response.")
+        return None
+
+    def _found(self, format: str, prompt: str) -> str:
+        self.format = format
+        log(f"[DEBUG] Extracted improved prompt ({format}): {prompt[:50]}...")
+        return prompt
+
+
+def record_extraction(response_format: str | None, needed_parse_call: bool):
+    stats["responses"] += 1
+    stats[response_format or "failed"] += 1
+    if needed_parse_call:
+        stats["parse_calls"] += 1
+
+
+def extraction_stats() -> dict:
+    responses = stats["responses"]
+    return {
+        **stats,
+        "extraction_rate": (responses - stats["failed"]) / responses if responses else 0.0,
+        "parse_call_rate": stats["parse_calls"] / responses if responses else 0.0,
+    }
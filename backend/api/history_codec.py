@@ -0,0 +1,119 @@
+"""Compact, lossless encoding of stored conversation histories.
+
+A stored chunk is a version byte followed by zlib-compressed msgpack of the
+messages, with three reductions that decoding undoes exactly:
+
+- Keys holding None (`refusal`, `audio`, `function_call`, ... in every SDK dump)
+  are dropped. A bitmask under the integer key 0 says which of `NULLABLE_KEYS` to
+  put back; any other null keys are listed under key 1.
+- `"type": "function"` is dropped from tool calls, flagged by key 2.
+- The content of system messages, the same few prompts in every session, is
+  replaced by a reference to its content hash (msgpack ext type 1). The texts are
+  returned separately so the store keeps each one once.
+
+Integer keys cannot clash with message fields, which are always strings.
+"""
+import hashlib
+import json
+import zlib
+
+import msgpack
+
+FORMAT_VERSION = b"\x01"
+BLOB_REF = 1
+_NULL_MASK, _OTHER_NULLS, _FUNCTION_TYPES = 0, 1, 2
+
+NULLABLE_KEYS = (
+    "content", "refusal", "audio", "function_call", "tool_calls", "annotations",
+    "name", "tool_call_id", "reasoning_content", "parsed",
+)
+_NULLABLE_BITS = {key: 1 << index for index, key in enumerate(NULLABLE_KEYS)}
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()[:32]
+
+
+def _compact(message: dict, blobs: dict[str, str]) -> dict:
+    if not isinstance(message, dict):
+        return message
+    compact = {}
+    null_mask = 0
+    other_nulls = []
+    for key, value in message.items():
+        if value is None:
+            if key in _NULLABLE_BITS:
+                null_mask |= _NULLABLE_BITS[key]
+            else:
+                other_nulls.append(key)
+        else:
+            compact[key] = value
+    if null_mask:
+        compact[_NULL_MASK] = null_mask
+    if other_nulls:
+        compact[_OTHER_NULLS] = other_nulls
+
+    tool_calls = compact.get("tool_calls")
+    if isinstance(tool_calls, list) and tool_calls and all(isinstance(call, dict) and call.get("type") == "function" for call in tool_calls):
+        compact["tool_calls"] = [{k: v for k, v in call.items() if k != "type"} for call in tool_calls]
+        compact[_FUNCTION_TYPES] = True
+
+    content = compact.get("content")
+    if compact.get("role") == "system" and isinstance(content, str):
+        digest = content_hash(content)
+        blobs[digest] = content
+        compact["content"] = msgpack.ExtType(BLOB_REF, bytes.fromhex(digest))
+    return compact
+
+
+def _expand(compact, blobs: dict[str, str]):
+    if not isinstance(compact, dict):
+        return compact
+    message = {}
+    for key, value in compact.items():
+        if isinstance(key, int):
+            continue
+        if isinstance(value, msgpack.ExtType) and value.code == BLOB_REF:
+            value = blobs[value.data.hex()]
+        message[key] = value
+    null_mask = compact.get(_NULL_MASK, 0)
+    for key, bit in _NULLABLE_BITS.items():
+        if null_mask & bit:
+            message[key] = None
+    for key in compact.get(_OTHER_NULLS, ()):
+        message[key] = None
+    if compact.get(_FUNCTION_TYPES):
+        message["tool_calls"] = [{**call, "type": "function"} for call in message["tool_calls"]]
+    return message
+
+
+def encode_chunk(messages: list, level: int = 6) -> tuple[bytes, dict[str, str]]:
+    """The stored form of `messages`, and the system prompt texts it refers to by hash."""
+    blobs: dict[str, str] = {}
+    packed = msgpack.packb([_compact(message, blobs) for message in messages], use_bin_type=True)
+    return FORMAT_VERSION + zlib.compress(packed, level), blobs
+
+
+def unpack_chunk(payload: bytes) -> list:
+    """The compact messages of a chunk. Chunks stored as plain JSON are read as they are."""
+    if payload[:1] != FORMAT_VERSION:
+        return json.loads(payload)
+    return msgpack.unpackb(zlib.decompress(payload[1:]), raw=False, strict_map_key=False)
+
+
+def blob_refs(compact_messages: list) -> set[str]:
+    return {
+        value.data.hex()
+        for message in compact_messages if isinstance(message, dict)
+        for value in message.values()
+        if isinstance(value, msgpack.ExtType) and value.code == BLOB_REF
+    }
+
+
+def expand_messages(compact_messages: list, blobs: dict[str, str]) -> list:
+    """OpenAI message dicts equal to the ones that were encoded."""
+    return [_expand(message, blobs) for message in compact_messages]
+
+
+def decode_chunk(payload: bytes, blobs: dict[str, str]) -> list:
+    return expand_messages(unpack_chunk(payload), blobs)
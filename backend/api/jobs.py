@@ -0,0 +1,202 @@
+import asyncio
+import os
+import time
+import traceback
+from typing import Awaitable, Callable
+
+from . import log
+from .conversations import get_conversation_store
+from .scheduler import scheduler
+from .shared_utils import PromptConfig, serialize_messages
+
+# A job talks to its client only through frames, the JSON messages the WebSocket
+# sends, and a queue of what the user typed in reply to a question
+SendFrame = Callable[[dict], Awaitable[None]]
+
+
+async def load_enhancement_messages(enhancement_task_id):
+    """Conversation of a finished enhancement, which an edit continues from."""
+    if enhancement_task_id:
+        stored_messages = await get_conversation_store().load(enhancement_task_id)
+        if stored_messages:
+            log(f"[Jobs] Loaded stored messages for enhancement_task_id: {enhancement_task_id}, messages count: {len(stored_messages)}")
+            return stored_messages
+        else:
+            log(f"[Jobs] No stored messages found for enhancement_task_id: {enhancement_task_id}")
+    return []
+
+
+def _config(data: dict, ask_user_func, on_delta) -> PromptConfig:
+    return PromptConfig(
+        model=os.getenv("MODEL", "gemini-3-flash-preview"),
+        use_web_search=data.get('use_web_search', True),
+        additional_context_query=data.get('additional_context_query', ''),
+        ask_user_func=ask_user_func,
+        target_model=data.get('target_model', 'gpt-5.1'),
+        is_reasoning_native=data.get('is_reasoning_native', False),
+        prompt_style=data.get('prompt_style', {}),
+        on_delta=on_delta if data.get('stream', False) else None,
+    )
+
+
+class Job:
+    """One enhance or edit request, wherever it runs.
+
+    The WebSocket consumer runs jobs itself, or hands them to a worker process
+    through the channel layer (`api.workers`); either way the job reaches its
+    client only through `send_frame` and the `answers` queue. It waits for a
+    scheduler slot first and gives the slot up while the user thinks.
+    """
+
+    def __init__(
+        self,
+        kind: str,
+        task_id: str,
+        data: dict,
+        client: str,
+        send_frame: SendFrame,
+        answers: asyncio.Queue,
+    ):
+        if kind not in ("enhance", "edit"):
+            raise ValueError(f"Unknown job kind: {kind}")
+        self.kind = kind
+        self.task_id = task_id
+        self.data = data
+        self.client = client
+        self.send_frame = send_frame
+        self.answers = answers
+        self.slot = None
+        self.queued = False
+
+    async def run(self):
+        """Run the job, reporting any failure to the client as a task_error frame."""
+        try:
+            async with scheduler.slot(self.client, on_position=self.send_queue_position) as self.slot:
+                if self.queued:
+                    await self.send_queue_position(0)
+                if self.kind == "enhance":
+                    await self.run_enhancement()
+                else:
+                    await self.run_edit()
+        except asyncio.CancelledError:
+            log(f"[Jobs] {self.kind.capitalize()} task was cancelled")
+        except Exception as e:
+            log(f"[Jobs] {self.kind.capitalize()} error: {e}")
+            traceback.print_exc()
+            try:
+                await self.send_frame({'type': 'task_error', 'error': str(e)})
+            except Exception:
+                pass
+
+    async def run_enhancement(self):
+        t_ws_start = time.perf_counter()
+        # Import here to avoid circular imports at module load time
+        from .result_cache import enhance_prompt_cached
+
+        data = self.data
+        log(f"[Jobs] Calling enhance_prompt_async with task: {data.get('task', '')[:50]}")
+        log(f"[TIMING] [WS] enhance request received")
+
+        config = _config(data, self.ask_user_question, self.send_delta)
+        t_before_enhance = time.perf_counter()
+        log(f"[TIMING] [WS] config built in {t_before_enhance - t_ws_start:.3f}s")
+        result, is_fallback, messages, cache_hit = await enhance_prompt_cached(
+            task=data.get('task', ''),
+            lazy_prompt=data.get('lazy_prompt', ''),
+            reasoning_effort=data.get('reasoning_effort', 'low'),
+            config=config,
+        )
+        t_after_enhance = time.perf_counter()
+        log(f"[TIMING] [WS] enhance_prompt_async completed in {t_after_enhance - t_before_enhance:.3f}s")
+
+        result = result or "Sorry, I couldn't generate a response."
+        messages = messages or []
+
+        await get_conversation_store().save(self.task_id, messages)
+        t_after_store = time.perf_counter()
+        log(f"[TIMING] [WS] conversation stored in {t_after_store - t_after_enhance:.3f}s")
+
+        log(f"[Jobs] Enhancement complete, result length: {len(result)}, messages stored: {len(messages)}")
+
+        await self.send_frame({
+            'type': 'task_complete',
+            'result': result,
+            'is_fallback': is_fallback,
+            'cached': cache_hit is not None,
+            'cache_match': cache_hit
+        })
+        t_total = time.perf_counter() - t_ws_start
+        log(f"[TIMING] [WS] total enhance request wall time: {t_total:.3f}s")
+        log("[Jobs] Sent task_complete to client")
+
+    async def run_edit(self):
+        t_ws_start = time.perf_counter()
+        data = self.data
+        if data.get("edit_instructions", "") == "":
+            raise ValueError("Edit instructions cannot be empty.")
+
+        # Import here to avoid circular imports at module load time
+        from .edit import edit_prompt_async
+
+        log(f"[Jobs] Calling edit_prompt_async with instructions: {data.get('edit_instructions', '')[:50]}")
+        log(f"[TIMING] [WS] edit request received")
+
+        enhancement_task_id = data.get("enhancement_task_id", None)
+        enhancement_messages = await load_enhancement_messages(enhancement_task_id)
+        t_after_cache_load = time.perf_counter()
+        log(f"[TIMING] [WS] enhancement messages loaded in {t_after_cache_load - t_ws_start:.3f}s")
+
+        config = _config(data, self.ask_user_question, self.send_delta)
+        t_before_edit = time.perf_counter()
+        result, messages = await edit_prompt_async(
+            edit_instructions=data.get('edit_instructions', ''),
+            current_prompt=data.get('current_prompt', ''),
+            config=config,
+            enhancement_messages=enhancement_messages
+        )
+        t_after_edit = time.perf_counter()
+        log(f"[TIMING] [WS] edit_prompt_async completed in {t_after_edit - t_before_edit:.3f}s")
+
+        if enhancement_task_id and result:
+            # Later edits of the same prompt continue from this one
+            await get_conversation_store().append(
+                enhancement_task_id, serialize_messages(messages[len(enhancement_messages):])
+            )
+
+        await self.send_frame({
+            'type': 'task_complete',
+            'result': result
+        })
+        t_total = time.perf_counter() - t_ws_start
+        log(f"[TIMING] [WS] total edit request wall time: {t_total:.3f}s")
+        log("[Jobs] Sent task_complete to client")
+
+    async def send_delta(self, delta: str, reset: bool = False):
+        """Forward a streamed content delta to the client; with `reset` it replaces the text streamed so far."""
+        frame = {'type': 'task_delta', 'delta': delta}
+        if reset:
+            frame['reset'] = True
+        await self.send_frame(frame)
+
+    async def send_queue_position(self, position: int):
+        """Tell the client its place in the queue (1 is next) while it waits for a slot, and 0 once it runs."""
+        self.queued = position > 0
+        await self.send_frame({'type': 'queued', 'position': position})
+
+    async def ask_user_question(self, questions: str, timeout: int = 300) -> str:
+        """Ask user a question and wait for the answer."""
+        log(f"[Jobs] Asking user question: {questions}")
+        # Answers sent while no question was pending (a second click, or a reply to a
+        # question that timed out) must not answer this one
+        while not self.answers.empty():
+            self.answers.get_nowait()
+        await self.send_frame({'type': 'user_question', 'questions': questions})
+
+        try:
+            # Nothing runs against the provider while the user thinks, so free the slot
+            async with self.slot.suspended():
+                answer = await asyncio.wait_for(self.answers.get(), timeout=timeout)
+            log(f"[Jobs] Got user answer: {answer}")
+            return answer or ""
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"User did not respond within {timeout} seconds")
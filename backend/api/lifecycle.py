@@ -0,0 +1,70 @@
+import asyncio
+import traceback
+from typing import Awaitable, Callable
+
+from . import log
+
+_startup_hooks: list[Callable[[], Awaitable[None]]] = []
+_shutdown_hooks: list[Callable[[], Awaitable[None]]] = []
+_started = False
+_startup_task: asyncio.Task | None = None
+
+
+def on_startup(func: Callable[[], Awaitable[None]]):
+    """Register a coroutine function to run when the ASGI server starts."""
+    _startup_hooks.append(func)
+    return func
+
+
+def on_shutdown(func: Callable[[], Awaitable[None]]):
+    """Register a coroutine function to run when the ASGI server shuts down."""
+    _shutdown_hooks.append(func)
+    return func
+
+
+async def _run_hooks(hooks: list[Callable[[], Awaitable[None]]], stage: str):
+    for hook in hooks:
+        try:
+            await hook()
+        except Exception as e:
+            # One failing hook must not keep the others from running
+            log(f"[Lifecycle] {stage} hook {hook.__qualname__} failed: {e}")
+            traceback.print_exc()
+
+
+async def run_startup():
+    """Run the startup hooks once. Safe to call repeatedly."""
+    global _started
+    if _started:
+        return
+    _started = True
+    await _run_hooks(_startup_hooks, "startup")
+
+
+def run_startup_soon():
+    """Schedule the startup hooks on the running loop without waiting for them."""
+    global _startup_task
+    if not _started and (_startup_task is None or _startup_task.done()):
+        _startup_task = asyncio.ensure_future(run_startup())
+
+
+async def run_shutdown():
+    global _started
+    # Tear down in reverse registration order
+    await _run_hooks(list(reversed(_shutdown_hooks)), "shutdown")
+    _started = False
+
+
+class LifespanApp:
+    """ASGI app for the `lifespan` protocol that runs the registered hooks."""
+
+    async def __call__(self, scope, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await run_startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await run_shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
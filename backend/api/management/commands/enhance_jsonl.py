@@ -0,0 +1,183 @@
+import asyncio
+import hashlib
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ...batch import batch_config
+from ...enhance import enhance_prompt_async
+from ...lifecycle import run_shutdown
+from ...shared_utils import prompt_cache_stats
+
+
+def record_id(record: dict) -> str:
+    """The record's own "id", or a digest of its content so reruns find it again."""
+    if record.get("id") is not None:
+        return str(record["id"])
+    payload = json.dumps(record, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def load_checkpoint(path: Path) -> set[str]:
+    if not path.exists():
+        return set()
+    with open(path) as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+class RunReport:
+    def __init__(self):
+        self.t_start = time.perf_counter()
+        self.tokens_at_start = prompt_cache_stats.prompt_tokens + prompt_cache_stats.completion_tokens
+        self.latencies: list[float] = []
+        self.done = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def lines(self) -> list[str]:
+        seconds = time.perf_counter() - self.t_start
+        tokens = prompt_cache_stats.prompt_tokens + prompt_cache_stats.completion_tokens - self.tokens_at_start
+        lines = [
+            f"done {self.done}, failed {self.failed}, skipped (checkpointed) {self.skipped} in {seconds:.1f}s",
+            f"throughput: {self.done / seconds:.2f} items/s, {tokens / seconds:.0f} tokens/s ({tokens} tokens)",
+        ]
+        if self.latencies:
+            p50, p90, p99 = np.percentile(self.latencies, [50, 90, 99])
+            lines.append(
+                f"latency: p50 {p50:.2f}s, p90 {p90:.2f}s, p99 {p99:.2f}s, max {max(self.latencies):.2f}s"
+            )
+        return lines
+
+
+class Command(BaseCommand):
+    help = (
+        "Enhance every record of a JSONL file of {task, lazy_prompt, style, target_model} objects. "
+        "Results are appended to the output file as they complete and finished ids are checkpointed, "
+        "so rerunning an interrupted run only enhances what is left."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", type=Path)
+        parser.add_argument("--output", type=Path, help="Defaults to <input>.enhanced.jsonl")
+        parser.add_argument("--checkpoint", type=Path, help="Defaults to <output>.checkpoint")
+        parser.add_argument(
+            "--concurrency", type=int, default=getattr(settings, "BATCH_DEFAULT_CONCURRENCY", 4)
+        )
+        parser.add_argument("--target-model", default="gpt-5.1", help="For records without target_model")
+        parser.add_argument("--reasoning-effort", default="low", choices=["low", "medium", "high"])
+        parser.add_argument("--use-web-search", action="store_true")
+
+    def handle(self, *args, **options):
+        source: Path = options["input"]
+        if not source.exists():
+            raise CommandError(f"{source} does not exist")
+        if options["concurrency"] < 1:
+            raise CommandError("--concurrency must be at least 1")
+        output = options["output"] or source.with_suffix(".enhanced.jsonl")
+        checkpoint = options["checkpoint"] or output.with_name(output.name + ".checkpoint")
+
+        report = RunReport()
+        try:
+            asyncio.run(self.run(source, output, checkpoint, options, report))
+        except KeyboardInterrupt:
+            self.stderr.write("Interrupted; run the same command again to resume.")
+        finally:
+            for line in report.lines():
+                self.stdout.write(line)
+
+    async def run(self, source: Path, output: Path, checkpoint: Path, options: dict, report: RunReport):
+        finished = load_checkpoint(checkpoint)
+        concurrency = options["concurrency"]
+        queue: asyncio.Queue = asyncio.Queue(maxsize=2 * concurrency)
+
+        with open(output, "a") as out, open(checkpoint, "a") as done_ids:
+            def write(entry_id: str, entry: dict):
+                out.write(json.dumps(entry) + "\n")
+                out.flush()
+                # Checkpoint only once the result is safely in the output
+                if "error" not in entry:
+                    done_ids.write(entry_id + "\n")
+                    done_ids.flush()
+
+            async def worker():
+                while True:
+                    job = await queue.get()
+                    if job is None:
+                        return
+                    entry_id, record = job
+                    write(entry_id, await self.enhance(entry_id, record, options, report))
+
+            async def produce():
+                seen = set()
+                with open(source) as f:
+                    for line_number, line in enumerate(f, start=1):
+                        if not line.strip():
+                            continue
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError as e:
+                            self.stderr.write(f"{source}:{line_number}: skipping invalid JSON ({e})")
+                            continue
+                        entry_id = record_id(record)
+                        if entry_id in finished or entry_id in seen:
+                            report.skipped += 1
+                            continue
+                        seen.add(entry_id)
+                        await queue.put((entry_id, record))
+                for _ in range(concurrency):
+                    await queue.put(None)
+
+            # The file is read as the workers free up queue slots, never all at once
+            tasks = [asyncio.ensure_future(produce())] + [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                # Close the pooled HTTP clients before asyncio.run closes the loop
+                await run_shutdown()
+
+    async def enhance(self, entry_id: str, record: dict, options: dict, report: RunReport) -> dict:
+        timings = {}
+        config = batch_config(
+            {
+                "target_model": record.get("target_model") or options["target_model"],
+                "prompt_style": record.get("style") or {},
+                "use_web_search": options["use_web_search"],
+            },
+            on_timings=timings.update,
+        )
+        entry = {"id": entry_id, "task": record.get("task", ""), "lazy_prompt": record.get("lazy_prompt", "")}
+        t_start = time.perf_counter()
+        try:
+            result, is_fallback, _ = await enhance_prompt_async(
+                task=entry["task"],
+                lazy_prompt=entry["lazy_prompt"],
+                config=config,
+                reasoning_effort=record.get("reasoning_effort") or options["reasoning_effort"],
+            )
+        except Exception as e:
+            return self.failed(entry_id, entry, str(e), report)
+        if not result:
+            # Written, but not checkpointed, so a rerun tries the record again
+            return self.failed(entry_id, entry, "No enhanced prompt was returned", report)
+        latency = time.perf_counter() - t_start
+        report.done += 1
+        report.latencies.append(latency)
+        return {
+            **entry,
+            "target_model": config.target_model,
+            "enhanced_prompt": result,
+            "is_fallback": is_fallback,
+            "latency_seconds": latency,
+            "timings": timings or None,
+        }
+
+    def failed(self, entry_id: str, entry: dict, error: str, report: RunReport) -> dict:
+        report.failed += 1
+        self.stderr.write(f"{entry_id}: {error}")
+        return {**entry, "error": error}
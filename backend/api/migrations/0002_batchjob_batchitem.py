@@ -0,0 +1,52 @@
+# Generated by Django 5.2.10 on 2026-10-17 05:02
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BatchJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('completed', 'Completed'), ('cancelled', 'Cancelled')], default='queued', max_length=16)),
+                ('options', models.JSONField(default=dict)),
+                ('concurrency', models.PositiveIntegerField(default=4)),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BatchItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('task', models.CharField(blank=True, max_length=255)),
+                ('lazy_prompt', models.TextField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], default='pending', max_length=16)),
+                ('result', models.TextField(blank=True, default='')),
+                ('is_fallback', models.BooleanField(default=False)),
+                ('cache_hit', models.CharField(blank=True, default='', max_length=16)),
+                ('error', models.TextField(blank=True, default='')),
+                ('timings', models.JSONField(blank=True, null=True)),
+                ('latency_seconds', models.FloatField(blank=True, null=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='api.batchjob')),
+            ],
+            options={
+                'ordering': ['index'],
+                'indexes': [models.Index(fields=['job', 'status'], name='api_batchit_job_id_76cb39_idx')],
+                'constraints': [models.UniqueConstraint(fields=('job', 'index'), name='unique_batch_item_index')],
+            },
+        ),
+    ]
@@ -1,3 +1,5 @@
+import uuid
+
 from django.db import models
 
 class SavedPrompt(models.Model):
@@ -14,3 +16,61 @@ class SavedPrompt(models.Model):
     
     def __str__(self):
         return f"Prompt for task: {self.task or '(Untitled)'} created at {self.created_at}"
+
+
+class BatchJob(models.Model):
+    """A batch of enhancement requests submitted over REST and run in the background."""
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    CANCELLED = "cancelled"
+    STATUS_CHOICES = [(QUEUED, "Queued"), (RUNNING, "Running"), (COMPLETED, "Completed"), (CANCELLED, "Cancelled")]
+    FINISHED = (COMPLETED, CANCELLED)
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED)
+    # Request parameters shared by every item (target_model, reasoning_effort, ...)
+    options = models.JSONField(default=dict)
+    concurrency = models.PositiveIntegerField(default=4)
+    total = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Batch {self.id} ({self.status}, {self.total} items)"
+
+
+class BatchItem(models.Model):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"), (RUNNING, "Running"), (DONE, "Done"), (FAILED, "Failed"), (CANCELLED, "Cancelled"),
+    ]
+
+    job = models.ForeignKey(BatchJob, on_delete=models.CASCADE, related_name="items")
+    index = models.PositiveIntegerField()
+    task = models.CharField(max_length=255, blank=True)
+    lazy_prompt = models.TextField()
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    result = models.TextField(blank=True, default="")
+    is_fallback = models.BooleanField(default=False)
+    cache_hit = models.CharField(max_length=16, blank=True, default="")
+    error = models.TextField(blank=True, default="")
+    # Timings.as_dict() of the run: total and per-step durations
+    timings = models.JSONField(null=True, blank=True)
+    latency_seconds = models.FloatField(null=True, blank=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["index"]
+        constraints = [models.UniqueConstraint(fields=["job", "index"], name="unique_batch_item_index")]
+        indexes = [models.Index(fields=["job", "status"])]
+
+    def __str__(self):
+        return f"Item {self.index} of batch {self.job_id} ({self.status})"
@@ -0,0 +1,180 @@
+import asyncio
+import re
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+# Prime just above 2**32 so (a * x + b) never overflows uint64 for 32-bit a, b and x
+_MERSENNE_PRIME = np.uint64(4294967311)
+_MAX_HASH = np.uint64(0xFFFFFFFF)
+_NORMALIZE_PATTERN = re.compile(r"[\W_]+")
+
+
+def normalize_prompt(task: str, lazy_prompt: str) -> str:
+    """Casefold and strip punctuation and whitespace differences."""
+    text = f"{task} | {lazy_prompt}".casefold()
+    return _NORMALIZE_PATTERN.sub(" ", text).strip()
+
+
+def shingles(text: str, k: int) -> np.ndarray:
+    """32-bit hashes of the character k-grams of `text`."""
+    if len(text) <= k:
+        grams = {text}
+    else:
+        grams = {text[i:i + k] for i in range(len(text) - k + 1)}
+    return np.fromiter((zlib.crc32(gram.encode()) for gram in grams), dtype=np.uint64, count=len(grams))
+
+
+@dataclass
+class NearDuplicateMatch:
+    similarity: float
+    result: str
+    result_key: str
+
+
+class NearDuplicateIndex:
+    """MinHash signatures with an LSH band index over normalized (task, lazy_prompt) pairs.
+
+    Signatures live in one preallocated array of `max_entries` rows, so memory is
+    bounded; once full, the least recently used entry is evicted. Entries are only
+    compared within the same `scope` (the request parameters that change the output).
+
+    Long prompts are signed from a sample of about `max_shingles` shingles, so the
+    cost of a signature is bounded whatever the length; `asignature` computes it in
+    a thread when the text is long. The sample keeps the shingles whose hash is
+    below a threshold that halves with each doubling of the length, so two texts
+    sampled at the same rate keep exactly the same shared shingles and MinHash
+    estimates the Jaccard similarity of the samples. Near duplicates are about as
+    long and almost always share the rate; a pair straddling a doubling is compared
+    on samples of different rates and its similarity is underestimated.
+    """
+
+    # Shingles permuted at once, bounding the temporary matrix to CHUNK x num_perm
+    CHUNK = 1024
+    # Texts longer than this are signed off the event loop
+    THREAD_CHARS = 20000
+
+    def __init__(
+        self,
+        max_entries: int = 10000,
+        num_perm: int = 128,
+        bands: int = 32,
+        shingle_size: int = 5,
+        seed: int = 1,
+        max_shingles: int = 4096,
+    ):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.max_entries = max_entries
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.max_shingles = max_shingles
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, 2 ** 32, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, 2 ** 32, size=num_perm, dtype=np.uint64)
+        self._signatures = np.zeros((max_entries, num_perm), dtype=np.uint32)
+        self._buckets: list[dict[bytes, set[int]]] = [{} for _ in range(bands)]
+        self._entries: OrderedDict[int, tuple[str, str, str]] = OrderedDict()
+        self._free_slots = list(range(max_entries - 1, -1, -1))
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def signature(self, task: str, lazy_prompt: str) -> np.ndarray:
+        hashes = self.sample(shingles(normalize_prompt(task, lazy_prompt), self.shingle_size))
+        signature = np.full(self.num_perm, _MAX_HASH, dtype=np.uint64)
+        for start in range(0, len(hashes), self.CHUNK):
+            permuted = (np.outer(hashes[start:start + self.CHUNK], self._a) + self._b) % _MERSENNE_PRIME & _MAX_HASH
+            np.minimum(signature, permuted.min(axis=0), out=signature)
+        return signature.astype(np.uint32)
+
+    def sample(self, hashes: np.ndarray) -> np.ndarray:
+        """At most about `max_shingles` of the shingle hashes, chosen consistently across texts."""
+        if len(hashes) <= self.max_shingles:
+            return hashes
+        # Keep hashes below 2**(32 - halvings): the same rule for every text of this
+        # length class, unlike the k smallest hashes of each text
+        halvings = int(np.ceil(np.log2(len(hashes) / self.max_shingles)))
+        return hashes[hashes < np.uint64(1 << (32 - halvings))]
+
+    async def asignature(self, task: str, lazy_prompt: str) -> np.ndarray:
+        if len(task) + len(lazy_prompt) > self.THREAD_CHARS:
+            return await asyncio.to_thread(self.signature, task, lazy_prompt)
+        return self.signature(task, lazy_prompt)
+
+    def _band_keys(self, signature: np.ndarray) -> list[bytes]:
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def add(
+        self,
+        task: str,
+        lazy_prompt: str,
+        scope: str,
+        result: str,
+        result_key: str,
+        signature: Optional[np.ndarray] = None,
+    ):
+        if signature is None:
+            signature = self.signature(task, lazy_prompt)
+        if not self._free_slots:
+            self._evict(next(iter(self._entries)))
+        slot = self._free_slots.pop()
+        self._signatures[slot] = signature
+        for band, key in zip(self._buckets, self._band_keys(signature)):
+            band.setdefault(key, set()).add(slot)
+        self._entries[slot] = (scope, result, result_key)
+
+    def _evict(self, slot: int):
+        for band, key in zip(self._buckets, self._band_keys(self._signatures[slot])):
+            members = band.get(key)
+            if members is not None:
+                members.discard(slot)
+                if not members:
+                    del band[key]
+        del self._entries[slot]
+        self._free_slots.append(slot)
+        self.evictions += 1
+
+    def query(
+        self,
+        task: str,
+        lazy_prompt: str,
+        scope: str,
+        threshold: float,
+        signature: Optional[np.ndarray] = None,
+    ) -> Optional[NearDuplicateMatch]:
+        """Best previous entry in `scope` with estimated Jaccard similarity >= threshold.
+
+        Pass the `signature` of the prompt when it is already known.
+        """
+        if signature is None:
+            signature = self.signature(task, lazy_prompt)
+        candidates: set[int] = set()
+        for band, key in zip(self._buckets, self._band_keys(signature)):
+            candidates.update(band.get(key, ()))
+        candidates = [slot for slot in candidates if self._entries[slot][0] == scope]
+        if not candidates:
+            return None
+
+        similarities = (self._signatures[candidates] == signature).mean(axis=1)
+        best = int(similarities.argmax())
+        if similarities[best] < threshold:
+            return None
+        slot = candidates[best]
+        self._entries.move_to_end(slot)
+        _, result, result_key = self._entries[slot]
+        return NearDuplicateMatch(float(similarities[best]), result, result_key)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "capacity": self.max_entries,
+            "signature_bytes": self._signatures.nbytes,
+            "evictions": self.evictions,
+        }
@@ -74,6 +74,17 @@ style_options = {
     "technique": {"Zero-Shot": "Zero-Shot - A straightforward prompt without examples.", "Few-Shot": "Few-Shot - Include a few examples to guide the model.", "Chain-of-Thought": "Chain-of-Thought - Encourage step-by-step reasoning."}
 }
 
+def _seed_prompt_section(seed_prompt: str | None) -> str:
+    """Build the reference prompt section of the user prompt."""
+    if seed_prompt:
+        return (
+            "<reference-prompt>\nAn improved prompt previously generated for a very similar input. Use it as a starting point and adapt it to the differences in this input.\n"
+            + seed_prompt
+            + "\n</reference-prompt>"
+        )
+    return ""
+
+
 def _prompt_style_section(prompt_style: dict) -> str:
     """Build the prompt style section of the user prompt."""
     if (not prompt_style) or (prompt_style.get("formatting") == 'Any' and
@@ -149,14 +160,45 @@ Here you provide the optimized, ready-to-use prompt text. DO NOT include any add
 """
     
     
-def build_enhancement_prompts(task: str, lazy_prompt: str, use_web_search: bool, additional_context: str, target_model: str, prompt_style:dict, is_reasoning_native: bool = False) -> dict[str, str]:
-    """Build system and user prompts for the prompt enhancement process."""
+# Every system prompt variant is rendered once at import. Keeping the system prompt
+# byte-identical across requests lets providers serve it from their prefix cache.
+_SYSTEM_PROMPTS = {
+    (use_web_search, is_reasoning_native, has_additional_context): _build_system_prompt(
+        use_web_search, is_reasoning_native, "additional context" if has_additional_context else ""
+    )
+    for use_web_search in (False, True)
+    for is_reasoning_native in (False, True)
+    for has_additional_context in (False, True)
+}
+
 
-    SYSTEM_PROMPT = _build_system_prompt(use_web_search, is_reasoning_native, additional_context)
+def get_system_prompt(use_web_search: bool, is_reasoning_native: bool, has_additional_context: bool) -> str:
+    """Return the precompiled system prompt for the given variant."""
+    return _SYSTEM_PROMPTS[(bool(use_web_search), bool(is_reasoning_native), bool(has_additional_context))]
+
+
+def build_enhancement_prompts(task: str, lazy_prompt: str, use_web_search: bool, additional_context: str, target_model: str, prompt_style:dict, is_reasoning_native: bool = False, seed_prompt: str | None = None) -> dict[str, str]:
+    """Build system and user prompts for the prompt enhancement process.
+
+    The user prompt is ordered from the most stable content to the most volatile
+    (instructions, target model and style, the input itself, retrieved context,
+    then the date) so that consecutive requests share the longest possible prefix.
+    """
+
+    SYSTEM_PROMPT = get_system_prompt(use_web_search, is_reasoning_native, bool(additional_context))
 
     target_model_desc = f"<target-model>{target_model}</target-model>" if target_model else ""
 
-    USER_PROMPT = f"""<input-components>
+    USER_PROMPT = f"""<instructions>
+Analyze the raw input below, determine the necessary improvements. If you need more information, CALL `get_user_input`.
+When you have enough information, generate <analysis> and <improved-prompt> following provided instructions.
+</instructions>
+
+<input-components>
+{target_model_desc}
+
+{_prompt_style_section(prompt_style)}
+
 <task>
 {task}
 </task>
@@ -166,18 +208,11 @@ def build_enhancement_prompts(task: str, lazy_prompt: str, use_web_search: bool,
 </raw_input>
 
 {_additional_context_section(additional_context)}
-
-{target_model_desc}
-
-{_prompt_style_section(prompt_style)}
 </input-components>
 
-<date>{datetime.now().strftime("%B %d, %Y")}</date>
+{_seed_prompt_section(seed_prompt)}
 
-<instructions>
-Analyze the raw input above, determine the necessary improvements. If you need more information, CALL `get_user_input`.
-When you have enough information, generate <analysis> and <improved-prompt> following provided instructions.
-</instructions>
+<date>{datetime.now().strftime("%B %d, %Y")}</date>
 """
     
     return {
@@ -204,7 +239,7 @@ Edit the prompt above based on the edit instructions. DO NOT make any changes th
 
 def build_edit_prompts(edit_instructions: str, current_prompt: str, use_web_search: bool, is_reasoning_native: bool = False) -> dict[str, str]:
     """Build system and user prompts for the prompt editing process."""
-    SYSTEM_PROMPT = _build_system_prompt(use_web_search, is_reasoning_native, additional_context=None)
+    SYSTEM_PROMPT = get_system_prompt(use_web_search, is_reasoning_native, has_additional_context=False)
     USER_PROMPT = _build_edit_user_prompt(edit_instructions, current_prompt)
     return {
         "system_prompt": SYSTEM_PROMPT,
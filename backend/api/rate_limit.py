@@ -0,0 +1,147 @@
+import abc
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from . import log
+
+PERIODS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_rate(rate: str) -> tuple[int, float]:
+    """'5/minute' -> (5, 60.0): the number of requests and the period in seconds."""
+    count, period = rate.split("/")
+    return int(count), float(PERIODS[period[0]])
+
+
+class RateLimiter(abc.ABC):
+    """Token buckets of WebSocket messages per route and client.
+
+    Each route ('enhance', 'edit', 'answer') has a rate such as '5/minute': a
+    client may send a burst of 5 and then one more every 12 seconds. Routes
+    without a rate are not limited.
+    """
+
+    def __init__(self, rates: dict[str, str]):
+        self.rates = {route: parse_rate(rate) for route, rate in rates.items()}
+        self.allowed = Counter()
+        self.rejected = Counter()
+
+    async def allow(self, route: str, client: str) -> bool:
+        """Take a token for `client` on `route`; False if it has none left."""
+        rate = self.rates.get(route)
+        if rate is None:
+            return True
+        allowed = await self._take(f"{route}:{client}", *rate)
+        (self.allowed if allowed else self.rejected)[route] += 1
+        return allowed
+
+    @abc.abstractmethod
+    async def _take(self, key: str, capacity: int, period: float) -> bool:
+        ...
+
+    def stats(self) -> dict:
+        return {
+            "backend": type(self).__name__,
+            "rates": {route: f"{capacity}/{int(period)}s" for route, (capacity, period) in self.rates.items()},
+            "allowed": dict(self.allowed),
+            "rejected": dict(self.rejected),
+        }
+
+
+class LocalRateLimiter(RateLimiter):
+    """Buckets in this process, checked on the event loop without a thread hop.
+
+    A check never awaits between reading and updating a bucket, so concurrent
+    messages cannot both take the last token. Buckets that have refilled are
+    dropped every `prune_every` checks, which keeps memory in line with the
+    clients seen in the last period.
+    """
+
+    def __init__(self, rates: dict[str, str], prune_every: int = 10000):
+        super().__init__(rates)
+        self.prune_every = prune_every
+        # key -> [tokens, updated_at, period]
+        self._buckets: dict[str, list] = {}
+        self._checks = 0
+
+    async def _take(self, key: str, capacity: int, period: float) -> bool:
+        now = time.monotonic()
+        self._checks += 1
+        if self._checks % self.prune_every == 0:
+            self._prune(now)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [float(capacity), now, period]
+        else:
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * capacity / period)
+            bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def _prune(self, now: float):
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if now - bucket[1] < bucket[2]}
+
+    def stats(self) -> dict:
+        return {**super().stats(), "buckets": len(self._buckets)}
+
+
+class RedisRateLimiter(RateLimiter):
+    """Buckets in Redis, shared by every process. Needs the `redis` package.
+
+    Each check is one script call, so it is atomic across processes and uses the
+    Redis clock rather than the clocks of the hosts.
+    """
+
+    SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local period = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or capacity
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + (now - updated_at) * capacity / period)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(period * 1000))
+return allowed
+"""
+
+    def __init__(self, rates: dict[str, str], url: str, prefix: str = "ratelimit:"):
+        super().__init__(rates)
+        try:
+            from redis import asyncio as redis
+        except ImportError as e:
+            raise ImproperlyConfigured("RedisRateLimiter needs the redis package") from e
+        self.client = redis.from_url(url)
+        self.prefix = prefix
+        self._script = self.client.register_script(self.SCRIPT)
+
+    async def _take(self, key: str, capacity: int, period: float) -> bool:
+        return bool(await self._script(keys=[self.prefix + key], args=[capacity, period]))
+
+
+_limiter: RateLimiter | None = None
+
+
+def get_rate_limiter() -> RateLimiter:
+    """The limiter configured by WS_RATE_LIMITER and WS_RATE_LIMITS, created on first use."""
+    global _limiter
+    if _limiter is None:
+        config = getattr(settings, "WS_RATE_LIMITER", {})
+        backend = import_string(config.get("BACKEND", "api.rate_limit.LocalRateLimiter"))
+        limit = getattr(settings, "WS_RATE_LIMIT", 5)
+        rates = getattr(settings, "WS_RATE_LIMITS", {"enhance": f"{limit}/minute", "edit": f"{limit}/minute"})
+        _limiter = backend(rates=rates, **config.get("OPTIONS", {}))
+        log(f"[RateLimit] Using {backend.__name__}")
+    return _limiter
@@ -0,0 +1,131 @@
+import hashlib
+import json
+from dataclasses import replace
+
+from django.conf import settings
+from django.core.cache import caches
+
+from . import log
+from .enhance import enhance_prompt_async
+from .near_duplicates import NearDuplicateIndex
+from .shared_utils import PromptConfig, serialize_messages
+
+stats = {
+    "hits": 0, "near_hits": 0, "seeded": 0, "misses": 0, "stored": 0,
+    "skipped_interactive": 0, "skipped_degraded": 0,
+}
+
+near_duplicate_index = NearDuplicateIndex(max_entries=getattr(settings, "NEAR_DUPLICATE_MAX_ENTRIES", 10000))
+
+
+def _cache():
+    return caches[getattr(settings, "ENHANCE_RESULT_CACHE", "default")]
+
+
+def _request_fields(config: PromptConfig, reasoning_effort: str) -> dict:
+    """Request parameters other than the prompt text that shape the result."""
+    return {
+        "prompt_style": config.prompt_style or {},
+        "target_model": config.target_model,
+        "model": config.model,
+        "reasoning_effort": reasoning_effort,
+        "use_web_search": config.use_web_search,
+        "additional_context_query": config.additional_context_query or "",
+        "is_reasoning_native": config.is_reasoning_native,
+    }
+
+
+def asked_user(messages: list[dict]) -> bool:
+    """Whether the model called get_user_input, answered by a user or not."""
+    return any(
+        (call.get("function") or {}).get("name") == "get_user_input"
+        for message in messages
+        for call in message.get("tool_calls") or []
+    )
+
+
+def _digest(fields: dict) -> str:
+    payload = json.dumps(fields, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def result_cache_key(task: str, lazy_prompt: str, config: PromptConfig, reasoning_effort: str) -> str:
+    """Content address of an enhancement request."""
+    fields = {"task": task, "lazy_prompt": lazy_prompt, **_request_fields(config, reasoning_effort)}
+    return "enhance_result_" + _digest(fields)
+
+
+async def enhance_prompt_cached(
+    task: str,
+    lazy_prompt: str,
+    config: PromptConfig,
+    reasoning_effort: str = "low",
+) -> tuple[str, bool, list[dict], str | None]:
+    """Serve repeated enhancement requests from the result caches.
+
+    Exact repeats come from the result cache. Near duplicates of a previous lazy
+    prompt (same request parameters, estimated Jaccard similarity above
+    NEAR_DUPLICATE_INSTANT_THRESHOLD) reuse its result, and weaker matches above
+    NEAR_DUPLICATE_SEED_THRESHOLD are passed to the model as a starting point.
+
+    Only complete runs that never asked a question are stored, since their result
+    depends on nothing but the request itself: a run that called get_user_input
+    (even without a user to answer, as in batches) or took a shortcut to stay
+    within its latency budget is not reused. Returns the usual
+    (result, is_fallback, messages) plus "exact", "near" or None for the cache hit.
+    """
+    key = result_cache_key(task, lazy_prompt, config, reasoning_effort)
+    cached = await _cache().aget(key)
+    if cached:
+        stats["hits"] += 1
+        log(f"[ResultCache] Hit for {key}")
+        return cached["result"], cached["is_fallback"], cached["messages"], "exact"
+    stats["misses"] += 1
+
+    scope = _digest(_request_fields(config, reasoning_effort))
+    signature = await near_duplicate_index.asignature(task, lazy_prompt)
+    match = near_duplicate_index.query(
+        task, lazy_prompt, scope, getattr(settings, "NEAR_DUPLICATE_SEED_THRESHOLD", 0.6), signature=signature
+    )
+    if match and match.similarity >= getattr(settings, "NEAR_DUPLICATE_INSTANT_THRESHOLD", 0.9):
+        stats["near_hits"] += 1
+        log(f"[ResultCache] Near-duplicate hit (similarity {match.similarity:.2f})")
+        near = await _cache().aget(match.result_key) or {}
+        return match.result, near.get("is_fallback", False), near.get("messages", []), "near"
+    if match:
+        stats["seeded"] += 1
+        log(f"[ResultCache] Seeding with near-duplicate result (similarity {match.similarity:.2f})")
+        config = replace(config, seed_prompt=match.result)
+
+    degraded = []
+    on_timings = config.on_timings
+
+    def capture_timings(timings: dict):
+        degraded.extend(timings.get("degraded", []))
+        if on_timings:
+            on_timings(timings)
+
+    config = replace(config, on_timings=capture_timings)
+
+    result, is_fallback, messages = await enhance_prompt_async(
+        task=task,
+        lazy_prompt=lazy_prompt,
+        config=config,
+        reasoning_effort=reasoning_effort,
+    )
+    messages = serialize_messages(messages or [])
+
+    if asked_user(messages):
+        stats["skipped_interactive"] += 1
+    elif degraded:
+        stats["skipped_degraded"] += 1
+    elif result:
+        await _cache().aset(
+            key,
+            {"result": result, "is_fallback": is_fallback, "messages": messages},
+            timeout=getattr(settings, "ENHANCE_RESULT_CACHE_TTL", 24 * 3600),
+        )
+        near_duplicate_index.add(task, lazy_prompt, scope, result, key, signature=signature)
+        stats["stored"] += 1
+
+    return result, is_fallback, messages, None
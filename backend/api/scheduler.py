@@ -0,0 +1,257 @@
+import asyncio
+import heapq
+import itertools
+import statistics
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Optional
+
+from django.conf import settings
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+LANES = (INTERACTIVE, BATCH)
+
+
+def client_key(scope) -> str:
+    """Fair-share key of a WebSocket client: its session if it has one, else its IP."""
+    session = scope.get("session")
+    if session is not None and session.session_key:
+        return f"session:{session.session_key}"
+    return f"ip:{scope.get('client', ['0.0.0.0'])[0]}"
+
+
+class _Ticket:
+    __slots__ = ("lane", "client", "tag", "seq", "enqueued_at", "granted", "cancelled", "position", "wake")
+
+    def __init__(self, lane: str, client: str, tag: float, seq: int):
+        self.lane = lane
+        self.client = client
+        self.tag = tag
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self.cancelled = False
+        self.position = 0
+        self.wake = asyncio.Event()
+
+    def __lt__(self, other: "_Ticket"):
+        return (self.tag, self.seq) < (other.tag, other.seq)
+
+
+class _Lane:
+    """Start-time fair queuing: each client's requests are tagged with a virtual
+    start time that advances by 1/weight per request, and the smallest tag goes first.
+    A client with many queued requests therefore gets its turn no more often than
+    any other client with the same weight.
+    """
+
+    def __init__(self, name: str, window: int):
+        self.name = name
+        self.heap: list[_Ticket] = []
+        self.waiting = 0
+        self.virtual_time = 0.0
+        self.finish_tags: dict[str, float] = {}
+        self.wait_seconds: deque[float] = deque(maxlen=window)
+        self.admitted = 0
+
+    def push(self, client: str, weight: float, seq: int) -> _Ticket:
+        tag = max(self.virtual_time, self.finish_tags.get(client, 0.0))
+        self.finish_tags[client] = tag + 1.0 / weight
+        ticket = _Ticket(self.name, client, tag, seq)
+        heapq.heappush(self.heap, ticket)
+        self.waiting += 1
+        return ticket
+
+    def pop(self) -> Optional[_Ticket]:
+        while self.heap:
+            ticket = heapq.heappop(self.heap)
+            if ticket.cancelled:
+                continue
+            self.waiting -= 1
+            self.virtual_time = max(self.virtual_time, ticket.tag)
+            self.wait_seconds.append(time.monotonic() - ticket.enqueued_at)
+            self.admitted += 1
+            # Clients whose tag is behind the virtual clock start from it anyway
+            self.finish_tags = {
+                client: tag for client, tag in self.finish_tags.items() if tag > self.virtual_time
+            }
+            return ticket
+        return None
+
+    def remove(self, ticket: _Ticket):
+        ticket.cancelled = True
+        self.waiting -= 1
+
+    def queued(self) -> list[_Ticket]:
+        return sorted(ticket for ticket in self.heap if not ticket.cancelled)
+
+    def stats(self) -> dict:
+        waits = list(self.wait_seconds)
+        # Cut points at every 5%: the 10th is the median, the 19th the 95th percentile
+        cuts = statistics.quantiles(waits, n=20, method="inclusive") if len(waits) > 1 else waits * 19
+        return {
+            "queued": self.waiting,
+            "admitted": self.admitted,
+            "wait_seconds": {
+                "mean": statistics.fmean(waits) if waits else None,
+                "p50": cuts[9] if waits else None,
+                "p95": cuts[18] if waits else None,
+                "max": max(waits) if waits else None,
+            },
+        }
+
+
+class Slot:
+    """A running task's claim on one of the scheduler's slots."""
+
+    def __init__(self, scheduler: "TaskScheduler", lane: str, client: str, weight: float):
+        self.scheduler = scheduler
+        self.lane = lane
+        self.client = client
+        self.weight = weight
+        self.held = False
+
+    @asynccontextmanager
+    async def suspended(self):
+        """Give the slot up while waiting on something other than the provider, such
+        as the user's answer, and queue for it again afterwards.
+
+        A task cancelled or failing while suspended does not queue again; it has
+        nothing left to run."""
+        if not self.held:
+            yield
+            return
+        self.scheduler._release(self)
+        yield
+        await self.scheduler._acquire(self)
+
+
+class TaskScheduler:
+    """Admission control for enhance and edit tasks.
+
+    At most `max_concurrency` tasks run at once. Waiting tasks in the interactive
+    lane always go before the batch lane, and within a lane clients (keyed by IP
+    or session) share the slots by weighted fair queuing, so one busy client
+    cannot crowd out the others. Waiting tasks can be told their queue position;
+    positions are recomputed at most once every `position_interval` seconds, so a
+    long queue is not re-ranked on every admission.
+    """
+
+    def __init__(self, max_concurrency: int, wait_window: int = 1000, position_interval: float = 0.5):
+        self.max_concurrency = max_concurrency
+        self.position_interval = position_interval
+        self.running = 0
+        self._lanes = {name: _Lane(name, wait_window) for name in LANES}
+        self._seq = itertools.count()
+        self._positions_at = float("-inf")
+        self._positions_timer: Optional[asyncio.TimerHandle] = None
+        self._positions_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        client: str,
+        lane: str = INTERACTIVE,
+        weight: float = 1.0,
+        on_position: Optional[Callable[[int], Awaitable[None]]] = None,
+    ):
+        """Wait for a slot, reporting each change of the 1-based queue position, and hold it."""
+        slot = Slot(self, lane, client, weight)
+        await self._acquire(slot, on_position)
+        try:
+            yield slot
+        finally:
+            if slot.held:
+                self._release(slot)
+
+    async def _acquire(self, slot: Slot, on_position: Optional[Callable[[int], Awaitable[None]]] = None):
+        lane = self._lanes[slot.lane]
+        ticket = lane.push(slot.client, slot.weight, next(self._seq))
+        self._dispatch()
+        reported = None
+        try:
+            while not ticket.granted:
+                # Position 0 means not ranked yet
+                if on_position and ticket.position and ticket.position != reported:
+                    reported = ticket.position
+                    await on_position(reported)
+                    continue
+                await ticket.wake.wait()
+                ticket.wake.clear()
+        except BaseException:
+            if ticket.granted:
+                self.running -= 1
+                self._dispatch()
+            else:
+                lane.remove(ticket)
+                self._refresh_positions()
+            raise
+        slot.held = True
+
+    def _release(self, slot: Slot):
+        slot.held = False
+        self.running -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        granted = False
+        while self.running < self.max_concurrency:
+            ticket = self._next_ticket()
+            if ticket is None:
+                break
+            ticket.granted = True
+            ticket.wake.set()
+            self.running += 1
+            granted = True
+        if granted or any(lane.waiting for lane in self._lanes.values()):
+            self._refresh_positions()
+
+    def _next_ticket(self) -> Optional[_Ticket]:
+        for name in LANES:
+            ticket = self._lanes[name].pop()
+            if ticket is not None:
+                return ticket
+        return None
+
+    def _refresh_positions(self):
+        """Have queue positions recomputed soon, at most once per `position_interval`."""
+        if self.position_interval <= 0:
+            self._update_positions()
+            return
+        loop = asyncio.get_running_loop()
+        # A timer left on a loop that has since closed would never fire
+        if self._positions_timer is not None and self._positions_loop is loop:
+            return
+        delay = max(0.0, self._positions_at + self.position_interval - time.monotonic())
+        self._positions_loop = loop
+        self._positions_timer = loop.call_later(delay, self._update_positions)
+
+    def _update_positions(self):
+        self._positions_timer = None
+        self._positions_at = time.monotonic()
+        position = 0
+        for name in LANES:
+            for ticket in self._lanes[name].queued():
+                position += 1
+                if ticket.position != position:
+                    ticket.position = position
+                    ticket.wake.set()
+
+    def queue_depth(self) -> int:
+        return sum(lane.waiting for lane in self._lanes.values())
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "running": self.running,
+            "queued": self.queue_depth(),
+            "lanes": {name: lane.stats() for name, lane in self._lanes.items()},
+        }
+
+
+scheduler = TaskScheduler(
+    max_concurrency=getattr(settings, "SCHEDULER_MAX_CONCURRENCY", 16),
+    position_interval=getattr(settings, "SCHEDULER_POSITION_INTERVAL", 0.5),
+)
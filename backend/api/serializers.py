@@ -1,5 +1,8 @@
+from django.conf import settings
 from rest_framework import serializers
 
+from .models import BatchItem
+
 
 
 class EnhancePromptRequestSerializer(serializers.Serializer):
@@ -16,4 +19,34 @@ class EnhancePromptResponseSerializer(serializers.Serializer):
 class SavePromptSerializer(serializers.Serializer):
     task = serializers.CharField(required=True)
     lazy_prompt = serializers.CharField(required=True)
-    enhanced_prompt = serializers.CharField(required=True)
\ No newline at end of file
+    enhanced_prompt = serializers.CharField(required=True)
+
+class BatchItemRequestSerializer(serializers.Serializer):
+    task = serializers.CharField(required=False, allow_blank=True, default="", max_length=255)
+    lazy_prompt = serializers.CharField(required=True)
+
+
+class BatchRequestSerializer(serializers.Serializer):
+    items = BatchItemRequestSerializer(many=True, allow_empty=False)
+    target_model = serializers.CharField(required=True)
+    use_web_search = serializers.BooleanField(required=False, default=False)
+    additional_context_query = serializers.CharField(required=False, allow_blank=True, default="")
+    reasoning_effort = serializers.ChoiceField(choices=["low", "medium", "high"], required=False, default="low")
+    is_reasoning_native = serializers.BooleanField(required=False, default=False)
+    prompt_style = serializers.DictField(required=False, default=dict)
+    concurrency = serializers.IntegerField(required=False, min_value=1)
+
+    def validate_items(self, items):
+        max_items = getattr(settings, "BATCH_MAX_ITEMS", 5000)
+        if len(items) > max_items:
+            raise serializers.ValidationError(f"A batch can hold at most {max_items} items.")
+        return items
+
+
+class BatchItemSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = BatchItem
+        fields = [
+            "index", "task", "lazy_prompt", "status", "result", "is_fallback", "cache_hit", "error",
+            "latency_seconds", "timings", "started_at", "finished_at",
+        ]
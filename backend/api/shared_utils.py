@@ -1,20 +1,69 @@
 import os
+import asyncio
+import random
+import time
+import importlib.util
+import weakref
+from collections import deque
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
 from typing import Callable, Awaitable, Optional
 import unicodedata
-import re
 
 import httpx
+import json_repair
+import openai
+from django.conf import settings
 from dotenv import load_dotenv
 from openai import OpenAI, AsyncOpenAI
+from openai.types.chat import ChatCompletionMessage, ChatCompletionMessageFunctionToolCall
 from pydantic import BaseModel
 
 from . import log
+from .caching import AsyncTTLCache
+from .extraction import parse_llm_response_XML, parse_llm_response_markdown
+from .lifecycle import on_startup, on_shutdown
+from .timings import Timings
 
 load_dotenv()
 
 FALLBACK_MODEL = "gpt-5-mini"
 
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "90"))
+# HTTP/2 needs the optional `h2` package; fall back to HTTP/1.1 keep-alive without it
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "True") == "True" and importlib.util.find_spec("h2") is not None
+
+HCAI_STATUS_URL = os.getenv("HCAI_STATUS_URL", "https://ai.hackclub.com/up")
+HEALTH_PROBE_INTERVAL = float(os.getenv("HEALTH_PROBE_INTERVAL", "30"))
+HEALTH_PROBE_TIMEOUT = float(os.getenv("HEALTH_PROBE_TIMEOUT", "5"))
+# Probe results older than this are ignored and the provider is assumed up
+HEALTH_STALENESS = float(os.getenv("HEALTH_STALENESS", "120"))
+
+TOOL_CONCURRENCY = int(os.getenv("TOOL_CONCURRENCY", "4"))
+
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "3600"))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "2048"))
+SEARCH_CACHE_MAX_BYTES = int(os.getenv("SEARCH_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+SEARCH_BASE_URL = os.getenv("SEARCH_BASE_URL", "https://search.hackclub.com")
+SEARCH_CONNECT_TIMEOUT = float(os.getenv("SEARCH_CONNECT_TIMEOUT", "3"))
+SEARCH_READ_TIMEOUT = float(os.getenv("SEARCH_READ_TIMEOUT", "8"))
+SEARCH_TOTAL_TIMEOUT = float(os.getenv("SEARCH_TOTAL_TIMEOUT", "15"))
+SEARCH_RETRIES = int(os.getenv("SEARCH_RETRIES", "2"))
+SEARCH_RETRY_BACKOFF = float(os.getenv("SEARCH_RETRY_BACKOFF", "0.25"))
+
+BREAKER_WINDOW_SECONDS = float(os.getenv("BREAKER_WINDOW_SECONDS", "60"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "5"))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+# Unset, calls count as slow past half of AGENT_LLM_CALL_TIMEOUT_SECONDS; a call that
+# reaches the timeout is recorded as a failure, so the threshold must stay below it
+BREAKER_SLOW_CALL_SECONDS = os.getenv("BREAKER_SLOW_CALL_SECONDS", "")
+BREAKER_SLOW_CALL_RATE = float(os.getenv("BREAKER_SLOW_CALL_RATE", "0.8"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+BREAKER_HALF_OPEN_TRIALS = int(os.getenv("BREAKER_HALF_OPEN_TRIALS", "1"))
+
 
 @dataclass
 class PromptConfig:
@@ -26,6 +75,11 @@ class PromptConfig:
     ask_user_func: Optional[Callable[[str], Awaitable[str]]] = None
     prompt_style: dict | None = None
     is_reasoning_native: bool = False
+    # Called as on_delta(delta, reset=...) with streamed content; reset means the
+    # text streamed before is void and this delta starts it over
+    on_delta: Optional[Callable[..., Awaitable[None]]] = None
+    seed_prompt: Optional[str] = None
+    on_timings: Optional[Callable[[dict], None]] = None
 
 
 class EnhancedPromptResponse(BaseModel):
@@ -37,41 +91,601 @@ def get_client():
     base_url = os.getenv("OPENAI_BASE_URL") or os.getenv("BASE_URL") or "https://api.openai.com/v1"
     return OpenAI(api_key=api_key, base_url=base_url)
 
-def get_async_client(fallback: bool = False) -> AsyncOpenAI:
-    if fallback:
-        return AsyncOpenAI(api_key=os.getenv("FALLBACK_API_KEY", ""))
+class _CountingTransport(httpx.AsyncHTTPTransport):
+    """httpx transport that counts requests and newly opened connections."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.requests = 0
+        self.connections_opened = 0
+        self._seen_streams = weakref.WeakSet()
+
+    async def handle_async_request(self, request):
+        response = await super().handle_async_request(request)
+        self.requests += 1
+        stream = response.extensions.get("network_stream")
+        if stream is not None and stream not in self._seen_streams:
+            self._seen_streams.add(stream)
+            self.connections_opened += 1
+        return response
+
+    def stats(self) -> dict:
+        reused = self.requests - self.connections_opened
+        return {
+            "requests": self.requests,
+            "connections_opened": self.connections_opened,
+            "connections_reused": reused,
+            "reuse_rate": reused / self.requests if self.requests else 0.0,
+            "open_connections": len(self._pool.connections),
+        }
+
+
+class ClientRegistry:
+    """Process-wide AsyncOpenAI clients keyed by (base_url, api_key).
+
+    Every client shares one keep-alive connection pool per provider, so requests after
+    the first skip the TCP and TLS handshakes.
+    """
+
+    def __init__(self):
+        self._clients: dict[tuple[str, str], AsyncOpenAI] = {}
+        self._transports: dict[tuple[str, str], _CountingTransport] = {}
+
+    def get(self, base_url: str, api_key: str) -> AsyncOpenAI:
+        key = (base_url, api_key)
+        client = self._clients.get(key)
+        if client is None:
+            transport = _CountingTransport(
+                http2=LLM_HTTP2,
+                limits=httpx.Limits(
+                    max_connections=LLM_MAX_CONNECTIONS,
+                    max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+                ),
+            )
+            http_client = httpx.AsyncClient(
+                transport=transport,
+                timeout=httpx.Timeout(600.0, connect=10.0),
+            )
+            client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+            self._clients[key] = client
+            self._transports[key] = transport
+            log(f"[Clients] Created pooled client for {base_url} (http2={LLM_HTTP2})")
+        return client
+
+    async def preconnect(self, base_url: str, api_key: str, timeout: float = 5.0):
+        """Open a pooled connection to a provider if none is idle yet."""
+        client = self.get(base_url, api_key)
+        if self._transports[(base_url, api_key)].stats()["open_connections"]:
+            return
+        try:
+            await client._client.get(
+                f"{base_url.rstrip('/')}/models",
+                headers={"Authorization": f"Bearer {api_key}"},
+                timeout=timeout,
+            )
+        except httpx.HTTPError as e:
+            log(f"[Clients] Warm-up request to {base_url} failed: {e}")
+
+    async def warm(self):
+        """Open a connection to each configured provider ahead of the first request."""
+        await self.preconnect(*_primary_provider())
+        if os.getenv("FALLBACK_API_KEY"):
+            await self.preconnect(*_fallback_provider())
+
+    async def aclose(self):
+        for client in self._clients.values():
+            await client.close()
+        self._clients.clear()
+        self._transports.clear()
+
+    def stats(self) -> list[dict]:
+        return [
+            {"base_url": base_url, "http2": LLM_HTTP2, **transport.stats()}
+            for (base_url, _), transport in self._transports.items()
+        ]
+
+
+client_registry = ClientRegistry()
+on_startup(client_registry.warm)
+on_shutdown(client_registry.aclose)
+
+
+def _primary_provider() -> tuple[str, str]:
     api_key = os.getenv("OPENAI_API_KEY") or os.getenv("API_KEY") or ""
     base_url = os.getenv("OPENAI_BASE_URL") or os.getenv("BASE_URL") or "https://api.openai.com/v1"
-    return AsyncOpenAI(api_key=api_key, base_url=base_url)
+    return base_url, api_key
+
+
+def _fallback_provider() -> tuple[str, str]:
+    base_url = os.getenv("FALLBACK_BASE_URL") or os.getenv("OPENAI_BASE_URL") or "https://api.openai.com/v1"
+    return base_url, os.getenv("FALLBACK_API_KEY", "")
+
+
+def get_async_client(fallback: bool = False) -> AsyncOpenAI:
+    if fallback:
+        return client_registry.get(*_fallback_provider())
+    return client_registry.get(*_primary_provider())
+
+
+async def preconnect_async_client(fallback: bool = False, timeout: float = 2.0):
+    """Make sure the provider's pool holds a live connection before the first LLM call."""
+    provider = _fallback_provider() if fallback else _primary_provider()
+    await client_registry.preconnect(*provider, timeout=timeout)
+
+
+def _is_provider_failure(error: Exception) -> bool:
+    """Whether an error says something about the provider's health rather than our request."""
+    if isinstance(error, (openai.APIConnectionError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500 or error.status_code == 429
+    return False
+
+
+def default_slow_call_seconds() -> float:
+    if BREAKER_SLOW_CALL_SECONDS:
+        return float(BREAKER_SLOW_CALL_SECONDS)
+    return getattr(settings, "AGENT_LLM_CALL_TIMEOUT_SECONDS", 45.0) / 2
+
+
+class CircuitBreaker:
+    """Per-provider circuit breaker driven by error rate and latency.
+
+    closed: requests flow and outcomes are recorded in a sliding time window.
+    open: the error or slow-call rate crossed its threshold; requests are rejected
+        until `open_seconds` have passed.
+    half_open: a limited number of trial requests are let through; a success closes
+        the circuit again and a failure re-opens it.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        name: str,
+        window_seconds: float = BREAKER_WINDOW_SECONDS,
+        min_calls: int = BREAKER_MIN_CALLS,
+        error_rate: float = BREAKER_ERROR_RATE,
+        slow_call_seconds: float | None = None,
+        slow_call_rate: float = BREAKER_SLOW_CALL_RATE,
+        open_seconds: float = BREAKER_OPEN_SECONDS,
+        half_open_trials: int = BREAKER_HALF_OPEN_TRIALS,
+    ):
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call_seconds = default_slow_call_seconds() if slow_call_seconds is None else slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.half_open_trials = half_open_trials
+        self.state = self.CLOSED
+        self.opened_at: Optional[float] = None
+        self.times_opened = 0
+        self.rejected = 0
+        self._calls: deque[tuple[float, bool, float]] = deque()
+        self._trials = 0
+        self._trial_started_at = 0.0
+
+    def _prune(self, now: float):
+        while self._calls and now - self._calls[0][0] > self.window_seconds:
+            self._calls.popleft()
+
+    def _open(self, now: float):
+        if self.state != self.OPEN:
+            log(f"[Breaker] {self.name} circuit opened")
+            self.times_opened += 1
+        self.state = self.OPEN
+        self.opened_at = now
+        self._trials = 0
+
+    def _close(self):
+        log(f"[Breaker] {self.name} circuit closed")
+        self.state = self.CLOSED
+        self.opened_at = None
+        self._calls.clear()
+        self._trials = 0
+
+    def is_open(self) -> bool:
+        """Whether requests are rejected right now; unlike `allow_request` it takes no trial."""
+        return self.state == self.OPEN and time.monotonic() - self.opened_at < self.open_seconds
+
+    def allow_request(self) -> bool:
+        now = time.monotonic()
+        if self.state == self.OPEN and now - self.opened_at >= self.open_seconds:
+            log(f"[Breaker] {self.name} circuit half-open, sending trial requests")
+            self.state = self.HALF_OPEN
+            self._trials = 0
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN:
+            # A trial that never reported back (e.g. cancelled) must not block recovery forever
+            if self._trials < self.half_open_trials or now - self._trial_started_at >= self.open_seconds:
+                self._trials += 1
+                self._trial_started_at = now
+                return True
+        self.rejected += 1
+        return False
+
+    def record(self, ok: bool, latency: float):
+        now = time.monotonic()
+        slow = latency >= self.slow_call_seconds
+        if self.state == self.HALF_OPEN:
+            if ok and not slow:
+                self._close()
+            else:
+                self._open(now)
+            return
+        self._calls.append((now, ok, latency))
+        self._prune(now)
+        if self.state != self.CLOSED or len(self._calls) < self.min_calls:
+            return
+        errors = sum(1 for _, call_ok, _ in self._calls if not call_ok)
+        slow_calls = sum(1 for _, _, call_latency in self._calls if call_latency >= self.slow_call_seconds)
+        if errors / len(self._calls) >= self.error_rate or slow_calls / len(self._calls) >= self.slow_call_rate:
+            self._open(now)
+
+    @asynccontextmanager
+    async def guard(self):
+        """Record the outcome and latency of the LLM call made inside the block."""
+        t_start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            if _is_provider_failure(e):
+                self.record(False, time.perf_counter() - t_start)
+            raise
+        self.record(True, time.perf_counter() - t_start)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        self._prune(now)
+        calls = len(self._calls)
+        return {
+            "name": self.name,
+            "state": self.state,
+            "window_calls": calls,
+            "error_rate": sum(1 for _, ok, _ in self._calls if not ok) / calls if calls else 0.0,
+            "slow_call_rate": sum(1 for _, _, latency in self._calls if latency >= self.slow_call_seconds) / calls if calls else 0.0,
+            "open_for": None if self.opened_at is None else now - self.opened_at,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected,
+        }
+
+
+breakers = {
+    "primary": CircuitBreaker("primary"),
+    "fallback": CircuitBreaker("fallback"),
+}
+
+
+def get_breaker(fallback: bool = False) -> CircuitBreaker:
+    return breakers["fallback" if fallback else "primary"]
+
+
+class ProviderUnavailable(Exception):
+    """No LLM provider can take the request at the moment."""
+
+    def __init__(self, message: str = "The AI provider is temporarily unavailable. Please try again in a few minutes."):
+        super().__init__(message)
+
+
+def _is_out_of_credit(error: openai.APIStatusError) -> bool:
+    return error.status_code == 402 or getattr(error, "code", None) == "insufficient_quota"
+
+
+def fallback_available() -> bool:
+    return bool(os.getenv("FALLBACK_API_KEY"))
+
+
+class ProviderSession:
+    """The provider one request is talking to.
+
+    `call` runs an LLM request through the provider's circuit breaker. When the
+    primary provider fails with an `APIStatusError` partway through, the session
+    switches to the fallback provider, converts the conversation so far with
+    `portable_messages` and retries the same request there. The request keeps
+    its completed tool calls and user answers instead of starting over.
+    """
+
+    def __init__(self, model: str, fallback: bool = False):
+        self.model = FALLBACK_MODEL if fallback else model
+        self.is_fallback = fallback
+        self.client = get_async_client(fallback=fallback)
+        self.breaker = get_breaker(fallback=fallback)
+
+    def can_fall_back(self) -> bool:
+        return not self.is_fallback and fallback_available()
+
+    def switch_to_fallback(self):
+        log(f"[Provider] Falling back to {FALLBACK_MODEL}")
+        self.is_fallback = True
+        self.model = FALLBACK_MODEL
+        self.client = get_async_client(fallback=True)
+        self.breaker = get_breaker(fallback=True)
+
+    async def call(
+        self,
+        request: Callable[[AsyncOpenAI, str], Awaitable],
+        messages: list | None = None,
+        timeout: float | None = None,
+    ):
+        """Await `request(client, model)`, resuming on the fallback provider on failure.
+
+        `messages` is the conversation the request is built from; it is converted
+        in place so the retried request and everything after it use portable dicts.
+        A call that exceeds `timeout` raises `TimeoutError` and counts against the
+        provider's circuit breaker. Every attempt asks the breaker first, so a circuit
+        that opens partway through a request moves its later calls to the fallback.
+        """
+        while True:
+            if not self.breaker.allow_request():
+                log(f"[Provider] {self.breaker.name} circuit is open")
+                if not self.can_fall_back():
+                    raise ProviderUnavailable()
+                self.switch_to_fallback()
+                if messages is not None:
+                    messages[:] = portable_messages(messages)
+                continue
+            try:
+                async with self.breaker.guard():
+                    async with asyncio.timeout(timeout):
+                        return await request(self.client, self.model)
+            except openai.APIStatusError as e:
+                log(f"APIStatusError: {e}")
+                if not self.can_fall_back():
+                    if _is_out_of_credit(e):
+                        raise Exception("We are out of money! Please try again later.") from e
+                    raise ProviderUnavailable() from e
+                self.switch_to_fallback()
+                if messages is not None:
+                    messages[:] = portable_messages(messages)
+
+class PromptCacheStats:
+    """Provider-side prompt cache usage, from `usage.prompt_tokens_details.cached_tokens`.
+
+    Time to first token is only known for streamed calls; it is tracked separately
+    for calls that did and did not hit the cache to estimate the time saved.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.cache_hit_calls = 0
+        self._ttft = {True: [0, 0.0], False: [0, 0.0]}
+
+    def record(self, usage, first_token_seconds: Optional[float] = None):
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = (getattr(details, "cached_tokens", None) or 0) if details else 0
+        self.calls += 1
+        self.prompt_tokens += usage.prompt_tokens or 0
+        self.completion_tokens += usage.completion_tokens or 0
+        self.cached_tokens += cached
+        self.cache_hit_calls += cached > 0
+        if first_token_seconds is not None:
+            bucket = self._ttft[cached > 0]
+            bucket[0] += 1
+            bucket[1] += first_token_seconds
+        log(f"[USAGE] prompt_tokens={usage.prompt_tokens} cached_tokens={cached} completion_tokens={usage.completion_tokens}")
+
+    def stats(self) -> dict:
+        def average(bucket):
+            return bucket[1] / bucket[0] if bucket[0] else None
+
+        ttft_hit, ttft_miss = average(self._ttft[True]), average(self._ttft[False])
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cached_token_rate": self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+            "cache_hit_calls": self.cache_hit_calls,
+            "avg_ttft_cache_hit": ttft_hit,
+            "avg_ttft_cache_miss": ttft_miss,
+            "ttft_saved": ttft_miss - ttft_hit if ttft_hit is not None and ttft_miss is not None else None,
+        }
+
+
+prompt_cache_stats = PromptCacheStats()
+
+
+async def create_chat_completion(
+    client: AsyncOpenAI,
+    on_delta: Optional[Callable[[str], Awaitable[None]]] = None,
+    **kwargs,
+) -> ChatCompletionMessage:
+    """Run a chat completion and return the assistant message.
+
+    When `on_delta` is given the request is streamed: content deltas are forwarded
+    as they arrive and tool call fragments are stitched back together, so the caller
+    gets the same message shape as a non-streaming call.
+    """
+    t_start = time.perf_counter()
+    if on_delta is None:
+        response = await client.chat.completions.create(**kwargs)
+        prompt_cache_stats.record(response.usage)
+        return response.choices[0].message
+
+    stream = await client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **kwargs)
+    content_parts: list[str] = []
+    tool_calls: dict[int, dict] = {}
+    usage = None
+    first_token_seconds = None
+    async for chunk in stream:
+        if first_token_seconds is None:
+            first_token_seconds = time.perf_counter() - t_start
+        if chunk.usage:
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta.content:
+            content_parts.append(delta.content)
+            await on_delta(delta.content)
+        for position, tool_call_delta in enumerate(delta.tool_calls or []):
+            index = tool_call_delta.index if tool_call_delta.index is not None else position
+            entry = tool_calls.setdefault(index, {"id": "", "name": "", "arguments": "", "extra": {}})
+            if tool_call_delta.id:
+                entry["id"] = tool_call_delta.id
+            if tool_call_delta.function:
+                entry["name"] += tool_call_delta.function.name or ""
+                entry["arguments"] += tool_call_delta.function.arguments or ""
+            # Keep provider specific fields (e.g. thought signatures) so they are sent back
+            entry["extra"].update(tool_call_delta.model_extra or {})
+
+    prompt_cache_stats.record(usage, first_token_seconds)
+    content = "".join(content_parts)
+    return ChatCompletionMessage(
+        role="assistant",
+        content=content if content or not tool_calls else None,
+        tool_calls=[
+            ChatCompletionMessageFunctionToolCall(
+                id=entry["id"],
+                type="function",
+                function={"name": entry["name"], "arguments": entry["arguments"]},
+                **entry["extra"],
+            )
+            for _, entry in sorted(tool_calls.items())
+        ] or None,
+    )
 
 def get_model() -> str:
     return os.getenv("OPENAI_MODEL") or os.getenv("MODEL") or "gpt-5.1"
 
+class _ControlCharacterTable(dict):
+    """`str.translate` table deleting control characters, filled in as code points are seen.
+
+    Newlines, carriage returns and tabs are kept. The "C" categories span close to a
+    million code points (mostly unassigned and private use), too many to build up
+    front, so each code point is classified once on first use. Growth stops at
+    `max_size` entries; past that, new code points are classified on every lookup.
+    """
+
+    def __init__(self, max_size: int = 65536):
+        super().__init__()
+        self.max_size = max_size
+
+    def __missing__(self, code_point: int):
+        char = chr(code_point)
+        value = None if unicodedata.category(char)[0] == 'C' and char not in '\n\r\t' else char
+        if len(self) < self.max_size:
+            self[code_point] = value
+        return value
+
+
+_CONTROL_TABLE = _ControlCharacterTable()
+
+
 def clean_text_for_llm(text):
     # Normalize Unicode
     text = unicodedata.normalize('NFKC', text)
-    
-    # Remove control characters except newlines/tabs
-    text = ''.join(c for c in text if unicodedata.category(c)[0] != 'C' or c in '\n\r\t')
-    
-    # Remove zero-width characters
-    text = re.sub(r'[\u200b-\u200d\ufeff]', '', text)
-    
-    # Normalize whitespace
-    text = re.sub(r'\s+', ' ', text)
-    
-    return text.strip()
+
+    # Remove control characters except newlines/tabs. Zero-width characters are Cf
+    # and go with them
+    text = text.translate(_CONTROL_TABLE)
+
+    # Collapse whitespace and trim; str.split() uses the same whitespace definition as \s
+    return ' '.join(text.split())
+
+class SearchClient:
+    """Long-lived, pooled HTTP client for the search API.
+
+    Each search is bounded by connect/read timeouts per attempt and by `total_timeout`
+    overall. Transport errors, 429s and 5xx responses are retried with jittered
+    exponential backoff.
+    """
+
+    def __init__(
+        self,
+        base_url: str = SEARCH_BASE_URL,
+        connect_timeout: float = SEARCH_CONNECT_TIMEOUT,
+        read_timeout: float = SEARCH_READ_TIMEOUT,
+        total_timeout: float = SEARCH_TOTAL_TIMEOUT,
+        retries: int = SEARCH_RETRIES,
+        backoff: float = SEARCH_RETRY_BACKOFF,
+        transport: httpx.AsyncBaseTransport | None = None,
+    ):
+        self.base_url = base_url
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.total_timeout = total_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.transport = transport
+        self.retried = 0
+        self._client: httpx.AsyncClient | None = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=50, max_keepalive_connections=10, keepalive_expiry=60),
+                transport=self.transport,
+            )
+        return self._client
+
+    async def search(self, query: str) -> dict:
+        return await asyncio.wait_for(self._search_with_retries(query), timeout=self.total_timeout)
+
+    async def _search_with_retries(self, query: str) -> dict:
+        client = self._get_client()
+        for attempt in range(self.retries + 1):
+            retryable = attempt < self.retries
+            try:
+                response = await client.get(
+                    "/res/v1/web/search",
+                    params={"q": query},
+                    headers={"Authorization": f'Bearer {os.getenv("HACKCLUB_SEARCH_API_KEY", "")}'},
+                )
+                if retryable and (response.status_code == 429 or response.status_code >= 500):
+                    log(f"[Search] Attempt {attempt + 1} got HTTP {response.status_code}, retrying...")
+                else:
+                    response.raise_for_status()
+                    return response.json()
+            except httpx.TransportError as e:
+                if not retryable:
+                    raise
+                log(f"[Search] Attempt {attempt + 1} failed: {e!r}, retrying...")
+            self.retried += 1
+            await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+search_client = SearchClient()
+on_shutdown(search_client.aclose)
+
+search_cache = AsyncTTLCache(
+    ttl=SEARCH_CACHE_TTL,
+    max_entries=SEARCH_CACHE_MAX_ENTRIES,
+    max_bytes=SEARCH_CACHE_MAX_BYTES,
+)
+
+
+def _normalize_query(query: str) -> str:
+    return " ".join(query.split()).casefold()
+
 
 async def web_search_async(query: str, n=3) -> str:
+    """Web search with results cached per normalized query and `n`."""
+    return await search_cache.get_or_load(
+        (_normalize_query(query), n),
+        lambda: _web_search_uncached(query, n),
+    )
+
+
+async def _web_search_uncached(query: str, n: int) -> str:
     log(f"Performing async web search for query: {query}")
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            'https://search.hackclub.com/res/v1/web/search',
-            params={'q': query},
-            headers={'Authorization': f'Bearer {os.getenv("HACKCLUB_SEARCH_API_KEY", "")}'},
-        )
-    response.raise_for_status()
-    data = response.json()
+    data = await search_client.search(query)
     
     data = [(item["title"], "\n".join(item["extra_snippets"]) if "extra_snippets" in item else item["description"]) for item in data["web"]["results"][:n]]
     data = [(clean_text_for_llm(title), clean_text_for_llm(snippets)) for title, snippets in data]
@@ -79,79 +693,219 @@ async def web_search_async(query: str, n=3) -> str:
     
     return data_str
 
+def serialize_messages(messages: list) -> list[dict]:
+    """Convert a conversation that may hold SDK message objects into plain dicts."""
+    serializable_messages = []
+    for msg in messages:
+        if hasattr(msg, 'model_dump'):
+            serializable_messages.append(msg.model_dump(mode="json"))
+        elif isinstance(msg, dict):
+            serializable_messages.append(msg)
+        else:
+            serializable_messages.append(str(msg))
+    return serializable_messages
+
+
+_PORTABLE_MESSAGE_FIELDS = ("role", "content", "name", "tool_call_id")
+
+
+def portable_message(message) -> dict:
+    """An OpenAI-style message dict with only the fields every compatible provider accepts.
+
+    Provider-specific extras such as reasoning content, refusals, annotations or
+    audio are dropped, and tool calls are reduced to id, type and function.
+    """
+    data = message.model_dump(mode="json") if hasattr(message, "model_dump") else dict(message)
+    portable = {field: data[field] for field in _PORTABLE_MESSAGE_FIELDS if data.get(field) is not None}
+    portable.setdefault("content", None if data.get("tool_calls") else "")
+    if data.get("tool_calls"):
+        portable["tool_calls"] = [
+            {
+                "id": call["id"],
+                "type": "function",
+                "function": {
+                    "name": call["function"]["name"],
+                    "arguments": call["function"].get("arguments") or "{}",
+                },
+            }
+            for call in data["tool_calls"]
+        ]
+    return portable
+
+
+def portable_messages(messages: list) -> list[dict]:
+    return [portable_message(message) for message in messages]
+
 def format_answers_for_llm(questions:list[str], answers: list[str] | str) -> str:
     if answers == "CANCEL":
         return "User refused to answer the questions."
+    if isinstance(answers, str):
+        return answers
     if len(answers) == 1:
         return answers[0]
     else:
         return "\n".join([f"Q: {q}\nA: {answer if answer else 'User did not provide an answer for this question.'}" for q, answer in zip(questions, answers)])
 
-def parse_llm_response_XML(response: str) -> str | None:
-    improved_prompt_match = re.search(r"<improved-prompt>(.*?)</improved-prompt>", response, re.DOTALL)
-    if improved_prompt_match:
-        improved_prompt = improved_prompt_match.group(1).strip()
-        log(f"[DEBUG] Parsed Improved Prompt: {improved_prompt[:50]}...")
-        return improved_prompt
-    else:
-        log("[DEBUG] No <improved-prompt> tag found in LLM response.")
-        return None
+async def run_tool_calls(
+    tool_calls: list,
+    config: PromptConfig,
+    timings: Timings,
+    turn: int,
+    tool_timeout: float | None = None,
+) -> list[dict]:
+    """Execute the tool calls of one LLM turn and return their tool messages in call order.
 
-def parse_llm_response_markdown(response: str) -> str | None:
-    marker_pattern = re.compile(
-        r"^\s*(?:[-*+]\s*)?(?:\*{1,2}\s*)?(?:[-*+]\s*)?(?:#{1,6}\s*)?Improved\s+Prompt(?:\s*\*{1,2})?\s*:?\s*(?:\*{1,2})?\s*(.*)$",
-        re.IGNORECASE,
-    )
+    `web_search` calls run concurrently (at most TOOL_CONCURRENCY at a time), each
+    limited to `tool_timeout` seconds, and all `get_user_input` calls are merged
+    into a single question frame.
+    """
+    results: dict[str, str] = {}
+    semaphore = asyncio.Semaphore(TOOL_CONCURRENCY)
+    search_calls = [call for call in tool_calls if call.function.name == "web_search"]
+    question_calls = [call for call in tool_calls if call.function.name == "get_user_input"]
 
-    next_section_pattern = re.compile(
-        r"^\s*(?:\*{1,2})?\s*(?:#{1,6}\s*)?[A-Z][A-Za-z0-9\s/&()_-]{1,48}\s*:?\s*(?:\*{1,2})?\s*$"
-    )
+    async def search(index: int, tool_call):
+        args = json_repair.loads(tool_call.function.arguments)
+        async with semaphore:
+            with timings.step("web_search", turn=turn, index=index):
+                try:
+                    search_result = await asyncio.wait_for(web_search_async(args["query"]), tool_timeout)
+                except (httpx.HTTPError, asyncio.TimeoutError) as e:
+                    log(f"[DEBUG] Web search failed: {e!r}")
+                    search_result = "Web search failed. Continue without these results."
+        log(f"[DEBUG] Tool Result ({tool_call.function.name}): {search_result[:100]}...")
+        results[tool_call.id] = search_result
 
-    lines = response.splitlines()
-    for idx, line in enumerate(lines):
-        marker_match = marker_pattern.match(line)
-        if not marker_match:
-            continue
+    async def ask():
+        questions_per_call = [json_repair.loads(call.function.arguments)["questions"] for call in question_calls]
+        questions = [question for call_questions in questions_per_call for question in call_questions]
+        log("Asking user question via WebSocket...")
+        with timings.step("get_user_input", turn=turn):
+            if config.ask_user_func:
+                answers = await config.ask_user_func(questions)
+            else:
+                answers = "(No user input handler available)"
 
-        inline_value = marker_match.group(1).strip()
-        if inline_value:
-            if inline_value.startswith("**Prompt:**"):
-                inline_value = inline_value[len("**Prompt:**"):].strip()
-            if inline_value:
-                log(f"[DEBUG] Parsed Improved Prompt from Markdown inline label: {inline_value[:50]}...")
-                return inline_value
-
-        collected: list[str] = []
-        in_code_fence = False
-        for next_line in lines[idx + 1:]:
-            stripped = next_line.strip()
-
-            if stripped.startswith("```"):
-                in_code_fence = not in_code_fence
-                continue
+        # Hand every tool call the answers to its own questions
+        offset = 0
+        for tool_call, call_questions in zip(question_calls, questions_per_call):
+            call_answers = answers
+            if isinstance(answers, list):
+                call_answers = answers[offset:offset + len(call_questions)]
+                offset += len(call_questions)
+            results[tool_call.id] = format_answers_for_llm(call_questions, call_answers)
+            log(f"[DEBUG] Tool Result ({tool_call.function.name}): {results[tool_call.id]}")
+
+    for tool_call in tool_calls:
+        log(f"[DEBUG] Processing Tool Call (Async): {tool_call.function.name} with args: {tool_call.function.arguments}")
+
+    jobs = [search(index, tool_call) for index, tool_call in enumerate(search_calls, start=1)]
+    if question_calls:
+        jobs.append(ask())
+    await asyncio.gather(*jobs)
+
+    return [
+        {
+            "role": "tool",
+            "tool_call_id": tool_call.id,
+            "content": results.get(tool_call.id, f"Unknown tool: {tool_call.function.name}"),
+        }
+        for tool_call in tool_calls
+    ]
 
-            if not in_code_fence and next_section_pattern.match(next_line) and stripped:
-                break
+class HealthProber:
+    """Polls a provider status endpoint in the background and answers from memory.
 
-            collected.append(next_line)
+    Requests never wait on a probe: while no fresh result is available the provider
+    is assumed up and failures are left to the normal error handling.
+    """
 
-        improved_prompt = "\n".join(collected).strip()
-        if improved_prompt.startswith("**Prompt:**"):
-            improved_prompt = improved_prompt[len("**Prompt:**"):].strip()
+    def __init__(
+        self,
+        url: str,
+        interval: float = HEALTH_PROBE_INTERVAL,
+        staleness: float = HEALTH_STALENESS,
+        timeout: float = HEALTH_PROBE_TIMEOUT,
+        transport: httpx.AsyncBaseTransport | None = None,
+    ):
+        self.url = url
+        self.interval = interval
+        self.staleness = staleness
+        self.timeout = timeout
+        self.transport = transport
+        self.status: Optional[bool] = None
+        self.checked_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.probes = 0
+        self._client: httpx.AsyncClient | None = None
+        self._task: asyncio.Task | None = None
+
+    async def probe(self) -> bool:
+        if self._client is None:
+            self._client = httpx.AsyncClient(transport=self.transport, timeout=self.timeout)
+        try:
+            response = await self._client.get(self.url)
+            status = response.json().get("status", "down") == "up"
+            self.last_error = None
+        except (httpx.HTTPError, ValueError) as e:
+            log(f"[Health] Probe of {self.url} failed: {e}")
+            status = False
+            self.last_error = str(e)
+        self.status = status
+        self.checked_at = time.monotonic()
+        self.probes += 1
+        return status
+
+    async def _run(self):
+        while True:
+            await self.probe()
+            await asyncio.sleep(self.interval)
+
+    def _ensure_running(self):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def start(self):
+        self._ensure_running()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def is_fresh(self) -> bool:
+        return self.checked_at is not None and time.monotonic() - self.checked_at <= self.staleness
+
+    def is_up(self) -> bool:
+        self._ensure_running()
+        if not self.is_fresh():
+            return True
+        return bool(self.status)
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "status": None if not self.is_fresh() else ("up" if self.status else "down"),
+            "age": None if self.checked_at is None else time.monotonic() - self.checked_at,
+            "probes": self.probes,
+            "last_error": self.last_error,
+        }
 
-        if improved_prompt:
-            log(f"[DEBUG] Parsed Improved Prompt from Markdown block: {improved_prompt[:50]}...")
-            return improved_prompt
 
-        log("[DEBUG] Found Improved Prompt label but no prompt content.")
-        return None
+hcai_prober = HealthProber(HCAI_STATUS_URL)
+on_startup(hcai_prober.start)
+on_shutdown(hcai_prober.stop)
 
-    log("[DEBUG] No markdown Improved Prompt label found in LLM response.")
-    return None
 
 def check_hcai_status() -> bool:
-    res = httpx.get("https://ai.hackclub.com/up").json()
-    return res.get("status", "down") == "up"
+    return hcai_prober.is_up()
 
 def get_tools(use_web_search: bool):
     tools = [
@@ -1,6 +1,61 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import io
+import json
+import random
+import re
+import string
+import sys
+import tempfile
+import unicodedata
+import time
+from datetime import timedelta
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
 
-from .shared_utils import parse_llm_response_markdown
+import httpx
+import numpy as np
+from channels.layers import get_channel_layer
+from channels.routing import ChannelNameRouter, URLRouter
+from channels.testing import WebsocketCommunicator
+from channels.worker import Worker
+import openai
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from openai.types.chat import ChatCompletionChunk, ChatCompletionMessage
+
+from . import agent_loop, batch, conversations, edit, enhance, history_codec, jobs, rate_limit, result_cache, shared_utils
+from .agent_loop import AgentLoop, BudgetExhausted, LoopLimits, get_loop_limits
+from .batch import batch_runner
+from .workers import EnhanceWorker
+from .caching import AsyncTTLCache
+from .conversations import MemoryConversationStore, SQLiteConversationStore
+from .jobs import Job
+from .management.commands import enhance_jsonl
+from .extraction import OutputExtractor, parse_llm_response, parse_response
+from .models import BatchItem, BatchJob
+from .near_duplicates import NearDuplicateIndex, shingles
+from .rate_limit import LocalRateLimiter, parse_rate
+from .prompt import build_enhancement_prompts, get_system_prompt
+from .scheduler import BATCH, TaskScheduler
+from .timings import Timings
+from .token_budget import ELIDED_DRAFT, TokenBudget, estimate_tokens
+from .shared_utils import (
+	CircuitBreaker,
+	ClientRegistry,
+	HealthProber,
+	PromptCacheStats,
+	PromptConfig,
+	ProviderSession,
+	ProviderUnavailable,
+	SearchClient,
+	create_chat_completion,
+	parse_llm_response_markdown,
+	run_tool_calls,
+)
 
 # Create your tests here.
 
@@ -37,3 +92,1753 @@ class ParseLlmResponseMarkdownTests(TestCase):
 	def test_returns_none_when_marker_has_no_content(self):
 		response = "- Improved Prompt:\n```markdown\n```"
 		self.assertIsNone(parse_llm_response_markdown(response))
+
+
+def _chunk(delta):
+	return ChatCompletionChunk.model_validate({
+		"id": "chunk",
+		"object": "chat.completion.chunk",
+		"created": 0,
+		"model": "test",
+		"choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+	})
+
+
+class _FakeStream:
+	def __init__(self, chunks):
+		self.chunks = chunks
+
+	def __aiter__(self):
+		return self._iterate()
+
+	async def _iterate(self):
+		for chunk in self.chunks:
+			yield chunk
+
+
+def _fake_client(chunks):
+	async def create(**kwargs):
+		assert kwargs["stream"] is True
+		return _FakeStream(chunks)
+	return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+class CreateChatCompletionStreamingTests(TestCase):
+	async def test_forwards_content_deltas(self):
+		deltas = []
+
+		async def on_delta(delta):
+			deltas.append(delta)
+
+		client = _fake_client([_chunk({"content": "Improved "}), _chunk({"content": "Prompt"}), _chunk({})])
+		message = await create_chat_completion(client, on_delta, model="test", messages=[])
+
+		self.assertEqual(deltas, ["Improved ", "Prompt"])
+		self.assertEqual(message.content, "Improved Prompt")
+		self.assertIsNone(message.tool_calls)
+
+	async def test_stitches_tool_call_fragments(self):
+		async def on_delta(delta):
+			pass
+
+		client = _fake_client([
+			_chunk({"tool_calls": [{"index": 0, "id": "call_1", "type": "function", "function": {"name": "web_search", "arguments": '{"que'}}]}),
+			_chunk({"tool_calls": [{"index": 0, "function": {"arguments": 'ry": "x"}'}}]}),
+			_chunk({"tool_calls": [{"index": 1, "id": "call_2", "type": "function", "function": {"name": "get_user_input", "arguments": "{}"}}]}),
+		])
+		message = await create_chat_completion(client, on_delta, model="test", messages=[])
+
+		self.assertIsNone(message.content)
+		self.assertEqual([call.id for call in message.tool_calls], ["call_1", "call_2"])
+		self.assertEqual(message.tool_calls[0].function.arguments, '{"query": "x"}')
+		self.assertEqual(message.tool_calls[1].function.name, "get_user_input")
+
+
+class ClientRegistryTests(TestCase):
+	async def test_reuses_client_per_provider(self):
+		registry = ClientRegistry()
+		first = registry.get("https://a.example/v1", "key-a")
+		self.assertIs(registry.get("https://a.example/v1", "key-a"), first)
+		self.assertIsNot(registry.get("https://a.example/v1", "key-b"), first)
+		self.assertIsNot(registry.get("https://b.example/v1", "key-a"), first)
+		await registry.aclose()
+		self.assertEqual(registry.stats(), [])
+
+	async def test_reports_pool_stats(self):
+		registry = ClientRegistry()
+		registry.get("https://a.example/v1", "key-a")
+		stats = registry.stats()
+		self.assertEqual(len(stats), 1)
+		self.assertEqual(stats[0]["base_url"], "https://a.example/v1")
+		self.assertEqual(stats[0]["requests"], 0)
+		self.assertEqual(stats[0]["reuse_rate"], 0.0)
+		self.assertNotIn("key-a", str(stats))
+		await registry.aclose()
+
+	def test_metrics_endpoint(self):
+		_use_temporary_conversation_store(self)
+		response = self.client.get("/api/metrics/")
+		self.assertEqual(response.status_code, 200)
+		self.assertIn("llm_pools", response.json())
+
+
+def _status_transport(status):
+	return httpx.MockTransport(lambda request: httpx.Response(200, json={"status": status}))
+
+
+class HealthProberTests(TestCase):
+	async def test_reports_probed_status(self):
+		prober = HealthProber("http://stub/up", transport=_status_transport("down"))
+		self.assertFalse(await prober.probe())
+		self.assertFalse(prober.is_up())
+		await prober.stop()
+
+	async def test_assumes_up_when_stale_or_unknown(self):
+		prober = HealthProber("http://stub/up", staleness=0.0, transport=_status_transport("down"))
+		self.assertTrue(prober.is_up())
+		await prober.probe()
+		await asyncio.sleep(0.01)
+		self.assertTrue(prober.is_up())
+		await prober.stop()
+
+	async def test_probe_failure_marks_down(self):
+		def fail(request):
+			raise httpx.ConnectError("unreachable")
+
+		prober = HealthProber("http://stub/up", transport=httpx.MockTransport(fail))
+		self.assertFalse(await prober.probe())
+		self.assertEqual(prober.stats()["status"], "down")
+		self.assertIn("unreachable", prober.stats()["last_error"])
+		await prober.stop()
+
+
+def _status_error(status_code):
+	request = httpx.Request("POST", "http://stub/chat/completions")
+	return openai.APIStatusError("error", response=httpx.Response(status_code, request=request), body=None)
+
+
+class CircuitBreakerTests(TestCase):
+	def test_opens_on_error_rate_and_rejects(self):
+		breaker = CircuitBreaker("test", min_calls=4, error_rate=0.5, open_seconds=60)
+		for ok in (True, False, True, False):
+			breaker.record(ok, 0.1)
+		self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+		self.assertFalse(breaker.allow_request())
+		self.assertEqual(breaker.stats()["rejected"], 1)
+
+	def test_opens_on_slow_calls(self):
+		breaker = CircuitBreaker("test", min_calls=2, slow_call_seconds=1.0, slow_call_rate=1.0)
+		breaker.record(True, 2.0)
+		breaker.record(True, 3.0)
+		self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+	def test_slow_calls_within_the_call_timeout_open_it_by_default(self):
+		breaker = CircuitBreaker("test")
+		llm_call_seconds = get_loop_limits().llm_call_seconds
+		self.assertLess(breaker.slow_call_seconds, llm_call_seconds)
+		for _ in range(breaker.min_calls):
+			breaker.record(True, llm_call_seconds * 0.9)
+		self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+	def test_half_open_trial_closes_or_reopens(self):
+		breaker = CircuitBreaker("test", min_calls=1, open_seconds=0.0, half_open_trials=1)
+		breaker.record(False, 0.1)
+		self.assertTrue(breaker.allow_request())
+		self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+		breaker.record(False, 0.1)
+		self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+		self.assertTrue(breaker.allow_request())
+		breaker.record(True, 0.1)
+		self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+	async def test_guard_only_counts_provider_failures(self):
+		breaker = CircuitBreaker("test", min_calls=1)
+		with self.assertRaises(openai.APIStatusError):
+			async with breaker.guard():
+				raise _status_error(400)
+		self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+		with self.assertRaises(openai.APIStatusError):
+			async with breaker.guard():
+				raise _status_error(503)
+		self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+
+def _tool_call(call_id, name, arguments):
+	return SimpleNamespace(id=call_id, function=SimpleNamespace(name=name, arguments=arguments))
+
+
+class RunToolCallsTests(TestCase):
+	async def test_searches_run_concurrently_and_keep_call_order(self):
+		running = 0
+		peak = 0
+
+		async def fake_search(query, n=3):
+			nonlocal running, peak
+			running += 1
+			peak = max(peak, running)
+			# Later queries finish first
+			await asyncio.sleep(0.03 if query == "first" else 0.01)
+			running -= 1
+			return f"results for {query}"
+
+		calls = [
+			_tool_call("a", "web_search", '{"query": "first"}'),
+			_tool_call("b", "web_search", '{"query": "second"}'),
+			_tool_call("c", "web_search", '{"query": "third"}'),
+		]
+		with mock.patch.object(shared_utils, "web_search_async", fake_search):
+			tool_messages = await run_tool_calls(calls, PromptConfig(model="test"), Timings("test"), 1)
+
+		self.assertEqual(peak, 3)
+		self.assertEqual([m["tool_call_id"] for m in tool_messages], ["a", "b", "c"])
+		self.assertEqual(tool_messages[0]["content"], "results for first")
+
+	async def test_merges_user_questions_into_one_frame(self):
+		asked = []
+
+		async def ask_user(questions):
+			asked.append(questions)
+			return ["red", "tall", "ten"]
+
+		calls = [
+			_tool_call("a", "get_user_input", '{"questions": ["Color?"]}'),
+			_tool_call("b", "get_user_input", '{"questions": ["Height?", "Age?"]}'),
+		]
+		config = PromptConfig(model="test", ask_user_func=ask_user)
+		tool_messages = await run_tool_calls(calls, config, Timings("test"), 1)
+
+		self.assertEqual(asked, [["Color?", "Height?", "Age?"]])
+		self.assertEqual(tool_messages[0]["content"], "red")
+		self.assertEqual(tool_messages[1]["content"], "Q: Height?\nA: tall\nQ: Age?\nA: ten")
+
+
+class AsyncTTLCacheTests(TestCase):
+	async def test_hits_after_first_load(self):
+		cache = AsyncTTLCache(ttl=60)
+		loads = []
+
+		async def loader():
+			loads.append(1)
+			return "value"
+
+		self.assertEqual(await cache.get_or_load("key", loader), "value")
+		self.assertEqual(await cache.get_or_load("key", loader), "value")
+		self.assertEqual(len(loads), 1)
+		self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+	async def test_expired_entries_are_reloaded(self):
+		cache = AsyncTTLCache(ttl=0)
+		await cache.get_or_load("key", lambda: asyncio.sleep(0, "old"))
+		self.assertEqual(await cache.get_or_load("key", lambda: asyncio.sleep(0, "new")), "new")
+		self.assertEqual(cache.misses, 2)
+
+	def test_evicts_least_recently_used(self):
+		cache = AsyncTTLCache(ttl=60, max_entries=2)
+		cache.set("a", "1")
+		cache.set("b", "2")
+		cache.get("a")
+		cache.set("c", "3")
+		self.assertIsNone(cache.get("b"))
+		self.assertEqual(cache.get("a"), "1")
+		self.assertEqual(cache.evictions, 1)
+
+	def test_evicts_by_size(self):
+		cache = AsyncTTLCache(ttl=60, max_bytes=10)
+		cache.set("a", "x" * 6)
+		cache.set("b", "y" * 6)
+		self.assertIsNone(cache.get("a"))
+		self.assertEqual(cache.bytes, 6)
+
+	async def test_coalesces_concurrent_loads(self):
+		cache = AsyncTTLCache(ttl=60)
+		loads = []
+
+		async def loader():
+			loads.append(1)
+			await asyncio.sleep(0.01)
+			return "value"
+
+		results = await asyncio.gather(*(cache.get_or_load("key", loader) for _ in range(5)))
+		self.assertEqual(results, ["value"] * 5)
+		self.assertEqual(len(loads), 1)
+		self.assertEqual(cache.coalesced, 4)
+
+	async def test_failed_loads_are_not_cached(self):
+		cache = AsyncTTLCache(ttl=60)
+
+		async def failing():
+			raise RuntimeError("boom")
+
+		with self.assertRaises(RuntimeError):
+			await cache.get_or_load("key", failing)
+		self.assertEqual(await cache.get_or_load("key", lambda: asyncio.sleep(0, "ok")), "ok")
+
+	async def test_web_search_cache_normalizes_queries(self):
+		calls = []
+
+		async def fake_search(query, n):
+			calls.append(query)
+			return f"results for {query}"
+
+		shared_utils.search_cache.clear()
+		with mock.patch.object(shared_utils, "_web_search_uncached", fake_search):
+			first = await shared_utils.web_search_async("Rice University  values")
+			second = await shared_utils.web_search_async(" rice university values ")
+		self.assertEqual(first, second)
+		self.assertEqual(len(calls), 1)
+		shared_utils.search_cache.clear()
+
+
+class SearchClientTests(TestCase):
+	async def test_retries_server_errors(self):
+		responses = [httpx.Response(503), httpx.Response(200, json={"web": {"results": []}})]
+		seen = []
+
+		def handler(request):
+			seen.append(request.url)
+			return responses.pop(0)
+
+		client = SearchClient(base_url="http://search.local", backoff=0, transport=httpx.MockTransport(handler))
+		self.assertEqual(await client.search("query"), {"web": {"results": []}})
+		self.assertEqual(str(seen[0]), "http://search.local/res/v1/web/search?q=query")
+		self.assertEqual(client.retried, 1)
+		await client.aclose()
+
+	async def test_gives_up_after_retries(self):
+		def handler(request):
+			raise httpx.ConnectError("refused")
+
+		client = SearchClient(base_url="http://search.local", retries=1, backoff=0, transport=httpx.MockTransport(handler))
+		with self.assertRaises(httpx.ConnectError):
+			await client.search("query")
+		await client.aclose()
+
+	async def test_total_timeout_bounds_a_hung_server(self):
+		async def handler(request):
+			await asyncio.sleep(1)
+			return httpx.Response(200, json={})
+
+		client = SearchClient(base_url="http://search.local", total_timeout=0.05, transport=httpx.MockTransport(handler))
+		with self.assertRaises(asyncio.TimeoutError):
+			await client.search("query")
+		await client.aclose()
+
+
+def _completion_client(content, seen_messages=None):
+	async def create(**kwargs):
+		if seen_messages is not None:
+			seen_messages.append(list(kwargs["messages"]))
+		message = ChatCompletionMessage(role="assistant", content=content)
+		return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+	return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+class EnhancePipelineTests(TestCase):
+	async def test_context_search_overlaps_client_setup(self):
+		seen_messages = []
+
+		async def slow_search(query, n=3):
+			await asyncio.sleep(0.1)
+			return f"context for {query}"
+
+		async def slow_preconnect(fallback=False, timeout=2.0):
+			await asyncio.sleep(0.1)
+
+		client = _completion_client('{"analysis": "vague", "improved_prompt": "Better prompt"}', seen_messages)
+		with mock.patch.object(enhance, "web_search_async", slow_search), \
+				mock.patch.object(enhance, "preconnect_async_client", slow_preconnect), \
+				mock.patch.object(shared_utils, "get_async_client", lambda fallback=False: client), \
+				mock.patch.object(agent_loop, "check_hcai_status", lambda: True):
+			t_start = time.perf_counter()
+			result, is_fallback, _ = await enhance.enhance_prompt_async(
+				"task", "lazy prompt", PromptConfig(model="test", additional_context_query="rice values")
+			)
+			elapsed = time.perf_counter() - t_start
+
+		self.assertEqual(result, "Better prompt")
+		self.assertFalse(is_fallback)
+		self.assertLess(elapsed, 0.18)
+		self.assertIn("context for rice values", seen_messages[0][1]["content"])
+
+	async def test_fallback_resumes_the_conversation(self):
+		questions_asked = []
+		searches = []
+		fallback_messages = []
+
+		async def ask_user(questions):
+			questions_asked.append(questions)
+			return ["For a bakery"]
+
+		async def fake_search(query, n=3):
+			searches.append(query)
+			return "search results"
+
+		primary_calls = 0
+
+		async def primary_create(**kwargs):
+			nonlocal primary_calls
+			primary_calls += 1
+			if primary_calls == 1:
+				message = ChatCompletionMessage.model_validate({
+					"role": "assistant",
+					"content": None,
+					"refusal": None,
+					"tool_calls": [
+						{"id": "ask", "type": "function", "function": {"name": "get_user_input", "arguments": '{"questions": ["Who is it for?"]}'}},
+						{"id": "search", "type": "function", "function": {"name": "web_search", "arguments": '{"query": "bakery logos"}'}},
+					],
+				})
+				return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+			raise _status_error(503)
+
+		primary = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=primary_create)))
+		fallback_client = _completion_client('{"analysis": "ok", "improved_prompt": "Better prompt"}', fallback_messages)
+		fresh_breakers = {"primary": CircuitBreaker("primary"), "fallback": CircuitBreaker("fallback")}
+
+		with mock.patch.object(shared_utils, "get_async_client", lambda fallback=False: fallback_client if fallback else primary), \
+				mock.patch.dict(shared_utils.breakers, fresh_breakers), \
+				mock.patch.dict("os.environ", {"FALLBACK_API_KEY": "key"}), \
+				mock.patch.object(shared_utils, "web_search_async", fake_search), \
+				mock.patch.object(agent_loop, "check_hcai_status", lambda: True):
+			result, is_fallback, messages = await enhance.enhance_prompt_async(
+				"logo", "make a logo", PromptConfig(model="test", use_web_search=True, ask_user_func=ask_user)
+			)
+
+		self.assertEqual(result, "Better prompt")
+		self.assertTrue(is_fallback)
+		self.assertEqual(len(questions_asked), 1)
+		self.assertEqual(searches, ["bakery logos"])
+		resumed = fallback_messages[0]
+		self.assertEqual([m["role"] for m in resumed], ["system", "user", "assistant", "tool", "tool"])
+		self.assertNotIn("refusal", resumed[2])
+		self.assertEqual(resumed[2]["tool_calls"][1]["function"]["name"], "web_search")
+
+	async def test_provider_outage_without_fallback_is_not_reported_as_out_of_credit(self):
+		breaker = CircuitBreaker("primary", min_calls=1)
+		breaker.record(False, 0.1)
+		loop = AgentLoop("test", PromptConfig(model="test"))
+		with mock.patch.dict(shared_utils.breakers, {"primary": breaker}), \
+				mock.patch.dict("os.environ", {"FALLBACK_API_KEY": ""}), \
+				mock.patch.object(agent_loop, "check_hcai_status", lambda: True):
+			with self.assertRaises(ProviderUnavailable):
+				loop.open_session()
+
+		async def failing(status_code):
+			raise _status_error(status_code)
+
+		with mock.patch.dict(shared_utils.breakers, {"primary": CircuitBreaker("primary")}), \
+				mock.patch.dict("os.environ", {"FALLBACK_API_KEY": ""}), \
+				mock.patch.object(shared_utils, "get_async_client", lambda fallback=False: None):
+			session = ProviderSession("test")
+			with self.assertRaises(ProviderUnavailable):
+				await session.call(lambda client, model: failing(503))
+			with self.assertRaisesMessage(Exception, "out of money"):
+				await session.call(lambda client, model: failing(402))
+
+
+def _tool_call_message(*calls, content=None):
+	return ChatCompletionMessage.model_validate({
+		"role": "assistant",
+		"content": content,
+		"tool_calls": [
+			{"id": f"call_{index}", "type": "function", "function": {"name": name, "arguments": arguments}}
+			for index, (name, arguments) in enumerate(calls)
+		],
+	})
+
+
+def _scripted_client(responses, seen_kwargs):
+	"""Answers each call with the next response; a number means hang for that many seconds."""
+	async def create(**kwargs):
+		seen_kwargs.append(kwargs)
+		response = responses.pop(0)
+		if isinstance(response, (int, float)):
+			await asyncio.sleep(response)
+		return SimpleNamespace(choices=[SimpleNamespace(message=response)], usage=None)
+	return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+_SEARCH = ("web_search", '{"query": "bakery logos"}')
+_FINAL_ANSWER = ChatCompletionMessage(role="assistant", content='{"analysis": "ok", "improved_prompt": "Better prompt"}')
+
+
+class AgentLoopTests(TestCase):
+	def setUp(self):
+		self.searches = []
+		self.seen_kwargs = []
+
+		async def fake_search(query, n=3):
+			self.searches.append(query)
+			return "search results"
+
+		for patcher in (
+			mock.patch.object(shared_utils, "web_search_async", fake_search),
+			mock.patch.dict(shared_utils.breakers, {"primary": CircuitBreaker("primary"), "fallback": CircuitBreaker("fallback")}),
+			mock.patch.object(agent_loop, "check_hcai_status", lambda: True),
+		):
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+	async def _run(self, responses, limits, config=None):
+		client = _scripted_client(responses, self.seen_kwargs)
+		with mock.patch.object(shared_utils, "get_async_client", lambda fallback=False: client):
+			loop = AgentLoop("test", config or PromptConfig(model="test"), limits=limits)
+			messages = [{"role": "system", "content": "system"}, {"role": "user", "content": "lazy"}]
+			return await loop.run(messages, shared_utils.get_tools(True))
+
+	async def test_iteration_cap_forces_a_final_answer(self):
+		outcome = await self._run(
+			[_tool_call_message(_SEARCH), _tool_call_message(_SEARCH), _FINAL_ANSWER],
+			LoopLimits(max_iterations=2),
+		)
+
+		self.assertEqual(outcome.result, "Better prompt")
+		self.assertEqual(len(self.searches), 1)
+		self.assertEqual(self.seen_kwargs[2]["tool_choice"], "none")
+		self.assertEqual(outcome.messages[-2]["content"], agent_loop.SKIPPED_TOOL_RESULT)
+		self.assertEqual(len(outcome.timings.degraded), 1)
+
+	async def test_slow_call_returns_the_best_draft(self):
+		draft = '{"improved_prompt": "Draft prompt"}'
+		outcome = await self._run(
+			[_tool_call_message(_SEARCH, content=draft), 1.0],
+			LoopLimits(llm_call_seconds=0.05, final_answer_reserve_seconds=0),
+		)
+
+		self.assertEqual(outcome.result, "Draft prompt")
+		self.assertIn("timed out", outcome.timings.degraded[0])
+		self.assertEqual(shared_utils.breakers["primary"].stats()["error_rate"], 0.5)
+
+	async def test_retry_on_the_fallback_restarts_the_stream(self):
+		def streaming_client(text, fail=False):
+			async def stream():
+				yield _chunk({"content": text})
+				if fail:
+					raise _status_error(503)
+
+			async def create(**kwargs):
+				return stream()
+			return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+		primary = streaming_client("<improved-prompt>Half a pro", fail=True)
+		secondary = streaming_client("<improved-prompt>Whole prompt</improved-prompt>")
+		frames = []
+
+		async def send_frame(frame):
+			frames.append(frame)
+
+		job = Job("enhance", "t", {}, "ip:1", send_frame, asyncio.Queue())
+		with mock.patch.object(shared_utils, "get_async_client", lambda fallback=False: secondary if fallback else primary), \
+				mock.patch.dict("os.environ", {"FALLBACK_API_KEY": "key"}):
+			loop = AgentLoop("test", PromptConfig(model="test", on_delta=job.send_delta))
+			messages = [{"role": "system", "content": "system"}, {"role": "user", "content": "lazy"}]
+			outcome = await loop.run(messages, shared_utils.get_tools(False))
+
+		# What the client shows: deltas appended, starting over on a reset
+		shown = ""
+		for frame in frames:
+			shown = ("" if frame.get("reset") else shown) + frame["delta"]
+		self.assertEqual(outcome.result, "Whole prompt")
+		self.assertTrue(outcome.is_fallback)
+		self.assertNotIn("Half", shown)
+		self.assertIn("Whole prompt", shown)
+
+	async def test_calls_after_the_circuit_opens_go_to_the_fallback(self):
+		primary_kwargs, fallback_kwargs = [], []
+		primary = _scripted_client([_tool_call_message(_SEARCH), _FINAL_ANSWER], primary_kwargs)
+		secondary = _scripted_client([_FINAL_ANSWER], fallback_kwargs)
+
+		async def search_while_the_primary_fails(query, n=3):
+			# Other requests fail on the primary meanwhile and open its circuit
+			breaker = shared_utils.breakers["primary"]
+			for _ in range(breaker.min_calls):
+				breaker.record(False, 0.1)
+			return "search results"
+
+		with mock.patch.object(shared_utils, "get_async_client", lambda fallback=False: secondary if fallback else primary), \
+				mock.patch.object(shared_utils, "web_search_async", search_while_the_primary_fails), \
+				mock.patch.dict("os.environ", {"FALLBACK_API_KEY": "key"}):
+			loop = AgentLoop("test", PromptConfig(model="test"))
+			messages = [{"role": "system", "content": "system"}, {"role": "user", "content": "lazy"}]
+			outcome = await loop.run(messages, shared_utils.get_tools(True))
+
+		self.assertEqual(outcome.result, "Better prompt")
+		self.assertTrue(outcome.is_fallback)
+		self.assertEqual((len(primary_kwargs), len(fallback_kwargs)), (1, 1))
+		self.assertEqual(shared_utils.breakers["primary"].rejected, 1)
+
+	async def test_open_circuits_on_both_providers_fail_the_call(self):
+		for breaker in shared_utils.breakers.values():
+			for _ in range(breaker.min_calls):
+				breaker.record(False, 0.1)
+		sent = []
+
+		async def request(client, model):
+			sent.append(model)
+
+		with mock.patch.object(shared_utils, "get_async_client", lambda fallback=False: None), \
+				mock.patch.dict("os.environ", {"FALLBACK_API_KEY": "key"}):
+			with self.assertRaises(ProviderUnavailable):
+				await ProviderSession("test").call(request)
+		self.assertEqual(sent, [])
+
+	async def test_streams_only_the_prompt_of_each_turn(self):
+		turns = [
+			[
+				_chunk({"content": "<analysis>Need facts</analysis>\n<improved-prompt>Draft one</improved-prompt>"}),
+				_chunk({"tool_calls": [{"index": 0, "id": "call_1", "type": "function", "function": {"name": "web_search", "arguments": '{"query": "x"}'}}]}),
+			],
+			[_chunk({"content": text}) for text in ("<analysis>Better now</analysis>\n<improved-", "prompt>Final ", "prompt</improved-prompt> trailing")],
+		]
+
+		async def create(**kwargs):
+			return _FakeStream(turns.pop(0))
+
+		client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+		frames = []
+
+		async def send_frame(frame):
+			frames.append(frame)
+
+		job = Job("enhance", "t", {}, "ip:1", send_frame, asyncio.Queue())
+		with mock.patch.object(shared_utils, "get_async_client", lambda fallback=False: client):
+			loop = AgentLoop("test", PromptConfig(model="test", on_delta=job.send_delta))
+			messages = [{"role": "system", "content": "system"}, {"role": "user", "content": "lazy"}]
+			outcome = await loop.run(messages, shared_utils.get_tools(True))
+
+		self.assertEqual(outcome.result, "Final prompt")
+		self.assertEqual(
+			frames,
+			[
+				{"type": "task_delta", "delta": "Draft one", "reset": True},
+				{"type": "task_delta", "delta": "Final", "reset": True},
+				{"type": "task_delta", "delta": " prompt"},
+			],
+		)
+
+	async def test_slow_call_without_draft_raises(self):
+		with self.assertRaises(BudgetExhausted):
+			await self._run([1.0], LoopLimits(llm_call_seconds=0.05))
+
+	async def test_waiting_for_the_user_does_not_use_the_budget(self):
+		async def slow_user(questions):
+			await asyncio.sleep(0.4)
+			return ["For a bakery"]
+
+		outcome = await self._run(
+			[
+				_tool_call_message(("get_user_input", '{"questions": ["Who is it for?"]}')),
+				_tool_call_message(_SEARCH),
+				_FINAL_ANSWER,
+			],
+			LoopLimits(request_seconds=0.3, final_answer_reserve_seconds=0.1),
+			PromptConfig(model="test", ask_user_func=slow_user),
+		)
+
+		self.assertEqual(outcome.result, "Better prompt")
+		self.assertEqual(self.searches, ["bakery logos"])
+		self.assertEqual(outcome.timings.degraded, [])
+		steps = [step["name"] for step in outcome.timings.as_dict()["steps"]]
+		self.assertEqual(steps, ["llm_call", "get_user_input", "llm_call", "web_search", "llm_call", "extract_result"])
+
+
+class EnhanceResultCacheTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		patcher = mock.patch.object(result_cache, "near_duplicate_index", NearDuplicateIndex(max_entries=100))
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	async def test_identical_requests_hit_the_cache(self):
+		calls = []
+
+		async def fake_enhance(task, lazy_prompt, config, reasoning_effort):
+			calls.append(task)
+			return "Better prompt", False, [{"role": "user", "content": lazy_prompt}]
+
+		with mock.patch.object(result_cache, "enhance_prompt_async", fake_enhance):
+			first = await result_cache.enhance_prompt_cached("task", "lazy", PromptConfig(model="test"))
+			second = await result_cache.enhance_prompt_cached("task", "lazy", PromptConfig(model="test"))
+			other = await result_cache.enhance_prompt_cached("task", "lazy", PromptConfig(model="other"))
+
+		self.assertIsNone(first[3])
+		self.assertEqual(second, ("Better prompt", False, [{"role": "user", "content": "lazy"}], "exact"))
+		self.assertIsNone(other[3])
+		self.assertEqual(len(calls), 2)
+
+	async def test_interactive_runs_are_not_stored(self):
+		async def ask_user(questions):
+			return ["answer"]
+
+		async def fake_enhance(task, lazy_prompt, config, reasoning_effort):
+			answers = await config.ask_user_func(["Question?"])
+			return "Better prompt", False, [_tool_call_message(("get_user_input", "{}")), {"role": "tool", "tool_call_id": "call_0", "content": answers[0]}]
+
+		config = PromptConfig(model="test", ask_user_func=ask_user)
+		with mock.patch.object(result_cache, "enhance_prompt_async", fake_enhance):
+			await result_cache.enhance_prompt_cached("task", "lazy", config)
+			_, _, _, cache_hit = await result_cache.enhance_prompt_cached("task", "lazy", config)
+
+		self.assertIsNone(cache_hit)
+
+	async def test_batch_runs_that_asked_a_question_are_not_stored(self):
+		async def fake_enhance(task, lazy_prompt, config, reasoning_effort):
+			self.assertIsNone(config.ask_user_func)
+			return "Guessed prompt", False, [
+				_tool_call_message(("get_user_input", '{"questions": ["Who is it for?"]}')),
+				{"role": "tool", "tool_call_id": "call_0", "content": "(No user input handler available)"},
+			]
+
+		config = batch.batch_config({}, on_timings=None)
+		with mock.patch.object(result_cache, "enhance_prompt_async", fake_enhance):
+			await result_cache.enhance_prompt_cached("task", "lazy", config)
+			_, _, _, cache_hit = await result_cache.enhance_prompt_cached("task", "lazy", config)
+
+		self.assertIsNone(cache_hit)
+
+	async def test_degraded_runs_are_not_stored(self):
+		seen_timings = []
+
+		async def fake_enhance(task, lazy_prompt, config, reasoning_effort):
+			config.on_timings({"name": "enhance", "steps": [], "degraded": ["request budget: returned the best draft so far"]})
+			return "Best draft", False, []
+
+		config = PromptConfig(model="test", on_timings=seen_timings.append)
+		with mock.patch.object(result_cache, "enhance_prompt_async", fake_enhance):
+			await result_cache.enhance_prompt_cached("task", "lazy", config)
+			_, _, _, cache_hit = await result_cache.enhance_prompt_cached("task", "lazy", config)
+
+		self.assertIsNone(cache_hit)
+		self.assertEqual(len(seen_timings), 2)
+
+	async def test_near_duplicates_reuse_or_seed_previous_results(self):
+		seeds = []
+
+		async def fake_enhance(task, lazy_prompt, config, reasoning_effort):
+			seeds.append(config.seed_prompt)
+			return f"Better {lazy_prompt}", False, []
+
+		lazy = "Write a cover letter for a software engineering internship at Google"
+		with mock.patch.object(result_cache, "enhance_prompt_async", fake_enhance):
+			await result_cache.enhance_prompt_cached("cover letter", lazy, PromptConfig(model="test"))
+			near = await result_cache.enhance_prompt_cached("Cover letter", "  write a cover letter for a software engineering internship at google!", PromptConfig(model="test"))
+			seeded = await result_cache.enhance_prompt_cached("cover letter", "Write a short cover letter for a software engineering internship at Google", PromptConfig(model="test"))
+
+		self.assertEqual(near[0], f"Better {lazy}")
+		self.assertEqual(near[3], "near")
+		self.assertIsNone(seeded[3])
+		self.assertEqual(seeds, [None, f"Better {lazy}"])
+
+
+class NearDuplicateIndexTests(TestCase):
+	def test_finds_near_duplicates_within_scope(self):
+		index = NearDuplicateIndex(max_entries=10)
+		index.add("email", "Write a polite email asking my manager for a day off", "scope", "result", "key")
+
+		match = index.query("Email", "write a polite email asking my manager for a day off.", "scope", 0.9)
+		self.assertEqual((match.result, match.result_key), ("result", "key"))
+		self.assertEqual(match.similarity, 1.0)
+		self.assertIsNone(index.query("email", "Write a polite email asking my manager for a day off", "other", 0.5))
+		self.assertIsNone(index.query("poem", "A sonnet about the sea at night", "scope", 0.5))
+
+	def test_similarity_tracks_small_edits(self):
+		index = NearDuplicateIndex(max_entries=10)
+		index.add("email", "Write a polite email asking my manager for a day off next Friday", "scope", "result", "key")
+		match = index.query("email", "Write a polite email asking my boss for a day off next Friday", "scope", 0.5)
+		self.assertIsNotNone(match)
+		self.assertLess(match.similarity, 1.0)
+
+	def test_evicts_least_recently_used_when_full(self):
+		index = NearDuplicateIndex(max_entries=2)
+		index.add("a", "first prompt about gardening tips", "scope", "1", "k1")
+		index.add("b", "second prompt about cooking pasta", "scope", "2", "k2")
+		index.query("a", "first prompt about gardening tips", "scope", 0.9)
+		index.add("c", "third prompt about learning guitar", "scope", "3", "k3")
+
+		self.assertEqual(len(index), 2)
+		self.assertEqual(index.evictions, 1)
+		self.assertIsNone(index.query("b", "second prompt about cooking pasta", "scope", 0.9))
+		self.assertIsNotNone(index.query("a", "first prompt about gardening tips", "scope", 0.9))
+
+	async def test_long_prompts_are_signed_from_a_bounded_sample(self):
+		index = NearDuplicateIndex(max_entries=10)
+		rng = random.Random(3)
+		words = [f"word{n}" for n in range(5000)]
+		long_prompt = " ".join(rng.choice(words) for _ in range(40000))
+		self.assertGreater(len(long_prompt), 231000)
+
+		t_start = time.perf_counter()
+		signature = await index.asignature("task", long_prompt)
+		self.assertLess(time.perf_counter() - t_start, 0.5)
+		np.testing.assert_array_equal(signature, index.signature("task", long_prompt))
+		index.add("task", long_prompt, "scope", "result", "key", signature=signature)
+
+		# Near duplicates of long prompts are still found through the sample
+		edited = long_prompt[:-2000] + " a different ending to the prompt"
+		match = index.query("task", edited, "scope", 0.8)
+		self.assertIsNotNone(match)
+		self.assertGreater(match.similarity, 0.9)
+		unrelated = " ".join(f"term{rng.randrange(5000)}x" for _ in range(40000))
+		self.assertIsNone(index.query("task", unrelated, "scope", 0.5))
+
+	def test_long_texts_keep_the_same_shared_shingles(self):
+		index = NearDuplicateIndex(max_entries=10)
+		rng = random.Random(5)
+		words = ["".join(rng.choice(string.ascii_lowercase) for _ in range(6)) for _ in range(12000)]
+		first = shingles(" ".join(words[:8000]), 5)
+		second = shingles(" ".join(words[:4000] + words[8000:]), 5)
+		sample_first, sample_second = set(index.sample(first).tolist()), set(index.sample(second).tolist())
+
+		self.assertLess(len(sample_first), index.max_shingles * 1.2)
+		shared = set(first.tolist()) & set(second.tolist())
+		self.assertEqual(sample_first & shared, sample_second & shared)
+		self.assertTrue(sample_first & shared)
+
+
+class PromptLayoutTests(TestCase):
+	def _build(self, **overrides):
+		kwargs = dict(
+			task="cover letter",
+			lazy_prompt="write one for google",
+			use_web_search=True,
+			additional_context="Google values",
+			target_model="gpt-5.1",
+			prompt_style={"length": "Concise"},
+		)
+		kwargs.update(overrides)
+		return build_enhancement_prompts(**kwargs)
+
+	def test_system_prompts_are_precompiled(self):
+		first = self._build()["system_prompt"]
+		second = self._build(task="essay", lazy_prompt="about rice")["system_prompt"]
+		self.assertIs(first, second)
+		self.assertIs(first, get_system_prompt(True, False, True))
+		self.assertIsNot(first, self._build(additional_context="")["system_prompt"])
+
+	def test_user_prompt_puts_volatile_content_last(self):
+		user_prompt = self._build()["user_prompt"]
+		order = [user_prompt.index(marker) for marker in (
+			"<instructions>", "<target-model>", "<prompt-style>", "<task>", "<raw_input>", "<additional-information>", "<date>",
+		)]
+		self.assertEqual(order, sorted(order))
+		self.assertTrue(user_prompt.startswith("<instructions>"))
+
+
+class PromptCacheStatsTests(TestCase):
+	def test_records_cached_tokens_and_ttft(self):
+		stats = PromptCacheStats()
+		hit = SimpleNamespace(prompt_tokens=1000, completion_tokens=10, prompt_tokens_details=SimpleNamespace(cached_tokens=800))
+		miss = SimpleNamespace(prompt_tokens=1000, completion_tokens=10, prompt_tokens_details=None)
+		stats.record(hit, 0.2)
+		stats.record(miss, 0.5)
+		stats.record(None)
+
+		result = stats.stats()
+		self.assertEqual(result["calls"], 2)
+		self.assertEqual(result["cached_tokens"], 800)
+		self.assertEqual(result["cached_token_rate"], 0.4)
+		self.assertAlmostEqual(result["ttft_saved"], 0.3)
+
+
+def _tool_round(call_id, content):
+	return [
+		{"role": "assistant", "content": None, "tool_calls": [{"id": call_id, "type": "function", "function": {"name": "web_search", "arguments": "{}"}}]},
+		{"role": "tool", "tool_call_id": call_id, "content": content},
+	]
+
+
+class TokenBudgetTests(TestCase):
+	def _history(self):
+		return [
+			{"role": "system", "content": "system " * 50},
+			{"role": "user", "content": "enhance this"},
+			*_tool_round("old", "search dump " * 400),
+			{"role": "assistant", "content": "first draft " * 100},
+			{"role": "user", "content": "make it shorter"},
+			*_tool_round("new", "fresh results " * 100),
+		]
+
+	def test_leaves_small_conversations_alone(self):
+		messages = self._history()
+		self.assertIs(TokenBudget(max_tokens=100000).fit(messages), messages)
+
+	def test_elides_old_tool_output_first(self):
+		messages = self._history()
+		fitted = TokenBudget(max_tokens=1200, tool_output_keep_chars=100).fit(messages)
+
+		self.assertIn("characters elided", fitted[3]["content"])
+		self.assertEqual(fitted[-1]["content"], messages[-1]["content"])
+		self.assertEqual(fitted[4]["content"], messages[4]["content"])
+		self.assertEqual(len(messages[3]["content"]), len("search dump " * 400))
+
+	def test_drops_old_rounds_but_keeps_system_and_latest_prompt(self):
+		messages = self._history()
+		fitted = TokenBudget(max_tokens=500, tool_output_keep_chars=100).fit(messages)
+
+		self.assertEqual(fitted[0], messages[0])
+		self.assertNotIn("old", [m.get("tool_call_id") for m in fitted])
+		self.assertIn({"role": "user", "content": "make it shorter"}, fitted)
+		self.assertEqual(fitted[-1]["tool_call_id"], "new")
+
+	def test_replaces_superseded_drafts(self):
+		messages = [
+			{"role": "system", "content": "system"},
+			{"role": "user", "content": "enhance this"},
+			{"role": "assistant", "content": "first draft " * 200},
+			{"role": "user", "content": "edit it"},
+			{"role": "assistant", "content": "second draft " * 200},
+			{"role": "user", "content": "edit again"},
+		]
+		fitted = TokenBudget(max_tokens=800).fit(messages)
+		self.assertEqual(fitted[2]["content"], ELIDED_DRAFT)
+		self.assertEqual(fitted[4]["content"], messages[4]["content"])
+
+	def test_trims_the_enhancement_tool_round_during_an_edit(self):
+		messages = [
+			{"role": "system", "content": "system " * 50},
+			{"role": "user", "content": "enhance this"},
+			*_tool_round("enhance", "search dump " * 400),
+			{"role": "assistant", "content": "draft " * 100},
+			{"role": "user", "content": "make it shorter"},
+		]
+		fitted = TokenBudget(max_tokens=300, tool_output_keep_chars=100).fit(messages)
+
+		self.assertNotIn("enhance", [m.get("tool_call_id") for m in fitted])
+		self.assertEqual(fitted[-2:], messages[-2:])
+
+		# The edit's own tool round is the one kept whole
+		edit_round = [*messages, *_tool_round("edit", "fresh results " * 100)]
+		fitted = TokenBudget(max_tokens=600, tool_output_keep_chars=100).fit(edit_round)
+		self.assertNotIn("enhance", [m.get("tool_call_id") for m in fitted])
+		self.assertEqual(fitted[-2:], edit_round[-2:])
+
+	def test_estimate_tokens(self):
+		self.assertEqual(estimate_tokens(""), 0)
+		self.assertEqual(estimate_tokens("abcdefgh"), 2)
+
+
+_MODEL_OUTPUTS = Path(__file__).resolve().parent.parent / "benchmarks" / "corpus" / "model_outputs.jsonl"
+
+
+def _streamed(text, delta_size=7):
+	extractor = OutputExtractor()
+	for start in range(0, len(text), delta_size):
+		extractor.feed(text[start:start + delta_size])
+	return extractor
+
+
+class ParseResponseTests(TestCase):
+	def test_sniffs_json_from_the_first_characters(self):
+		self.assertEqual(parse_response('  {"analysis": "a", "improved_prompt": "P"}'), ("P", "json"))
+		self.assertEqual(parse_response('```json\n{"improved_prompt": "P"}\n```'), ("P", "json"))
+
+	def test_tag_wins_over_an_earlier_label(self):
+		response = "## Improved Prompt\n<improved-prompt>\nWrite a haiku.\n</improved-prompt>"
+		self.assertEqual(parse_response(response), ("Write a haiku.", "xml"))
+
+	def test_label_does_not_read_past_its_line(self):
+		response = "- Improved Prompt:\nWrite a haiku.\n\nNotes:\nKeep it short."
+		self.assertEqual(parse_llm_response(response), "Write a haiku.")
+
+	def test_falls_back_to_the_last_fence(self):
+		response = "Example:\n```\nold\n```\nFinal:\n```\nWrite a haiku.\n```"
+		self.assertEqual(parse_response(response), ("Write a haiku.", "fenced"))
+
+	def test_nothing_found(self):
+		self.assertEqual(parse_response("Could you tell me more?"), (None, None))
+		self.assertEqual(parse_response("   "), (None, None))
+
+
+class OutputExtractorTests(TestCase):
+	def test_recognizes_each_format(self):
+		cases = {
+			"xml": "<analysis>vague</analysis>\n<improved-prompt>\nWrite a haiku.\n</improved-prompt>",
+			"json": '{"analysis": "vague", "improved_prompt": "Write a haiku."}',
+			"markdown": "- Analysis:\nvague\n\n- Improved Prompt:\nWrite a haiku.",
+			"fenced": "Here you go:\n\n```\nWrite a haiku.\n```",
+		}
+		for expected_format, text in cases.items():
+			extractor = _streamed(text)
+			self.assertEqual(extractor.result(), "Write a haiku.", expected_format)
+			self.assertEqual(extractor.format, expected_format)
+
+	def test_tag_split_across_deltas(self):
+		extractor = OutputExtractor()
+		for delta in ("<improved-pr", "ompt>Write a", " haiku.</improved-", "prompt> trailing"):
+			extractor.feed(delta)
+		self.assertTrue(extractor.complete)
+		self.assertEqual(extractor.result(), "Write a haiku.")
+
+	def test_draft_grows_with_the_prompt_only(self):
+		extractor = OutputExtractor()
+		drafts = []
+		for delta in ("<analysis>vague</analysis>\n<improved-pr", "ompt>\nWrite a", " haiku about", " dawn.</improved-", "prompt> trailing"):
+			drafts.append(extractor.feed(delta).draft())
+		self.assertEqual(drafts, [None, "Write a", "Write a haiku about", "Write a haiku about dawn.", "Write a haiku about dawn."])
+
+		extractor = OutputExtractor()
+		drafts = [extractor.feed(delta).draft() for delta in ("- Analysis:\nvague\n\n- Improved Prompt:\nWrite", " a haiku.\nAbout", " dawn.\n")]
+		self.assertEqual(drafts, [None, "Write a haiku.", "Write a haiku.\nAbout dawn."])
+		self.assertIsNone(_streamed('{"improved_prompt": "Write a haiku."}').draft())
+
+	def test_no_prompt(self):
+		extractor = _streamed("I need to know more about the audience first.")
+		self.assertIsNone(extractor.result())
+		self.assertIsNone(extractor.format)
+
+	def test_corpus_extraction_rate(self):
+		with open(_MODEL_OUTPUTS) as f:
+			corpus = [json.loads(line) for line in f if line.strip()]
+		correct = sum(_streamed(entry["output"]).result() == entry["expected"] for entry in corpus)
+		self.assertGreaterEqual(correct / len(corpus), 0.95)
+
+	def test_single_pass_parser_agrees_with_the_stream(self):
+		with open(_MODEL_OUTPUTS) as f:
+			corpus = [json.loads(line) for line in f if line.strip()]
+		for entry in corpus:
+			extractor = _streamed(entry["output"])
+			self.assertEqual(parse_response(entry["output"]), (extractor.result(), extractor.format), entry["id"])
+
+	async def test_agent_loop_skips_the_parse_call_for_markdown(self):
+		seen_kwargs = []
+		client = _scripted_client([ChatCompletionMessage(role="assistant", content="- Analysis:\nok\n\n- Improved Prompt:\nWrite a haiku.")], seen_kwargs)
+		with mock.patch.object(shared_utils, "get_async_client", lambda fallback=False: client), \
+				mock.patch.object(agent_loop, "check_hcai_status", lambda: True):
+			outcome = await AgentLoop("test", PromptConfig(model="test")).run(
+				[{"role": "user", "content": "haiku"}], shared_utils.get_tools(False)
+			)
+
+		self.assertEqual(outcome.result, "Write a haiku.")
+		self.assertEqual(len(seen_kwargs), 1)
+
+
+def _reference_clean_text_for_llm(text):
+	"""The previous implementation, which the fast one has to match exactly."""
+	text = unicodedata.normalize('NFKC', text)
+	text = ''.join(c for c in text if unicodedata.category(c)[0] != 'C' or c in '\n\r\t')
+	text = re.sub(r'[\u200b-\u200d\ufeff]', '', text)
+	text = re.sub(r'\s+', ' ', text)
+	return text.strip()
+
+
+# Characters where the implementations could plausibly differ: every kind of
+# whitespace and control character, zero-width characters, NFKC-affected forms,
+# private-use, surrogate and unassigned code points
+_TRICKY_CHARACTERS = (
+	"ab Z09.,-\n\r\t\x0b\x0c\x1c\x1d\x1e\x1f\x00\x07\x7f\x85\xa0\xad"
+	"\u1680\u180e\u2000\u2007\u200a\u200b\u200c\u200d\u200e\u2028\u2029\u202f\u205f\u2060\u3000"
+	"\ufeff\ufb01\uff21\u2460\u00bd\u0301\u1e9b\u0378\ue000\ud800\udfff\ufff0\ufffe"
+	"\U0001f600\U000e0001\U000f0000\U0010fffd\U0001d400\u0fb2\u0f80"
+)
+
+
+class CleanTextForLlmTests(TestCase):
+	def test_matches_previous_implementation_on_tricky_text(self):
+		rng = random.Random(0)
+		for _ in range(3000):
+			text = "".join(rng.choice(_TRICKY_CHARACTERS) for _ in range(rng.randint(0, 40)))
+			self.assertEqual(shared_utils.clean_text_for_llm(text), _reference_clean_text_for_llm(text), repr(text))
+
+	def test_matches_previous_implementation_on_random_code_points(self):
+		rng = random.Random(1)
+		for _ in range(2000):
+			text = "".join(chr(rng.randint(0, sys.maxunicode)) for _ in range(rng.randint(0, 30)))
+			self.assertEqual(shared_utils.clean_text_for_llm(text), _reference_clean_text_for_llm(text), repr(text))
+
+	def test_every_code_point(self):
+		text = "".join(chr(code_point) + " x" for code_point in range(sys.maxunicode + 1))
+		self.assertEqual(shared_utils.clean_text_for_llm(text), _reference_clean_text_for_llm(text))
+
+
+class BatchJobTests(TestCase):
+	def setUp(self):
+		self.configs = []
+		self.running = 0
+		self.max_running = 0
+
+	async def fake_enhance(self, task, lazy_prompt, config, reasoning_effort):
+		self.configs.append(config)
+		self.running += 1
+		self.max_running = max(self.max_running, self.running)
+		try:
+			await asyncio.sleep(0.02)
+			if lazy_prompt == "boom":
+				raise RuntimeError("provider exploded")
+			config.on_timings({"name": "enhance", "total_seconds": 0.02, "steps": [], "degraded": []})
+			return f"Better {lazy_prompt}", False, [], None
+		finally:
+			self.running -= 1
+
+	async def submit(self, prompts, **options):
+		response = await self.async_client.post(
+			"/api/batches/",
+			{"items": [{"task": "t", "lazy_prompt": prompt} for prompt in prompts], "target_model": "gpt-5.1", **options},
+			content_type="application/json",
+		)
+		self.assertEqual(response.status_code, 202, response.content)
+		return response.json()["batch_id"]
+
+	async def test_runs_items_with_bounded_concurrency_and_pages_results(self):
+		with mock.patch.object(batch, "enhance_prompt_cached", self.fake_enhance):
+			batch_id = await self.submit([f"prompt {i}" for i in range(5)] + ["boom"], concurrency=2)
+			await batch_runner.wait(batch_id)
+
+		summary = (await self.async_client.get(f"/api/batches/{batch_id}/")).json()
+		self.assertEqual(summary["status"], "completed")
+		self.assertEqual(summary["counts"]["done"], 5)
+		self.assertEqual(summary["counts"]["failed"], 1)
+		self.assertEqual(self.max_running, 2)
+		self.assertTrue(all(config.ask_user_func is None for config in self.configs))
+
+		page = (await self.async_client.get(f"/api/batches/{batch_id}/results/?limit=2&offset=1")).json()
+		self.assertEqual(page["count"], 6)
+		self.assertEqual([item["index"] for item in page["results"]], [1, 2])
+		self.assertEqual(page["results"][0]["result"], "Better prompt 1")
+		self.assertEqual(page["results"][0]["timings"]["total_seconds"], 0.02)
+		self.assertGreater(page["results"][0]["latency_seconds"], 0)
+
+		failed = (await self.async_client.get(f"/api/batches/{batch_id}/results/?status=failed")).json()
+		self.assertEqual(failed["results"][0]["error"], "provider exploded")
+
+	async def test_cancel_stops_remaining_items(self):
+		release = asyncio.Event()
+
+		async def blocked_enhance(task, lazy_prompt, config, reasoning_effort):
+			await release.wait()
+			return "never", False, [], None
+
+		with mock.patch.object(batch, "enhance_prompt_cached", blocked_enhance):
+			batch_id = await self.submit(["a", "b", "c"], concurrency=1)
+			await asyncio.sleep(0.05)
+			response = await self.async_client.post(f"/api/batches/{batch_id}/cancel/")
+			await asyncio.gather(batch_runner.wait(batch_id), return_exceptions=True)
+			again = await self.async_client.post(f"/api/batches/{batch_id}/cancel/")
+
+		self.assertEqual(response.json()["status"], "cancelled")
+		self.assertEqual(response.json()["counts"]["cancelled"], 3)
+		self.assertEqual(again.status_code, 409)
+
+	async def test_resumes_unfinished_jobs_on_startup(self):
+		job = await BatchJob.objects.acreate(status=BatchJob.RUNNING, options={"target_model": "gpt-5.1"}, total=2)
+		long_ago = timezone.now() - timedelta(hours=1)
+		await BatchItem.objects.acreate(job=job, index=0, lazy_prompt="stuck", status=BatchItem.RUNNING, started_at=long_ago)
+		await BatchItem.objects.acreate(job=job, index=1, lazy_prompt="waiting")
+
+		with mock.patch.object(batch, "enhance_prompt_cached", self.fake_enhance):
+			await batch_runner.resume_unfinished()
+			await batch_runner.wait(job.pk)
+
+		await job.arefresh_from_db()
+		self.assertEqual(job.status, BatchJob.COMPLETED)
+		results = [item.result async for item in job.items.all()]
+		self.assertEqual(results, ["Better stuck", "Better waiting"])
+
+
+class EnhanceJsonlCommandTests(TestCase):
+	def setUp(self):
+		directory = tempfile.TemporaryDirectory()
+		self.addCleanup(directory.cleanup)
+		self.source = Path(directory.name) / "prompts.jsonl"
+		records = [
+			{"id": "a", "task": "email", "lazy_prompt": "write an email", "target_model": "gpt-5.1"},
+			{"task": "logo", "lazy_prompt": "boom", "style": {"tone": "playful"}},
+			{"id": "c", "task": "essay", "lazy_prompt": "write an essay"},
+		]
+		self.source.write_text("\n".join(json.dumps(record) for record in records) + "\n")
+		self.output = self.source.with_suffix(".enhanced.jsonl")
+		self.enhanced = []
+
+	def run_command(self, fail_on=(), empty_on=()):
+		async def fake_enhance(task, lazy_prompt, config, reasoning_effort):
+			self.enhanced.append(lazy_prompt)
+			if lazy_prompt in fail_on:
+				raise RuntimeError("provider exploded")
+			if lazy_prompt in empty_on:
+				return None, False, []
+			config.on_timings({"name": "enhance", "total_seconds": 0.01, "steps": [], "degraded": []})
+			return f"Better {lazy_prompt} ({config.prompt_style})", False, []
+
+		stdout, stderr = io.StringIO(), io.StringIO()
+		with mock.patch.object(enhance_jsonl, "enhance_prompt_async", fake_enhance):
+			call_command("enhance_jsonl", str(self.source), "--concurrency", "2", stdout=stdout, stderr=stderr)
+		return stdout.getvalue()
+
+	def test_writes_results_and_resumes_from_the_checkpoint(self):
+		first_report = self.run_command(fail_on=("boom",))
+		self.assertIn("done 2, failed 1, skipped (checkpointed) 0", first_report)
+		self.assertIn("latency: p50", first_report)
+
+		second_report = self.run_command()
+		self.assertIn("done 1, failed 0, skipped (checkpointed) 2", second_report)
+		self.assertEqual(sorted(self.enhanced), ["boom", "boom", "write an email", "write an essay"])
+
+		lines = [json.loads(line) for line in self.output.read_text().splitlines()]
+		self.assertEqual(len(lines), 4)
+		self.assertEqual(lines[-1]["enhanced_prompt"], "Better boom ({'tone': 'playful'})")
+		self.assertEqual(lines[-1]["timings"]["total_seconds"], 0.01)
+		self.assertEqual(sum("error" in line for line in lines), 1)
+
+	def test_records_without_a_result_are_failed_and_retried(self):
+		first_report = self.run_command(empty_on=("boom",))
+		self.assertIn("done 2, failed 1, skipped (checkpointed) 0", first_report)
+
+		second_report = self.run_command()
+		self.assertIn("done 1, failed 0, skipped (checkpointed) 2", second_report)
+		lines = [json.loads(line) for line in self.output.read_text().splitlines()]
+		self.assertEqual([line.get("error") for line in lines if line["lazy_prompt"] == "boom"], ["No enhanced prompt was returned", None])
+
+
+class TaskSchedulerTests(TestCase):
+	async def run_in_order(self, scheduler, requests):
+		"""Queue (client, lane) requests behind a held slot and return the order they ran in."""
+		order = []
+		positions = {}
+		release = asyncio.Event()
+
+		async def hold():
+			async with scheduler.slot("holder"):
+				await release.wait()
+
+		async def request(name, client, lane):
+			async def on_position(position):
+				positions.setdefault(name, []).append(position)
+
+			async with scheduler.slot(client, lane=lane, on_position=on_position):
+				order.append(name)
+				await asyncio.sleep(0)
+
+		holder = asyncio.ensure_future(hold())
+		await asyncio.sleep(0)
+		tasks = []
+		for name, client, lane in requests:
+			tasks.append(asyncio.ensure_future(request(name, client, lane)))
+			await asyncio.sleep(0)
+		release.set()
+		await asyncio.gather(holder, *tasks)
+		return order, positions
+
+	async def test_interactive_first_and_fair_between_clients(self):
+		scheduler = TaskScheduler(max_concurrency=1, position_interval=0)
+		order, positions = await self.run_in_order(scheduler, [
+			("batch", "job", BATCH),
+			("a1", "a", "interactive"),
+			("a2", "a", "interactive"),
+			("a3", "a", "interactive"),
+			("b1", "b", "interactive"),
+		])
+
+		self.assertEqual(order, ["a1", "b1", "a2", "a3", "batch"])
+		self.assertEqual(positions["batch"], [1, 2, 3, 4, 5, 4, 3, 2, 1])
+		self.assertEqual(positions["b1"], [2, 1])
+		stats = scheduler.stats()
+		self.assertEqual((stats["running"], stats["queued"]), (0, 0))
+		self.assertEqual(stats["lanes"]["interactive"]["admitted"], 5)
+		self.assertIsNotNone(stats["lanes"]["batch"]["wait_seconds"]["p95"])
+
+	async def test_cancelled_waiters_leave_the_queue(self):
+		scheduler = TaskScheduler(max_concurrency=1, position_interval=0)
+		positions = []
+
+		async def wait_for_slot(client, on_position=None):
+			async with scheduler.slot(client, on_position=on_position):
+				pass
+
+		async with scheduler.slot("holder"):
+			first = asyncio.ensure_future(wait_for_slot("a"))
+			await asyncio.sleep(0)
+			second = asyncio.ensure_future(wait_for_slot("b", on_position=lambda p: asyncio.sleep(0, positions.append(p))))
+			await asyncio.sleep(0)
+			first.cancel()
+			await asyncio.sleep(0.01)
+			self.assertEqual(scheduler.queue_depth(), 1)
+		await second
+
+		self.assertEqual(positions, [2, 1])
+		self.assertEqual(scheduler.running, 0)
+
+	async def test_positions_are_ranked_at_most_once_per_interval(self):
+		scheduler = TaskScheduler(max_concurrency=1, position_interval=60)
+		positions = []
+
+		async def wait_for_slot(client):
+			async with scheduler.slot(client, on_position=lambda p: asyncio.sleep(0, positions.append(p))):
+				pass
+
+		with mock.patch.object(scheduler, "_update_positions", wraps=scheduler._update_positions) as update:
+			async with scheduler.slot("holder"):
+				waiters = []
+				for index in range(20):
+					waiters.append(asyncio.ensure_future(wait_for_slot(f"client{index}")))
+					await asyncio.sleep(0)
+				await asyncio.sleep(0.01)
+			await asyncio.gather(*waiters)
+
+		self.assertEqual(update.call_count, 1)
+		self.assertEqual(positions, [1])
+		self.assertEqual(scheduler.running, 0)
+
+	async def test_suspended_slot_lets_others_run(self):
+		scheduler = TaskScheduler(max_concurrency=1)
+		ran = []
+
+		async def other():
+			async with scheduler.slot("b"):
+				ran.append("b")
+
+		async with scheduler.slot("a") as slot:
+			task = asyncio.ensure_future(other())
+			await asyncio.sleep(0)
+			self.assertEqual(ran, [])
+			async with slot.suspended():
+				await task
+			self.assertTrue(slot.held)
+		self.assertEqual(ran, ["b"])
+		self.assertEqual(scheduler.running, 0)
+
+	async def test_jobs_report_their_queue_position_until_they_run(self):
+		scheduler = TaskScheduler(max_concurrency=1)
+		frames = []
+
+		async def send_frame(frame):
+			frames.append(frame)
+
+		async def run_enhancement(job):
+			frames.append({"type": "running"})
+
+		with mock.patch.object(jobs, "scheduler", scheduler), mock.patch.object(Job, "run_enhancement", run_enhancement):
+			async with scheduler.slot("holder"):
+				queued = asyncio.ensure_future(Job("enhance", "t", {}, "ip:1", send_frame, asyncio.Queue()).run())
+				await asyncio.sleep(0.01)
+			await queued
+			await Job("enhance", "t", {}, "ip:1", send_frame, asyncio.Queue()).run()
+
+		self.assertEqual(frames, [
+			{"type": "queued", "position": 1},
+			{"type": "queued", "position": 0},
+			{"type": "running"},
+			{"type": "running"},
+		])
+
+	async def test_cancelled_suspended_task_does_not_queue_again(self):
+		scheduler = TaskScheduler(max_concurrency=1)
+		suspended = asyncio.Event()
+		release = asyncio.Event()
+
+		async def waiting_for_answer():
+			async with scheduler.slot("a") as slot:
+				async with slot.suspended():
+					suspended.set()
+					await asyncio.Event().wait()
+
+		async def busy():
+			async with scheduler.slot("b"):
+				await release.wait()
+
+		task = asyncio.ensure_future(waiting_for_answer())
+		await suspended.wait()
+		holder = asyncio.ensure_future(busy())
+		await asyncio.sleep(0)
+		self.assertEqual(scheduler.running, 1)
+
+		# Every slot is busy; the cancelled task ends at once instead of waiting for one
+		task.cancel()
+		await asyncio.wait_for(asyncio.gather(task, return_exceptions=True), timeout=0.5)
+		self.assertEqual((scheduler.running, scheduler.queue_depth()), (1, 0))
+		release.set()
+		await holder
+		self.assertEqual(scheduler.running, 0)
+
+
+class _CountingWorker(EnhanceWorker):
+	started = []
+	events = []
+
+	async def job_start(self, event):
+		_CountingWorker.started.append(event["kind"])
+		_CountingWorker.events.append(event)
+		await super().job_start(event)
+
+
+def _use_temporary_conversation_store(test, **options):
+	directory = tempfile.TemporaryDirectory()
+	test.addCleanup(directory.cleanup)
+	store = SQLiteConversationStore(Path(directory.name) / "conversations.sqlite3", **{"ttl": 60, **options})
+	patcher = mock.patch.object(conversations, "_store", store)
+	patcher.start()
+	test.addCleanup(patcher.stop)
+	return store
+
+
+class JobRelayTests(TestCase):
+	def setUp(self):
+		cache.clear()
+		_CountingWorker.started = []
+		_CountingWorker.events = []
+		self.store = _use_temporary_conversation_store(self)
+		patcher = mock.patch.object(result_cache, "near_duplicate_index", NearDuplicateIndex(max_entries=100))
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	@contextlib.asynccontextmanager
+	async def running_worker(self):
+		worker = Worker(ChannelNameRouter({"enhance-test": _CountingWorker.as_asgi()}), ["enhance-test"], get_channel_layer())
+		worker_task = asyncio.ensure_future(worker.arun())
+		try:
+			yield
+		finally:
+			worker_task.cancel()
+			await asyncio.gather(worker_task, return_exceptions=True)
+
+	async def converse(self, linger=0, early_answer=None):
+		"""Run an enhancement that asks one question over the WebSocket; return the frames received."""
+		from backend.routing import websocket_urlpatterns
+
+		async def fake_enhance(task, lazy_prompt, config, reasoning_effort):
+			answers = await config.ask_user_func(["Who is it for?"])
+			await config.on_delta("Better ")
+			return f"Better prompt for {answers[0]}", False, [{"role": "user", "content": lazy_prompt}]
+
+		frames = []
+		communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/enhance/relay-test/")
+		with mock.patch.object(result_cache, "enhance_prompt_async", fake_enhance):
+			connected, _ = await communicator.connect()
+			self.assertTrue(connected)
+			if early_answer:
+				await communicator.send_json_to({"type": "user_answer", "answers": [early_answer]})
+				self.assertEqual((await communicator.receive_json_from(timeout=2))["type"], "answer_received")
+			await communicator.send_json_to({"type": "enhance", "task": "logo", "lazy_prompt": "make a logo", "stream": True})
+			while not frames or frames[-1]["type"] not in ("task_complete", "task_error"):
+				frames.append(await communicator.receive_json_from(timeout=2))
+				if frames[-1]["type"] == "user_question":
+					await communicator.send_json_to({"type": "user_answer", "answers": ["a bakery"]})
+			await asyncio.sleep(linger)
+			await communicator.disconnect()
+		return frames
+
+	async def test_runs_jobs_in_process_by_default(self):
+		frames = await self.converse()
+
+		self.assertEqual(
+			[frame["type"] for frame in frames],
+			["processing", "user_question", "answer_received", "task_delta", "task_complete"],
+		)
+		self.assertEqual(frames[-1]["result"], "Better prompt for a bakery")
+		self.assertEqual(_CountingWorker.started, [])
+
+	async def test_answers_sent_before_a_question_are_ignored(self):
+		frames = await self.converse(early_answer="a stale answer")
+
+		self.assertEqual(frames[-1]["result"], "Better prompt for a bakery")
+
+	async def test_relays_jobs_to_workers_over_the_channel_layer(self):
+		async with self.running_worker():
+			with override_settings(ENHANCE_WORKER_CHANNEL="enhance-test"):
+				frames = await self.converse()
+
+		self.assertEqual(_CountingWorker.started, ["enhance"])
+		self.assertEqual(
+			[frame["type"] for frame in frames],
+			["processing", "user_question", "answer_received", "task_delta", "task_complete"],
+		)
+		self.assertEqual(frames[-1]["result"], "Better prompt for a bakery")
+		self.assertEqual(await self.store.load("relay-test"), [{"role": "user", "content": "make a logo"}])
+
+	async def test_finished_jobs_are_not_cancelled_on_disconnect(self):
+		async with self.running_worker():
+			with override_settings(ENHANCE_WORKER_CHANNEL="enhance-test"):
+				await self.converse(linger=0.1)
+
+		job_channel = _CountingWorker.events[0]["job_channel"]
+		with self.assertRaises(asyncio.TimeoutError):
+			await asyncio.wait_for(get_channel_layer().receive(job_channel), 0.1)
+
+	async def test_fails_jobs_no_worker_takes(self):
+		from backend.routing import websocket_urlpatterns
+
+		layer = get_channel_layer()
+		communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/enhance/relay-test/")
+		with override_settings(ENHANCE_WORKER_CHANNEL="enhance-test", ENHANCE_WORKER_START_TIMEOUT=0.05):
+			await communicator.connect()
+			await communicator.send_json_to({"type": "enhance", "task": "logo", "lazy_prompt": "make a logo"})
+			frames = [await communicator.receive_json_from(timeout=2) for _ in range(2)]
+			await communicator.disconnect()
+
+		self.assertEqual([frame["type"] for frame in frames], ["processing", "task_error"])
+		start = await asyncio.wait_for(layer.receive("enhance-test"), 1)
+		self.assertEqual((await asyncio.wait_for(layer.receive(start["job_channel"]), 1))["type"], "job.cancel")
+
+	async def test_cancels_jobs_before_a_worker_takes_them(self):
+		from backend.routing import websocket_urlpatterns
+
+		finished = []
+
+		async def slow_enhance(task, lazy_prompt, config, reasoning_effort):
+			await asyncio.sleep(0.1)
+			finished.append(task)
+			return "Better prompt", False, []
+
+		communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/enhance/relay-test/")
+		with override_settings(ENHANCE_WORKER_CHANNEL="enhance-test"), mock.patch.object(result_cache, "enhance_prompt_async", slow_enhance):
+			await communicator.connect()
+			await communicator.send_json_to({"type": "enhance", "task": "logo", "lazy_prompt": "make a logo"})
+			await communicator.disconnect()
+			async with self.running_worker():
+				while not _CountingWorker.started:
+					await asyncio.sleep(0.01)
+				await asyncio.sleep(0.2)
+
+		self.assertEqual(finished, [])
+
+
+class ConversationStoreTests(TestCase):
+	def setUp(self):
+		self.store = _use_temporary_conversation_store(self)
+
+	async def test_save_append_and_delete(self):
+		self.assertIsNone(await self.store.load("s"))
+		await self.store.save("s", [{"role": "system", "content": "sys"}, {"role": "user", "content": "hi"}])
+		await self.store.append("s", [{"role": "assistant", "content": "hello"}])
+		await self.store.save("other", [{"role": "user", "content": "unrelated"}])
+
+		self.assertEqual([m["content"] for m in await self.store.load("s")], ["sys", "hi", "hello"])
+		await self.store.save("s", [{"role": "user", "content": "replaced"}])
+		self.assertEqual(await self.store.load("s"), [{"role": "user", "content": "replaced"}])
+		await self.store.delete("s")
+		self.assertIsNone(await self.store.load("s"))
+		self.assertEqual(self.store.stats()["misses"], 2)
+
+	async def test_conversations_expire(self):
+		store = _use_temporary_conversation_store(self, ttl=0.05, purge_every=1)
+		await store.save("s", [{"role": "user", "content": "old"}])
+		await asyncio.sleep(0.1)
+
+		self.assertIsNone(await store.load("s"))
+		await store.append("s", [{"role": "user", "content": "new"}])
+		self.assertEqual(await store.load("s"), [{"role": "user", "content": "new"}])
+
+	async def test_concurrent_appends_are_atomic(self):
+		# Each store has its own connections, like separate processes sharing the file
+		other = SQLiteConversationStore(self.store.path, ttl=60)
+		await asyncio.gather(*(
+			(self.store if index % 2 else other).append("s", [{"role": "user", "content": str(index)}, {"role": "assistant", "content": str(index)}])
+			for index in range(100)
+		))
+
+		messages = await self.store.load("s")
+		self.assertEqual(len(messages), 200)
+		# The two messages of each append stay together
+		self.assertTrue(all(messages[i]["content"] == messages[i + 1]["content"] for i in range(0, 200, 2)))
+		self.assertEqual(sorted(int(m["content"]) for m in messages[::2]), list(range(100)))
+
+	async def test_edits_continue_the_stored_conversation(self):
+		seen = []
+
+		async def fake_edit(edit_instructions, current_prompt, config, enhancement_messages):
+			seen.append(list(enhancement_messages))
+			new = [{"role": "user", "content": edit_instructions}, {"role": "assistant", "content": "edited"}]
+			return "edited", enhancement_messages + new
+
+		async def send_frame(frame):
+			pass
+
+		await self.store.save("enh", [{"role": "system", "content": "sys"}])
+		with mock.patch.object(edit, "edit_prompt_async", fake_edit):
+			for instructions in ("shorter", "friendlier"):
+				data = {"edit_instructions": instructions, "current_prompt": "p", "enhancement_task_id": "enh"}
+				await Job("edit", "edit-task", data, "ip:1", send_frame, asyncio.Queue()).run()
+
+		self.assertEqual([m["content"] for m in seen[1]], ["sys", "shorter", "edited"])
+		self.assertEqual(len(await self.store.load("enh")), 5)
+
+
+def _stored_session(system_prompt):
+	tool_call = ChatCompletionMessage(
+		role="assistant",
+		content=None,
+		tool_calls=[{"id": "call_1", "type": "function", "function": {"name": "web_search", "arguments": '{"query": "q"}'}}],
+	)
+	return [
+		{"role": "system", "content": system_prompt},
+		{"role": "user", "content": "Task: write a haiku"},
+		tool_call.model_dump(mode="json"),
+		{"role": "tool", "tool_call_id": "call_1", "content": "result " * 200},
+		ChatCompletionMessage(role="assistant", content="<prompt>done</prompt>").model_dump(mode="json"),
+	]
+
+
+class HistoryCodecTests(TestCase):
+	def test_roundtrip_is_lossless(self):
+		rng = random.Random(7)
+		samples = [
+			_stored_session("You are a prompt engineer."),
+			[],
+			[{"role": "user", "content": [{"type": "text", "text": "parts"}], "custom": None, "extra": {"a": None}}],
+			[{"role": "assistant", "content": None, "tool_calls": [{"id": "c", "type": "custom", "custom": {"name": "x", "input": ""}}]}],
+			[{"role": "system", "content": ""}, {"role": "system", "content": None}],
+		]
+		for _ in range(200):
+			keys = rng.sample(history_codec.NULLABLE_KEYS + ("other", "role"), rng.randint(0, 5))
+			samples.append([{key: rng.choice([None, "x", 0, False, [], {}, 1.5]) for key in keys}])
+
+		for messages in samples:
+			payload, blobs = history_codec.encode_chunk(messages)
+			self.assertEqual(history_codec.decode_chunk(payload, blobs), messages)
+			# Keys come back in an order that compares equal, and as plain JSON types
+			self.assertEqual(json.dumps(history_codec.decode_chunk(payload, blobs), sort_keys=True), json.dumps(messages, sort_keys=True))
+
+	def test_encoding_is_much_smaller_than_json(self):
+		messages = _stored_session(get_system_prompt(True, False, False))
+		payload, blobs = history_codec.encode_chunk(messages)
+
+		self.assertEqual(list(blobs.values()), [get_system_prompt(True, False, False)])
+		self.assertLess(len(payload) * 10, len(json.dumps(messages)))
+
+	async def test_system_prompt_is_stored_once(self):
+		store = _use_temporary_conversation_store(self)
+		for session_id in ("a", "b", "c"):
+			await store.save(session_id, _stored_session(get_system_prompt(True, False, False)))
+
+		blob_count = store._connection().execute("SELECT COUNT(*) FROM conversation_blobs").fetchone()[0]
+		self.assertEqual(blob_count, 1)
+		# Another process has not seen the prompt yet and reads it from the store
+		other = SQLiteConversationStore(store.path, ttl=60)
+		self.assertEqual(await other.load("b"), _stored_session(get_system_prompt(True, False, False)))
+
+	async def test_reads_chunks_stored_as_json(self):
+		store = _use_temporary_conversation_store(self)
+		await store.save("s", [{"role": "user", "content": "new"}])
+		legacy = json.dumps([{"role": "system", "content": "old", "name": None}]).encode()
+		store._connection().execute("INSERT INTO conversation_chunks (session_id, seq, payload) VALUES ('s', 1, ?)", (legacy,))
+
+		self.assertEqual(await store.load("s"), [{"role": "user", "content": "new"}, {"role": "system", "content": "old", "name": None}])
+
+
+class MemoryConversationStoreTests(TestCase):
+	def setUp(self):
+		self.store = MemoryConversationStore(ttl=60)
+		patcher = mock.patch.object(conversations, "_store", self.store)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def session(self, session_id, size):
+		"""Messages that take `size` bytes or more once encoded, and their exact encoded size."""
+		# Random text barely compresses
+		messages = [{"role": "user", "content": random.Random(session_id).randbytes(size).decode("latin-1")}]
+		return messages, len(history_codec.encode_chunk(messages)[0])
+
+	async def test_evicts_least_recently_used_by_size(self):
+		small, small_size = self.session("small", 300)
+		huge, huge_size = self.session("huge", 2000)
+		self.store.max_bytes = 5 * small_size + huge_size - small_size * 3 // 2
+		for index in range(5):
+			await self.store.save(f"small-{index}", small)
+		await self.store.load("small-0")
+		await self.store.save("huge", huge)
+
+		# Making room for the huge session evicts the two least recently used small ones
+		self.assertIsNone(await self.store.load("small-1"))
+		self.assertIsNone(await self.store.load("small-2"))
+		self.assertIsNotNone(await self.store.load("small-0"))
+		self.assertIsNotNone(await self.store.load("huge"))
+		stats = self.store.stats()
+		self.assertEqual(stats["evictions"], 2)
+		self.assertEqual(stats["misses"], 2)
+		self.assertEqual(stats["bytes"], 3 * small_size + huge_size)
+		self.assertLessEqual(stats["bytes"], stats["max_bytes"])
+
+	async def test_pinned_sessions_are_not_evicted(self):
+		messages, size = self.session("big", 2000)
+		self.store.max_bytes = size * 3 // 2
+		await self.store.save("pinned", messages)
+		self.store.pin("pinned")
+		await self.store.save("other", messages)
+
+		self.assertIsNotNone(await self.store.load("pinned"))
+		self.assertIsNone(await self.store.load("other"))
+		self.store.pin("pinned")
+		self.store.unpin("pinned")
+		# Still pinned once
+		await self.store.save("other", messages)
+		self.assertIsNone(await self.store.load("other"))
+		self.store.unpin("pinned")
+		await self.store.save("other", messages)
+		self.assertIsNone(await self.store.load("pinned"))
+		self.assertIsNotNone(await self.store.load("other"))
+		self.assertEqual(self.store.stats()["evictions"], 3)
+		self.assertEqual(self.store.stats()["pinned"], 0)
+
+	async def test_edit_consumer_pins_the_enhancement_while_open(self):
+		from backend.routing import websocket_urlpatterns
+
+		pinned_during_edit = []
+
+		async def fake_edit(edit_instructions, current_prompt, config, enhancement_messages):
+			pinned_during_edit.append(self.store.is_pinned("enh"))
+			return "edited", enhancement_messages
+
+		await self.store.save("enh", [{"role": "user", "content": "make a logo"}])
+		communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/edit/edit-pin-test/")
+		with mock.patch.object(edit, "edit_prompt_async", fake_edit):
+			await communicator.connect()
+			await communicator.send_json_to({"type": "edit_request", "edit_instructions": "shorter", "current_prompt": "p", "enhancement_task_id": "enh"})
+			frames = [await communicator.receive_json_from(timeout=2) for _ in range(2)]
+			self.assertTrue(self.store.is_pinned("enh"))
+			await communicator.disconnect()
+
+		self.assertEqual(frames[-1], {"type": "task_complete", "result": "edited"})
+		self.assertEqual(pinned_during_edit, [True])
+		self.assertFalse(self.store.is_pinned("enh"))
+
+
+class RateLimiterTests(TestCase):
+	def test_parses_rates(self):
+		self.assertEqual(parse_rate("5/minute"), (5, 60.0))
+		self.assertEqual(parse_rate("100/day"), (100, 86400.0))
+		self.assertEqual(parse_rate("2/s"), (2, 1.0))
+
+	async def test_token_bucket_per_route_and_client(self):
+		limiter = LocalRateLimiter({"enhance": "3/minute", "answer": "1/minute"})
+
+		self.assertEqual([await limiter.allow("enhance", "a") for _ in range(4)], [True, True, True, False])
+		self.assertTrue(await limiter.allow("enhance", "b"))
+		self.assertTrue(await limiter.allow("answer", "a"))
+		self.assertFalse(await limiter.allow("answer", "a"))
+		# Routes without a rate are not limited
+		self.assertTrue(await limiter.allow("edit", "a"))
+		self.assertEqual(limiter.stats()["rejected"], {"enhance": 1, "answer": 1})
+
+	async def test_refills_over_time(self):
+		limiter = LocalRateLimiter({"enhance": "20/second"}, prune_every=5)
+		results = [await limiter.allow("enhance", "a") for _ in range(21)]
+		self.assertEqual(results.count(True), 20)
+		await asyncio.sleep(0.1)
+
+		# About two tokens came back
+		self.assertEqual([await limiter.allow("enhance", "a") for _ in range(3)][:2], [True, True])
+		await asyncio.sleep(1.05)
+		await limiter.allow("enhance", "b")
+		await limiter.allow("enhance", "b")
+		# Pruning dropped the refilled bucket of "a"
+		self.assertEqual(limiter.stats()["buckets"], 1)
+
+	async def test_concurrent_checks_never_oversubscribe(self):
+		limiter = LocalRateLimiter({"enhance": "10/minute"})
+		results = await asyncio.gather(*(limiter.allow("enhance", "a") for _ in range(100)))
+		self.assertEqual(results.count(True), 10)
+
+	async def test_consumer_limits_answers(self):
+		from backend.routing import websocket_urlpatterns
+
+		limiter = LocalRateLimiter({"answer": "1/minute"})
+		communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/edit/rate-test/")
+		with mock.patch.object(rate_limit, "_limiter", limiter):
+			await communicator.connect()
+			frames = []
+			for _ in range(2):
+				await communicator.send_json_to({"type": "user_answer", "answers": ["x"]})
+				frames.append(await communicator.receive_json_from(timeout=2))
+			await communicator.disconnect()
+
+		self.assertEqual(frames[0]["type"], "answer_received")
+		self.assertEqual(frames[1]["type"], "task_error")
+		self.assertIn("Rate limit", frames[1]["error"])
@@ -0,0 +1,66 @@
+import time
+from contextlib import contextmanager
+from typing import Awaitable, TypeVar
+
+from . import log
+
+T = TypeVar("T")
+
+
+class Timings:
+    """Structured timings of one request.
+
+    Every step records its name, any attributes passed to `step` (such as the turn
+    number), its start offset from the beginning of the request and its duration in
+    seconds. Steps that raised also record the exception type. `degraded` lists the
+    shortcuts the request had to take to stay within its latency budget.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._start = time.perf_counter()
+        self.steps: list[dict] = []
+        self.degraded: list[str] = []
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._start
+
+    @contextmanager
+    def step(self, name: str, **attrs):
+        start = self.elapsed()
+        record = {"name": name, **attrs, "start": round(start, 4), "duration": None}
+        self.steps.append(record)
+        try:
+            yield record
+        except BaseException as e:
+            record["error"] = type(e).__name__
+            raise
+        finally:
+            record["duration"] = round(self.elapsed() - start, 4)
+            log(f"[TIMING] {self.name}.{name} {attrs or ''}: {record['duration']:.3f}s")
+
+    async def measure(self, name: str, awaitable: Awaitable[T], **attrs) -> T:
+        """Await `awaitable` as a step, e.g. inside a background task."""
+        with self.step(name, **attrs):
+            return await awaitable
+
+    def degrade(self, reason: str):
+        log(f"[TIMING] {self.name} degraded: {reason}")
+        self.degraded.append(reason)
+
+    def as_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "total_seconds": round(self.elapsed(), 4),
+            "steps": [dict(step) for step in self.steps],
+            "degraded": list(self.degraded),
+        }
+
+    def log_summary(self):
+        log(f"[TIMING] === {self.name} timing summary ===")
+        for step in self.steps:
+            attrs = {key: value for key, value in step.items() if key not in ("name", "start", "duration")}
+            log(f"[TIMING]   {step['name']} {attrs or ''}: starts at {step['start']:.3f}s, took {step['duration']:.3f}s")
+        for reason in self.degraded:
+            log(f"[TIMING]   degraded: {reason}")
+        log(f"[TIMING] === Total: {self.elapsed():.3f}s ===")
@@ -0,0 +1,138 @@
+import math
+
+from django.conf import settings
+
+from . import log
+
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4
+ELIDED_DRAFT = "[Superseded draft elided to save context.]"
+
+
+def estimate_tokens(text: str | None) -> int:
+    """Cheap local token estimate (~4 characters per token for English text)."""
+    if not text:
+        return 0
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def _field(message, name: str):
+    if isinstance(message, dict):
+        return message.get(name)
+    return getattr(message, name, None)
+
+
+def message_tokens(message) -> int:
+    tokens = MESSAGE_OVERHEAD_TOKENS + estimate_tokens(_field(message, "content"))
+    for tool_call in _field(message, "tool_calls") or []:
+        function = _field(tool_call, "function")
+        tokens += estimate_tokens(_field(function, "name")) + estimate_tokens(_field(function, "arguments"))
+    return tokens
+
+
+def _with_content(message, content: str) -> dict:
+    if isinstance(message, dict):
+        return {**message, "content": content}
+    return {**message.model_dump(mode="json", exclude_none=True), "content": content}
+
+
+class TokenBudget:
+    """Keeps the conversation sent to the model under a token budget.
+
+    The full history is left untouched; `fit` returns a trimmed copy for one request.
+    The system prompt, the latest user message, the latest draft and the most recent
+    tool round of the current turn are always kept. Beyond that, space is reclaimed in this order:
+    1. old tool outputs are cut down to their first `tool_output_keep_chars` characters,
+    2. superseded drafts are replaced by a placeholder,
+    3. whole old tool rounds (assistant tool calls plus their results) are dropped.
+    """
+
+    def __init__(self, max_tokens: int, tool_output_keep_chars: int = 600):
+        self.max_tokens = max_tokens
+        self.tool_output_keep_chars = tool_output_keep_chars
+
+    def _protected(self, messages: list) -> set[int]:
+        protected = set()
+        if messages and _field(messages[0], "role") == "system":
+            protected.add(0)
+        roles = [_field(message, "role") for message in messages]
+        for role in ("user", "assistant"):
+            if role in roles:
+                protected.add(len(roles) - 1 - roles[::-1].index(role))
+        # The latest draft: the last assistant message with content and no tool calls
+        for index in range(len(messages) - 1, -1, -1):
+            if roles[index] == "assistant" and _field(messages[index], "content") and not _field(messages[index], "tool_calls"):
+                protected.add(index)
+                break
+        # The most recent tool round, which the next call has to see in full. Only a
+        # round of the current turn counts: in an edit, the enhancement's rounds come
+        # before the edit instructions and are as trimmable as any other old round
+        turn_start = len(roles) - 1 - roles[::-1].index("user") if "user" in roles else 0
+        for index in range(len(messages) - 1, turn_start, -1):
+            if roles[index] == "assistant" and _field(messages[index], "tool_calls"):
+                protected.update(range(index, len(messages)))
+                break
+        return protected
+
+    def fit(self, messages: list) -> list:
+        sizes = [message_tokens(message) for message in messages]
+        total = sum(sizes)
+        if total <= self.max_tokens:
+            return messages
+
+        fitted = list(messages)
+        protected = self._protected(fitted)
+        initial = total
+
+        # 1. Shorten old tool outputs, oldest first
+        for index, message in enumerate(fitted):
+            if total <= self.max_tokens:
+                break
+            content = _field(message, "content") or ""
+            if index in protected or _field(message, "role") != "tool" or len(content) <= self.tool_output_keep_chars:
+                continue
+            elided = len(content) - self.tool_output_keep_chars
+            fitted[index] = _with_content(
+                message, content[:self.tool_output_keep_chars] + f"\n[... {elided} characters elided to save context ...]"
+            )
+            total += message_tokens(fitted[index]) - sizes[index]
+            sizes[index] = message_tokens(fitted[index])
+
+        # 2. Replace superseded drafts
+        for index, message in enumerate(fitted):
+            if total <= self.max_tokens:
+                break
+            if index in protected or _field(message, "role") != "assistant" or _field(message, "tool_calls"):
+                continue
+            if not _field(message, "content") or _field(message, "content") == ELIDED_DRAFT:
+                continue
+            fitted[index] = _with_content(message, ELIDED_DRAFT)
+            total += message_tokens(fitted[index]) - sizes[index]
+            sizes[index] = message_tokens(fitted[index])
+
+        # 3. Drop whole old tool rounds, oldest first
+        index = 0
+        while total > self.max_tokens and index < len(fitted):
+            message = fitted[index]
+            if index in protected or _field(message, "role") != "assistant" or not _field(message, "tool_calls"):
+                index += 1
+                continue
+            end = index + 1
+            while end < len(fitted) and _field(fitted[end], "role") == "tool":
+                end += 1
+            if any(position in protected for position in range(index, end)):
+                index = end
+                continue
+            total -= sum(sizes[index:end])
+            del fitted[index:end], sizes[index:end]
+            protected = {position - (end - index) if position > index else position for position in protected}
+
+        log(f"[TokenBudget] Trimmed conversation from ~{initial} to ~{total} tokens (budget {self.max_tokens})")
+        return fitted
+
+
+def get_context_budget() -> TokenBudget:
+    return TokenBudget(
+        max_tokens=getattr(settings, "LLM_CONTEXT_TOKEN_BUDGET", 24000),
+        tool_output_keep_chars=getattr(settings, "LLM_TOOL_OUTPUT_KEEP_CHARS", 600),
+    )
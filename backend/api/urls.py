@@ -1,8 +1,22 @@
 from django.urls import path
-from .views import EnhancePromptView, SavePromptView, ListSavedPromptsView
+from .views import (
+    BatchCancelView,
+    BatchResultsView,
+    BatchStatusView,
+    BatchSubmitView,
+    EnhancePromptView,
+    ListSavedPromptsView,
+    MetricsView,
+    SavePromptView,
+)
 
 urlpatterns = [
     path('enhance/', EnhancePromptView.as_view(), name='enhance-prompt'),
     path('save/', SavePromptView.as_view(), name='save-prompt'),
     path('prompts/', ListSavedPromptsView.as_view(), name='list-prompts'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
+    path('batches/', BatchSubmitView.as_view(), name='batch-submit'),
+    path('batches/<uuid:batch_id>/', BatchStatusView.as_view(), name='batch-status'),
+    path('batches/<uuid:batch_id>/results/', BatchResultsView.as_view(), name='batch-results'),
+    path('batches/<uuid:batch_id>/cancel/', BatchCancelView.as_view(), name='batch-cancel'),
 ]
\ No newline at end of file
@@ -2,9 +2,28 @@ import os
 import uuid
 from dotenv import load_dotenv
 
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+from django.shortcuts import get_object_or_404
+from rest_framework import status
 from rest_framework.generics import GenericAPIView, CreateAPIView
-from .models import SavedPrompt
-from .serializers import EnhancePromptRequestSerializer, SavePromptSerializer
+from rest_framework.pagination import LimitOffsetPagination
+from .models import BatchItem, BatchJob, SavedPrompt
+from .serializers import (
+    BatchItemSerializer,
+    BatchRequestSerializer,
+    EnhancePromptRequestSerializer,
+    SavePromptSerializer,
+)
+from . import result_cache
+from .batch import batch_runner
+from .conversations import get_conversation_store
+from .rate_limit import get_rate_limiter
+from .scheduler import scheduler
+from .extraction import extraction_stats
+from .shared_utils import breakers, client_registry, hcai_prober, prompt_cache_stats, search_cache
 from rest_framework.response import Response
 
 load_dotenv()
@@ -68,3 +87,111 @@ class ListSavedPromptsView(GenericAPIView):
             for prompt in prompts
         ]
         return Response({'prompts': prompt_list})
+
+
+class MetricsView(GenericAPIView):
+    """Runtime metrics for monitoring. Not throttled so it can be scraped."""
+    throttle_classes = []
+
+    def get(self, request):
+        return Response({
+            'llm_pools': client_registry.stats(),
+            'provider_health': hcai_prober.stats(),
+            'circuit_breakers': [breaker.stats() for breaker in breakers.values()],
+            'search_cache': search_cache.stats(),
+            'prompt_cache': prompt_cache_stats.stats(),
+            'result_cache': result_cache.stats,
+            'near_duplicate_index': result_cache.near_duplicate_index.stats(),
+            'output_extraction': extraction_stats(),
+            'batches': batch_runner.stats(),
+            'scheduler': scheduler.stats(),
+            'conversations': get_conversation_store().stats(),
+            'rate_limits': get_rate_limiter().stats(),
+        })
+
+
+def batch_summary(job: BatchJob) -> dict:
+    counts = dict(job.items.values_list('status').annotate(count=Count('pk')).order_by())
+    return {
+        'batch_id': str(job.pk),
+        'status': job.status,
+        'total': job.total,
+        'counts': {choice: counts.get(choice, 0) for choice, _ in BatchItem.STATUS_CHOICES},
+        'concurrency': job.concurrency,
+        'options': job.options,
+        'created_at': job.created_at,
+        'started_at': job.started_at,
+        'finished_at': job.finished_at,
+    }
+
+
+class BatchSubmitView(GenericAPIView):
+    """
+    Queues a batch of enhancement requests and starts running it in the background.
+    Nobody can answer the model's questions, so items run without user input.
+    """
+    serializer_class = BatchRequestSerializer
+
+    def post(self, request):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        items = data.pop('items')
+        default_concurrency = getattr(settings, 'BATCH_DEFAULT_CONCURRENCY', 4)
+        concurrency = min(data.pop('concurrency', default_concurrency), batch_runner.max_concurrency)
+
+        with transaction.atomic():
+            job = BatchJob.objects.create(options=data, concurrency=concurrency, total=len(items))
+            BatchItem.objects.bulk_create(
+                BatchItem(job=job, index=index, task=item['task'], lazy_prompt=item['lazy_prompt'])
+                for index, item in enumerate(items)
+            )
+
+        # Sync views run in a worker thread; schedule the job on the server's event loop
+        async_to_sync(batch_runner.start)(job.pk)
+        return Response(batch_summary(job), status=status.HTTP_202_ACCEPTED)
+
+
+class BatchStatusView(GenericAPIView):
+    """Progress of a batch. Not throttled so clients can poll it."""
+    throttle_classes = []
+
+    def get(self, request, batch_id):
+        return Response(batch_summary(get_object_or_404(BatchJob, pk=batch_id)))
+
+
+class BatchResultsPagination(LimitOffsetPagination):
+    default_limit = 100
+    max_limit = 1000
+
+
+class BatchResultsView(GenericAPIView):
+    """
+    Pages through the items of a batch in submission order, including partial results
+    of a batch still running. `?status=done` limits the page to finished items.
+    """
+    throttle_classes = []
+    serializer_class = BatchItemSerializer
+    pagination_class = BatchResultsPagination
+
+    def get(self, request, batch_id):
+        job = get_object_or_404(BatchJob, pk=batch_id)
+        items = job.items.all()
+        if request.query_params.get('status'):
+            items = items.filter(status=request.query_params['status'])
+        page = self.paginate_queryset(items)
+        response = self.get_paginated_response(self.get_serializer(page, many=True).data)
+        response.data['batch_status'] = job.status
+        return response
+
+
+class BatchCancelView(GenericAPIView):
+    def post(self, request, batch_id):
+        job = get_object_or_404(BatchJob, pk=batch_id)
+        if not async_to_sync(batch_runner.cancel)(job.pk):
+            return Response(
+                {'error': f'Batch already {job.status}.', **batch_summary(job)},
+                status=status.HTTP_409_CONFLICT,
+            )
+        job.refresh_from_db()
+        return Response(batch_summary(job))
@@ -0,0 +1,61 @@
+import asyncio
+
+from channels.consumer import AsyncConsumer
+
+from . import log
+from .jobs import Job
+from .lifecycle import run_startup_soon
+
+
+class EnhanceWorker(AsyncConsumer):
+    """Runs enhance and edit jobs handed over by the WebSocket consumers.
+
+    Listens on the ENHANCE_WORKER_CHANNEL channel; start one or more with
+    `python manage.py runworker <channel>`. Each job brings the name of a channel
+    of its own, on which the consumer sends the user's answers and cancellation.
+    The worker acknowledges the job with `worker.attached`, sends everything for
+    the client as `worker.frame` and says `worker.finished` when it is done.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.jobs: set[asyncio.Task] = set()
+
+    async def job_start(self, event):
+        # Workers have no lifespan events either
+        run_startup_soon()
+        # Run the job beside the message loop so one worker holds many jobs at once
+        task = asyncio.ensure_future(self.run_job(event))
+        self.jobs.add(task)
+        task.add_done_callback(self.jobs.discard)
+
+    async def run_job(self, event):
+        layer = self.channel_layer
+        reply_channel = event["reply_channel"]
+        job_channel = event["job_channel"]
+        answers: asyncio.Queue = asyncio.Queue()
+
+        async def send_frame(frame: dict):
+            await layer.send(reply_channel, {"type": "worker.frame", "frame": frame})
+
+        job = Job(event["kind"], event["task_id"], event["data"], event["client"], send_frame, answers)
+        job_task = asyncio.ensure_future(job.run())
+
+        async def listen():
+            while True:
+                message = await layer.receive(job_channel)
+                if message["type"] == "job.answer":
+                    answers.put_nowait(message["answers"])
+                elif message["type"] == "job.cancel":
+                    log(f"[Worker] Cancelling {event['kind']} job {event['job_id']}")
+                    job_task.cancel()
+                    return
+
+        listener = asyncio.ensure_future(listen())
+        try:
+            await layer.send(reply_channel, {"type": "worker.attached", "job_id": event["job_id"]})
+            await asyncio.gather(job_task, return_exceptions=True)
+        finally:
+            listener.cancel()
+            job_task.cancel()
+            await layer.send(reply_channel, {"type": "worker.finished", "job_id": event["job_id"]})
@@ -10,8 +10,9 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 import os
 
 from channels.auth import AuthMiddlewareStack
-from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.routing import ChannelNameRouter, ProtocolTypeRouter, URLRouter
 from channels.security.websocket import AllowedHostsOriginValidator
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
@@ -21,9 +22,12 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 django_asgi_app = get_asgi_application()
 
 from backend.routing import websocket_urlpatterns
+from api.lifecycle import LifespanApp
+from api.workers import EnhanceWorker
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
+    "lifespan": LifespanApp(),
     "websocket": AllowedHostsOriginValidator(
         AuthMiddlewareStack(
             URLRouter(
@@ -31,4 +35,8 @@ application = ProtocolTypeRouter({
             )
         )
     ),
+    # Enhancement workers started with `manage.py runworker <ENHANCE_WORKER_CHANNEL>`
+    "channel": ChannelNameRouter({
+        settings.ENHANCE_WORKER_CHANNEL or "enhance-jobs": EnhanceWorker.as_asgi(),
+    }),
 })
@@ -87,6 +87,14 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Channel of the enhancement worker processes. Empty runs enhance/edit jobs inside
+# the process holding the WebSocket. When set, consumers only relay frames and jobs
+# run in `python manage.py runworker <channel>` processes; that needs a channel layer
+# shared between the processes (e.g. Redis), and CONVERSATION_STORE must reach them all.
+ENHANCE_WORKER_CHANNEL = os.getenv('ENHANCE_WORKER_CHANNEL', '')
+# Seconds a consumer waits for a worker to take a job before failing it
+ENHANCE_WORKER_START_TIMEOUT = float(os.getenv('ENHANCE_WORKER_START_TIMEOUT', '10'))
+
 # Cache Configuration (local memory for development)
 CACHES = {
     'default': {
@@ -95,6 +103,55 @@ CACHES = {
     }
 }
 
+# Enhancement conversations, which edits continue from. The SQLite file is shared by
+# the processes of one host; use api.conversations.RedisConversationStore with
+# OPTIONS {'url': 'redis://...'} to share them between hosts. A single process can
+# keep them in memory with api.conversations.MemoryConversationStore and OPTIONS
+# {'max_bytes': ...}; least recently used sessions beyond the budget are evicted.
+CONVERSATION_STORE = {
+    'BACKEND': 'api.conversations.SQLiteConversationStore',
+    'OPTIONS': {'path': BASE_DIR / 'conversations.sqlite3'},
+}
+CONVERSATION_TTL_SECONDS = 3600
+
+# Exact-match enhancement result cache. Point this at a shared cache alias
+# (e.g. Redis) to share results across processes.
+ENHANCE_RESULT_CACHE = 'default'
+ENHANCE_RESULT_CACHE_TTL = 24 * 3600  # seconds
+
+# Estimated tokens of conversation history sent per LLM call; older tool outputs and
+# superseded drafts are trimmed beyond this
+LLM_CONTEXT_TOKEN_BUDGET = 24000
+LLM_TOOL_OUTPUT_KEEP_CHARS = 600
+
+# Latency budget of one enhance/edit request (seconds). Time spent waiting for the
+# user's answers is not counted. Tool calls are skipped once less than the reserve
+# remains, so the model can still give its final answer in time.
+AGENT_REQUEST_BUDGET_SECONDS = 90
+AGENT_LLM_CALL_TIMEOUT_SECONDS = 45
+AGENT_TOOL_TIMEOUT_SECONDS = 15
+AGENT_FINAL_ANSWER_RESERVE_SECONDS = 20
+AGENT_MAX_ITERATIONS = 6
+
+# Near-duplicate lookup over previous lazy prompts (MinHash + LSH, in-process)
+NEAR_DUPLICATE_MAX_ENTRIES = 10000
+NEAR_DUPLICATE_INSTANT_THRESHOLD = 0.9  # estimated Jaccard similarity to reuse a result as-is
+NEAR_DUPLICATE_SEED_THRESHOLD = 0.6  # ...to pass a result to the model as a starting point
+
+# Enhance/edit tasks running at once per process. Interactive WebSocket tasks are
+# admitted before batch items, and clients share the slots fairly.
+SCHEDULER_MAX_CONCURRENCY = 16
+# Queue positions sent to waiting clients are recomputed at most this often (seconds)
+SCHEDULER_POSITION_INTERVAL = 0.5
+
+# Batch enhancement jobs (/api/batches/). Items of all batches in one process share
+# BATCH_MAX_CONCURRENCY slots; a batch runs BATCH_DEFAULT_CONCURRENCY items at once
+# unless the request asks for fewer (or more, up to the process limit). Keep it below
+# SCHEDULER_MAX_CONCURRENCY so interactive requests never wait for a batch to drain.
+BATCH_MAX_CONCURRENCY = 8
+BATCH_DEFAULT_CONCURRENCY = 4
+BATCH_MAX_ITEMS = 5000
+
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
@@ -169,6 +226,17 @@ CORS_ALLOWED_HOSTS = [
 
 # WebSocket Rate Limiting
 WS_RATE_LIMIT = 3 if not DEBUG else 99  # Requests per minute
+# Token buckets per client IP and route, as '<count>/<second|minute|hour|day>'. The
+# buckets live in each process; use api.rate_limit.RedisRateLimiter with OPTIONS
+# {'url': 'redis://...'} to share them between processes.
+WS_RATE_LIMITS = {
+    'enhance': f'{WS_RATE_LIMIT}/minute',
+    'edit': f'{WS_RATE_LIMIT}/minute',
+    'answer': f'{10 * WS_RATE_LIMIT}/minute',
+}
+WS_RATE_LIMITER = {
+    'BACKEND': 'api.rate_limit.LocalRateLimiter',
+}
 
 # REST Framework settings
 REST_FRAMEWORK = {
@@ -0,0 +1,77 @@
+"""clean_text_for_llm on multi-MB inputs, compared with the previous implementation.
+
+Run from the backend directory:
+    python -m benchmarks.bench_clean_text [--megabytes 4] [--repeat 3]
+"""
+import argparse
+import os
+import random
+import re
+import time
+import unicodedata
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")
+django.setup()
+
+from api.shared_utils import clean_text_for_llm  # noqa: E402
+
+
+def previous_clean_text_for_llm(text):
+    text = unicodedata.normalize('NFKC', text)
+    text = ''.join(c for c in text if unicodedata.category(c)[0] != 'C' or c in '\n\r\t')
+    text = re.sub(r'[​-‍﻿]', '', text)
+    text = re.sub(r'\s+', ' ', text)
+    return text.strip()
+
+
+def web_text(rng: random.Random, size: int) -> str:
+    words = "search result snippet about prompt engineering with examples and best practices for models".split()
+    parts = []
+    length = 0
+    while length < size:
+        word = rng.choice(words)
+        parts.append(word)
+        parts.append(rng.choice((" ", " ", " ", "\n", "  ", "\t")))
+        length += len(word) + 1
+    return "".join(parts)
+
+
+def unicode_text(rng: random.Random, size: int) -> str:
+    alphabet = "Grüße naïve café 東京 Привет مرحبا 😀 ﬁ ① ｆｕｌｌ ​  ﻿\x00\x07"
+    return "".join(rng.choice(alphabet) for _ in range(size))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--megabytes", type=float, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    size = int(args.megabytes * 1_000_000)
+    inputs = {
+        "ascii web text": web_text(rng, size),
+        "mixed unicode": unicode_text(rng, size),
+    }
+    for name, text in inputs.items():
+        assert clean_text_for_llm(text) == previous_clean_text_for_llm(text)
+        timings = {}
+        for label, func in (("previous", previous_clean_text_for_llm), ("current", clean_text_for_llm)):
+            best = float("inf")
+            for _ in range(args.repeat):
+                t_start = time.perf_counter()
+                func(text)
+                best = min(best, time.perf_counter() - t_start)
+            timings[label] = best
+        megabytes = len(text.encode()) / 1e6
+        print(
+            f"{name:<15} {megabytes:5.1f} MB  previous {timings['previous'] * 1000:8.1f} ms "
+            f"({megabytes / timings['previous']:6.1f} MB/s)  current {timings['current'] * 1000:7.1f} ms "
+            f"({megabytes / timings['current']:6.1f} MB/s)  {timings['previous'] / timings['current']:5.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Stored size and encode/decode time of enhancement conversations, compact
+encoding against the compact JSON stored before and the pickles LocMemCache kept
+before that.
+
+Run from the backend directory:
+    python -m benchmarks.bench_conversation_encoding [--sessions 500] [--search-kb 4]
+"""
+import argparse
+import json
+import os
+import pickle
+import random
+import time
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")
+django.setup()
+
+from openai.types.chat import ChatCompletionMessage  # noqa: E402
+
+from api import history_codec  # noqa: E402
+from api.prompt import build_enhancement_prompts  # noqa: E402
+
+WORDS = (
+    "prompt engineering guide examples model instructions context output format "
+    "few-shot reasoning chain of thought structured json schema role system user "
+    "best practices clarity specificity constraints evaluation temperature tokens "
+    "the a of to and in for with on is are be this that how when"
+).split()
+
+
+def prose(rng: random.Random, size: int) -> str:
+    parts = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        parts.append(word)
+        length += len(word) + 1
+    return " ".join(parts)
+
+
+def search_dump(rng: random.Random, size: int) -> str:
+    results = []
+    for index in range(5):
+        results.append({
+            "title": prose(rng, 60).title(),
+            "url": f"https://example{rng.randrange(1000)}.com/{'-'.join(rng.sample(WORDS, 4))}",
+            "content": prose(rng, size // 5),
+        })
+    return json.dumps({"query": prose(rng, 40), "results": results})
+
+
+def tool_call_message(rng: random.Random, call_id: str) -> dict:
+    arguments = json.dumps({"query": prose(rng, 50)})
+    return ChatCompletionMessage(
+        role="assistant",
+        content=None,
+        tool_calls=[{"id": call_id, "type": "function", "function": {"name": "web_search", "arguments": arguments}}],
+    ).model_dump(mode="json")
+
+
+def session(rng: random.Random, search_kb: float) -> list[dict]:
+    use_web_search = rng.random() < 0.8
+    prompts = build_enhancement_prompts(
+        task=prose(rng, 80),
+        lazy_prompt=prose(rng, rng.randint(100, 600)),
+        use_web_search=use_web_search,
+        additional_context="",
+        target_model=rng.choice(("gpt-5.1", "claude-sonnet-4", "gemini-3-pro")),
+        prompt_style={},
+        is_reasoning_native=rng.random() < 0.3,
+    )
+    messages = [
+        {"role": "system", "content": prompts["system_prompt"]},
+        {"role": "user", "content": prompts["user_prompt"]},
+    ]
+    if use_web_search:
+        for round_index in range(rng.randint(1, 3)):
+            call_id = f"call_{rng.getrandbits(64):016x}"
+            messages.append(tool_call_message(rng, call_id))
+            messages.append({"role": "tool", "tool_call_id": call_id, "content": search_dump(rng, int(search_kb * 1000))})
+    answer = ChatCompletionMessage(role="assistant", content=f"<prompt>{prose(rng, 1500)}</prompt>")
+    messages.append(answer.model_dump(mode="json"))
+    return messages
+
+
+def best_of(repeat: int, func) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t_start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=500)
+    parser.add_argument("--search-kb", type=float, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    sessions = [session(rng, args.search_kb) for _ in range(args.sessions)]
+
+    json_payloads = [json.dumps(messages, separators=(",", ":")).encode() for messages in sessions]
+    encoded = [history_codec.encode_chunk(messages) for messages in sessions]
+    blobs = {digest: text for _, session_blobs in encoded for digest, text in session_blobs.items()}
+    for messages, (payload, _) in zip(sessions, encoded):
+        assert history_codec.decode_chunk(payload, blobs) == messages
+
+    pickle_bytes = sum(len(pickle.dumps(messages, pickle.HIGHEST_PROTOCOL)) for messages in sessions) / len(sessions)
+    json_bytes = sum(map(len, json_payloads)) / len(sessions)
+    compact_bytes = sum(len(payload) for payload, _ in encoded) / len(sessions)
+    blob_bytes = sum(len(text.encode()) for text in blobs.values())
+    print(f"{len(sessions)} sessions, {len(blobs)} distinct system prompts ({blob_bytes / 1000:.1f} kB stored once)")
+    amortized_bytes = compact_bytes + blob_bytes / len(sessions)
+    print(f"bytes/session  pickle {pickle_bytes:8.0f}  json {json_bytes:8.0f}  compact {compact_bytes:7.0f}")
+    print(
+        f"with prompts amortized  compact {amortized_bytes:7.0f}  "
+        f"{pickle_bytes / amortized_bytes:5.1f}x smaller than pickle, {json_bytes / amortized_bytes:5.1f}x than json"
+    )
+
+    timings = {
+        "json encode": best_of(args.repeat, lambda: [json.dumps(m, separators=(",", ":")).encode() for m in sessions]),
+        "json decode": best_of(args.repeat, lambda: [json.loads(p) for p in json_payloads]),
+        "compact encode": best_of(args.repeat, lambda: [history_codec.encode_chunk(m) for m in sessions]),
+        "compact decode": best_of(args.repeat, lambda: [history_codec.decode_chunk(p, blobs) for p, _ in encoded]),
+    }
+    for label, seconds in timings.items():
+        print(f"{label:<15} {seconds / len(sessions) * 1e6:8.1f} µs/session")
+
+
+if __name__ == "__main__":
+    main()
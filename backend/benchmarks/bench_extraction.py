@@ -0,0 +1,80 @@
+"""Extraction success rate over a corpus of model outputs.
+
+Compares the previous parse chain (json_repair, then the <improved-prompt> regex,
+then parse_llm_response_markdown) with OutputExtractor fed in stream-sized deltas.
+Every miss on an output that holds a prompt costs an extra completions.parse call.
+
+Run from the backend directory:
+    python -m benchmarks.bench_extraction [--corpus benchmarks/corpus/model_outputs.jsonl] [--delta-size 8]
+"""
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")
+django.setup()
+
+from api.extraction import OutputExtractor  # noqa: E402
+from benchmarks.legacy_parsing import legacy_parse  # noqa: E402
+
+DEFAULT_CORPUS = Path(__file__).parent / "corpus" / "model_outputs.jsonl"
+
+
+def load_corpus(path: Path) -> list[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def streamed_extract(content: str, delta_size: int) -> tuple[str | None, str | None]:
+    extractor = OutputExtractor()
+    for start in range(0, len(content), delta_size):
+        extractor.feed(content[start:start + delta_size])
+    return extractor.result(), extractor.format
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", type=Path, default=DEFAULT_CORPUS)
+    parser.add_argument("--delta-size", type=int, default=8)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    with_prompt = [entry for entry in corpus if entry["expected"] is not None]
+    rows = []
+    legacy_ok = new_ok = legacy_parse_calls = new_parse_calls = 0
+    legacy_seconds = new_seconds = 0.0
+    for entry in corpus:
+        t_start = time.perf_counter()
+        legacy = legacy_parse(entry["output"])
+        legacy_seconds += time.perf_counter() - t_start
+        t_start = time.perf_counter()
+        new, fmt = streamed_extract(entry["output"], args.delta_size)
+        new_seconds += time.perf_counter() - t_start
+
+        legacy_hit = legacy == entry["expected"]
+        new_hit = new == entry["expected"]
+        legacy_ok += legacy_hit
+        new_ok += new_hit
+        legacy_parse_calls += not legacy
+        new_parse_calls += not new
+        rows.append((entry["id"], legacy_hit, new_hit, fmt))
+
+    width = max(len(row[0]) for row in rows)
+    print(f"{'output':<{width}}  legacy  extractor  format")
+    for entry_id, legacy_hit, new_hit, fmt in rows:
+        print(f"{entry_id:<{width}}  {'ok' if legacy_hit else 'miss':<6}  {'ok' if new_hit else 'miss':<9}  {fmt or '-'}")
+    print()
+    print(f"corpus: {len(corpus)} outputs, {len(with_prompt)} with a prompt")
+    print(f"correct: legacy {legacy_ok}/{len(corpus)} ({legacy_ok / len(corpus):.0%}), "
+          f"extractor {new_ok}/{len(corpus)} ({new_ok / len(corpus):.0%})")
+    print(f"final parse calls needed: legacy {legacy_parse_calls}/{len(corpus)}, extractor {new_parse_calls}/{len(corpus)}")
+    print(f"time per output: legacy {legacy_seconds / len(corpus) * 1e6:.0f} us, "
+          f"extractor {new_seconds / len(corpus) * 1e6:.0f} us (delta size {args.delta_size})")
+
+
+if __name__ == "__main__":
+    main()
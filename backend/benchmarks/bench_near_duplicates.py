@@ -0,0 +1,66 @@
+"""Lookup latency of the near-duplicate index.
+
+Run from the backend directory:
+    python -m benchmarks.bench_near_duplicates [--entries 100000] [--queries 1000]
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+from api.near_duplicates import NearDuplicateIndex
+
+WORDS = (
+    "write essay email cover letter plan summary report marketing campaign python script "
+    "data analysis story poem product launch customer support reply lesson quiz recipe "
+    "workout travel itinerary budget startup pitch research paper review blog post tweet"
+).split()
+
+
+def random_prompt(rng: random.Random) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 30)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=1000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    index = NearDuplicateIndex(max_entries=args.entries)
+    prompts = [random_prompt(rng) for _ in range(args.entries)]
+
+    t_start = time.perf_counter()
+    for i, prompt in enumerate(prompts):
+        index.add("task", prompt, "scope", f"result {i}", f"key {i}")
+    build_seconds = time.perf_counter() - t_start
+
+    queries = []
+    for _ in range(args.queries):
+        words = rng.choice(prompts).split()
+        words[rng.randrange(len(words))] = rng.choice(WORDS)
+        queries.append(" ".join(words))
+
+    latencies = []
+    found = 0
+    for query in queries:
+        t_query = time.perf_counter()
+        found += index.query("task", query, "scope", 0.6) is not None
+        latencies.append(time.perf_counter() - t_query)
+
+    latencies_ms = np.array(latencies) * 1000
+    print(f"entries: {len(index)}, signature memory: {index.stats()['signature_bytes'] / 1e6:.1f} MB")
+    print(f"build: {build_seconds:.1f}s ({args.entries / build_seconds:.0f} inserts/s)")
+    print(f"lookups: {args.queries}, near-duplicates found: {found}")
+    print(
+        "lookup latency ms: "
+        f"p50={np.percentile(latencies_ms, 50):.3f} "
+        f"p95={np.percentile(latencies_ms, 95):.3f} "
+        f"p99={np.percentile(latencies_ms, 99):.3f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Throughput of the response parser on a large synthetic corpus.
+
+Compares the previous chain (json_repair, then the <improved-prompt> regex, then
+parse_llm_response_markdown) and the previous markdown parser on its own with the
+single-pass parse_response.
+
+Run from the backend directory:
+    python -m benchmarks.bench_parsing [--outputs 20000] [--seed 0]
+"""
+import argparse
+import json
+import os
+import random
+import time
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")
+django.setup()
+
+from api import extraction  # noqa: E402
+from api.extraction import parse_llm_response_markdown, parse_response  # noqa: E402
+from benchmarks import legacy_parsing  # noqa: E402
+
+WORDS = (
+    "the prompt should specify audience tone length format examples constraints context goal "
+    "user wants a clear concise detailed answer about product marketing code data analysis "
+    "travel plan essay email story lesson report include avoid use explain list steps"
+).split()
+
+
+def sentence(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def paragraph(rng: random.Random, sentences: int) -> str:
+    return " ".join(sentence(rng, rng.randint(6, 18)) for _ in range(sentences))
+
+
+def synthetic_output(rng: random.Random) -> str:
+    analysis = "\n\n".join(paragraph(rng, rng.randint(2, 6)) for _ in range(rng.choices((1, 2, 4, 40, 400), (30, 30, 25, 14, 1))[0]))
+    prompt = "\n".join(paragraph(rng, rng.randint(1, 4)) for _ in range(rng.randint(1, 6)))
+    kind = rng.choice(("xml", "markdown", "bold", "heading-fenced", "json", "fenced", "prose"))
+    if kind == "xml":
+        return f"<analysis>\n{analysis}\n</analysis>\n\n<improved-prompt>\n{prompt}\n</improved-prompt>"
+    if kind == "markdown":
+        return f"- Analysis:\n{analysis}\n\n- Improved Prompt:\n{prompt}"
+    if kind == "bold":
+        return f"**Analysis:**\n{analysis}\n\n**Improved Prompt:**\n{prompt}"
+    if kind == "heading-fenced":
+        return f"## Analysis\n{analysis}\n\n## Improved Prompt\n```markdown\n{prompt}\n```"
+    if kind == "json":
+        return json.dumps({"analysis": analysis, "improved_prompt": prompt})
+    if kind == "fenced":
+        return f"{analysis}\n\n```\n{prompt}\n```"
+    return analysis
+
+
+def old_markdown_chain(text: str):
+    return legacy_parsing.parse_llm_response_XML(text) or legacy_parsing.parse_llm_response_markdown(text)
+
+
+def new_markdown_chain(text: str):
+    return parse_response(text)[0]
+
+
+def measure(func, corpus: list[str]) -> tuple[float, list]:
+    t_start = time.perf_counter()
+    results = [func(text) for text in corpus]
+    return time.perf_counter() - t_start, results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--outputs", type=int, default=20_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    corpus = [synthetic_output(rng) for _ in range(args.outputs)]
+    megabytes = sum(len(text) for text in corpus) / 1e6
+    print(f"corpus: {len(corpus)} outputs, {megabytes:.1f} MB, largest {max(map(len, corpus)) / 1e3:.0f} kB")
+
+    # Keep debug logging out of the measurement
+    extraction.log = legacy_parsing.log = lambda *args, **kwargs: None
+
+    runs = [
+        ("legacy chain (json_repair first)", legacy_parsing.legacy_parse),
+        ("legacy xml + markdown", old_markdown_chain),
+        ("legacy markdown only", legacy_parsing.parse_llm_response_markdown),
+        ("new markdown only", parse_llm_response_markdown),
+        ("parse_response (single pass)", new_markdown_chain),
+    ]
+    results = {}
+    for name, func in runs:
+        seconds, results[name] = measure(func, corpus)
+        found = sum(1 for result in results[name] if result)
+        print(f"{name:<34} {seconds:7.2f}s  {megabytes / seconds:7.1f} MB/s  {len(corpus) / seconds:9.0f} outputs/s  found {found}")
+
+    same = sum(
+        old == new for old, new in zip(results["legacy markdown only"], results["new markdown only"])
+    )
+    print(f"markdown parser agreement with the previous implementation: {same}/{len(corpus)}")
+
+
+if __name__ == "__main__":
+    main()
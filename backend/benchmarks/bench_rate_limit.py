@@ -0,0 +1,79 @@
+"""Latency of WebSocket rate limit checks with many sockets sending at once,
+compared with the previous check on the Django cache behind sync_to_async.
+
+Run from the backend directory:
+    python -m benchmarks.bench_rate_limit [--sockets 10000] [--checks 5]
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")
+django.setup()
+
+import numpy as np  # noqa: E402
+from asgiref.sync import sync_to_async  # noqa: E402
+from django.core.cache import cache  # noqa: E402
+
+from api.rate_limit import LocalRateLimiter  # noqa: E402
+
+
+def previous_check_rate_limit_sync(ip_address, limit):
+    cache_key = f"ws_enhance_limit_{ip_address}"
+    count = cache.get(cache_key, 0)
+    if count >= limit:
+        return False
+    if count == 0:
+        cache.set(cache_key, 1, 60)
+    else:
+        cache.incr(cache_key)
+    return True
+
+
+async def run(sockets: int, checks: int, check) -> tuple[np.ndarray, float]:
+    """Every socket sends `checks` messages at once; latency of each check and the wall time."""
+    latencies = np.empty(sockets * checks)
+
+    async def socket(index: int):
+        for round_index in range(checks):
+            t_start = time.perf_counter()
+            await check(f"10.{index >> 16}.{(index >> 8) & 255}.{index & 255}")
+            latencies[index * checks + round_index] = time.perf_counter() - t_start
+            # Let the other sockets in between, as messages arriving on the loop would
+            await asyncio.sleep(0)
+
+    t_start = time.perf_counter()
+    await asyncio.gather(*(socket(index) for index in range(sockets)))
+    return latencies, time.perf_counter() - t_start
+
+
+def report(label: str, latencies: np.ndarray, wall: float):
+    p50, p99, top = np.percentile(latencies, [50, 99, 100]) * 1e6
+    print(
+        f"{label:<28} p50 {p50:10.1f} µs  p99 {p99:10.1f} µs  max {top:10.1f} µs  "
+        f"{len(latencies) / wall:10.0f} checks/s"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sockets", type=int, default=10000)
+    parser.add_argument("--checks", type=int, default=5)
+    args = parser.parse_args()
+    limit = 3
+
+    limiter = LocalRateLimiter({"enhance": f"{limit}/minute"})
+    report("token bucket (in loop)", *await run(args.sockets, args.checks, lambda ip: limiter.allow("enhance", ip)))
+    stats = limiter.stats()
+    assert stats["allowed"]["enhance"] == args.sockets * min(limit, args.checks)
+
+    cache.clear()
+    previous = sync_to_async(previous_check_rate_limit_sync)
+    report("cache via sync_to_async", *await run(args.sockets, args.checks, lambda ip: previous(ip, limit)))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,82 @@
+"""The response parsing chain as it was before the single-pass parser, kept as a baseline for the benchmarks."""
+import re
+
+import json_repair
+
+from api import log
+
+
+def legacy_parse(content: str) -> str | None:
+    """json_repair first, then the <improved-prompt> regex, then the markdown scan."""
+    if not content:
+        return None
+    try:
+        parsed = json_repair.loads(content)
+        if "improved_prompt" in parsed:
+            return parsed["improved_prompt"]
+    except Exception:
+        return parse_llm_response_XML(content) or parse_llm_response_markdown(content)
+    return None
+
+
+def parse_llm_response_XML(response: str) -> str | None:
+    improved_prompt_match = re.search(r"<improved-prompt>(.*?)</improved-prompt>", response, re.DOTALL)
+    if improved_prompt_match:
+        improved_prompt = improved_prompt_match.group(1).strip()
+        log(f"[DEBUG] Parsed Improved Prompt: {improved_prompt[:50]}...")
+        return improved_prompt
+    else:
+        log("[DEBUG] No <improved-prompt> tag found in LLM response.")
+        return None
+
+def parse_llm_response_markdown(response: str) -> str | None:
+    marker_pattern = re.compile(
+        r"^\s*(?:[-*+]\s*)?(?:\*{1,2}\s*)?(?:[-*+]\s*)?(?:#{1,6}\s*)?Improved\s+Prompt(?:\s*\*{1,2})?\s*:?\s*(?:\*{1,2})?\s*(.*)$",
+        re.IGNORECASE,
+    )
+
+    next_section_pattern = re.compile(
+        r"^\s*(?:\*{1,2})?\s*(?:#{1,6}\s*)?[A-Z][A-Za-z0-9\s/&()_-]{1,48}\s*:?\s*(?:\*{1,2})?\s*$"
+    )
+
+    lines = response.splitlines()
+    for idx, line in enumerate(lines):
+        marker_match = marker_pattern.match(line)
+        if not marker_match:
+            continue
+
+        inline_value = marker_match.group(1).strip()
+        if inline_value:
+            if inline_value.startswith("**Prompt:**"):
+                inline_value = inline_value[len("**Prompt:**"):].strip()
+            if inline_value:
+                log(f"[DEBUG] Parsed Improved Prompt from Markdown inline label: {inline_value[:50]}...")
+                return inline_value
+
+        collected: list[str] = []
+        in_code_fence = False
+        for next_line in lines[idx + 1:]:
+            stripped = next_line.strip()
+
+            if stripped.startswith("```"):
+                in_code_fence = not in_code_fence
+                continue
+
+            if not in_code_fence and next_section_pattern.match(next_line) and stripped:
+                break
+
+            collected.append(next_line)
+
+        improved_prompt = "\n".join(collected).strip()
+        if improved_prompt.startswith("**Prompt:**"):
+            improved_prompt = improved_prompt[len("**Prompt:**"):].strip()
+
+        if improved_prompt:
+            log(f"[DEBUG] Parsed Improved Prompt from Markdown block: {improved_prompt[:50]}...")
+            return improved_prompt
+
+        log("[DEBUG] Found Improved Prompt label but no prompt content.")
+        return None
+
+    log("[DEBUG] No markdown Improved Prompt label found in LLM response.")
+    return None
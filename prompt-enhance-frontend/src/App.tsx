@@ -26,6 +26,7 @@ function App({showRightPanel = false}: {showRightPanel?: boolean} = {}) {
 
   const [savedEntries, setSavedEntries] = useState<SavedEntry[]>()
   const [isLoading, setIsLoading] = useState(false)
+  const [queuePosition, setQueuePosition] = useState<number | null>(null)
   const [ws, setWs] = useState<WebSocket | null>(null)
   const [userQuestions, setUserQuestions] = useState<Array<string> | null>(null)
   const [userAnswers, setUserAnswers] = useState<string[]>([])
@@ -143,6 +144,7 @@ function App({showRightPanel = false}: {showRightPanel?: boolean} = {}) {
 
   const handleEnhance = () => {
     setIsLoading(true)
+    setQueuePosition(null)
     setEnhancedPrompt('')
     setErrorMessage(null)
     setUserQuestions(null)
@@ -168,6 +170,7 @@ function App({showRightPanel = false}: {showRightPanel?: boolean} = {}) {
         target_model: targetModel,
         is_reasoning_native: isReasoningNative,
         reasoning_effort: thinkingMode,
+        stream: true,
         prompt_style: {
           formatting: promptFormatting,
           length: promptLength,
@@ -183,6 +186,14 @@ function App({showRightPanel = false}: {showRightPanel?: boolean} = {}) {
 
       if (data.type === 'processing') {
         console.log('Enhancement processing started')
+      } else if (data.type === 'queued') {
+        // Place in the server's queue; 0 once the enhancement starts running
+        setQueuePosition(data.position || null)
+      } else if (data.type === 'task_delta') {
+        // Show the improved prompt as it is being written; a reset starts it over
+        // with a new draft (the next model turn, or a retry on the fallback model)
+        setEnhancedPrompt(prev => (data.reset ? '' : prev) + data.delta)
+        requestAnimationFrame(() => resizeEnhancedTextarea())
       } else if (data.type === 'user_question') {
         // Show dialog with user questions
         setUserQuestions(data.questions)
@@ -245,6 +256,7 @@ function App({showRightPanel = false}: {showRightPanel?: boolean} = {}) {
 
     console.log('Submitting edit request:', editRequest)
     setIsEditLoading(true)
+    setQueuePosition(null)
 
     // Generate task ID on client side
     const taskId = crypto.randomUUID()
@@ -281,6 +293,8 @@ function App({showRightPanel = false}: {showRightPanel?: boolean} = {}) {
 
       if (data.type === 'processing') {
         console.log('Edit processing started')
+      } else if (data.type === 'queued') {
+        setQueuePosition(data.position || null)
       } else if (data.type === 'task_complete') {
         console.log('Edit complete, result length:', data.result?.length)
         setEnhancedPrompt(data.result)
@@ -763,11 +777,16 @@ function App({showRightPanel = false}: {showRightPanel?: boolean} = {}) {
               )}
             </div>
           )}
-          {isLoading ? (
+          {isLoading && enhancedPrompt ? (
+            // Draft streamed so far; editable once the enhancement completes
+            <pre className="enhanced-output">{enhancedPrompt}</pre>
+          ) : isLoading ? (
             <pre className="enhanced-output">
               <div className="spinner-container">
                 <div className="spinner"></div>
-                <span>Enhancing your prompt...</span>
+                <span>
+                  {queuePosition ? `Waiting in queue (position ${queuePosition})...` : 'Enhancing your prompt...'}
+                </span>
               </div>
             </pre>
           ) : 
@@ -812,6 +831,9 @@ function App({showRightPanel = false}: {showRightPanel?: boolean} = {}) {
                 </svg>
               )}
             </button>
+            {isEditLoading && queuePosition ? (
+              <span className="queue-status">In queue: {queuePosition}</span>
+            ) : null}
           </div>
         )}
       </aside>